@@ -0,0 +1,256 @@
+# Cleans messages from files offline, with the same scanner and tracker rules as the bot.
+# No Discord token needed.
+#
+# Usage:
+#   python3 batch_clean.py messages.txt -o clean.txt                  One message per line
+#   python3 batch_clean.py messages.jsonl --field content -o out.jsonl One JSON object per line
+#   python3 batch_clean.py export.json -o clean.json                  DiscordChatExporter or Discord data package JSON
+#   python3 batch_clean.py messages.jsonl --summary-only --trackers new.json   Try a tracker list
+#
+# Messages are cleaned in batches on a process pool. Output keeps the input order, and only
+# a bounded number of batches is in flight, so text and JSONL files of any size stream through.
+# Discord exports are single JSON documents and are loaded whole. The summary goes to stderr.
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_FOLDER)
+
+import core  # noqa: E402
+
+FORMATS = ("text", "jsonl", "discord")
+DEFAULT_BATCH_SIZE = 1000
+BATCHES_PER_WORKER = 4  # Batches queued per worker, bounds memory and keeps workers busy
+
+STATE = None  # core.CleaningState of this worker process
+
+#--------------------------------------------------------------------
+# Worker
+#--------------------------------------------------------------------
+
+
+def init_worker(tracker_map: dict = None, regex: str = None) -> None:
+    """Load the bot's rules in a worker process, optionally with another tracker list or regex_keys pattern."""
+    global STATE
+    STATE = core.load_state(tracker_map=tracker_map, regex=regex)
+
+
+def clean_content(content: str, summary: dict):
+    """
+    Clean one message, like find_trackers() without short link expansion.
+
+    Returns:
+        str: The cleaned message, or None if it had no trackers
+    """
+    cleaned, results = STATE.clean_message(content)
+    for result in results:
+        summary["urls"] += 1
+        for provider, params in result["removed_trackers"].items():
+            counts = summary["providers"].setdefault(provider, [0, 0])
+            counts[0] += len(params)
+            counts[1] += 1
+    if cleaned is not None:
+        summary["cleaned"] += 1
+    return cleaned
+
+
+def new_summary() -> dict:
+    # providers: provider -> [params removed, URLs]
+    return {"messages": 0, "cleaned": 0, "urls": 0, "invalid": 0, "providers": {}}
+
+
+def clean_batch(fmt: str, items: list, field: str) -> tuple:
+    """
+    Clean a batch of input items in a worker.
+
+    Text items are lines, JSONL items are raw JSON lines and Discord export
+    items are message contents. Unchanged items come back as None so they
+    don't have to be sent back to the parent process.
+
+    Returns:
+        tuple: (list of cleaned items or None, batch summary)
+    """
+    summary = new_summary()
+    results = []
+    for item in items:
+        summary["messages"] += 1
+        if fmt == "jsonl":
+            try:
+                record = json.loads(item)
+                content = record[field]
+            except (ValueError, KeyError, TypeError):
+                summary["invalid"] += 1
+                results.append(None)
+                continue
+            if not isinstance(content, str):
+                results.append(None)
+                continue
+            cleaned = clean_content(content, summary)
+            if cleaned is not None:
+                record[field] = cleaned
+                cleaned = json.dumps(record, ensure_ascii=False)
+        else:
+            cleaned = clean_content(item, summary)
+        results.append(cleaned)
+    return results, summary
+
+
+def merge_summary(total: dict, summary: dict) -> None:
+    for key in ("messages", "cleaned", "urls", "invalid"):
+        total[key] += summary[key]
+    for provider, (params, urls) in summary["providers"].items():
+        counts = total["providers"].setdefault(provider, [0, 0])
+        counts[0] += params
+        counts[1] += urls
+
+#--------------------------------------------------------------------
+# Runner
+#--------------------------------------------------------------------
+
+
+def batches(items, batch_size: int):
+    """Group an iterable into lists of at most batch_size items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_ordered(executor, fmt: str, items, field: str, batch_size: int, window: int, total: dict):
+    """
+    Clean items on the pool, yielding (original, cleaned or None) pairs in input order.
+
+    At most `window` batches are submitted ahead of the one being written,
+    so memory stays bounded however long the input is.
+    """
+    pending = deque()
+    for batch in batches(items, batch_size):
+        pending.append((batch, executor.submit(clean_batch, fmt, batch, field)))
+        if len(pending) >= window:
+            yield from collect(pending.popleft(), total)
+    while pending:
+        yield from collect(pending.popleft(), total)
+
+
+def collect(entry: tuple, total: dict):
+    batch, future = entry
+    results, summary = future.result()
+    merge_summary(total, summary)
+    yield from zip(batch, results)
+
+
+def detect_format(path: str) -> str:
+    if path.endswith(".jsonl") or path.endswith(".ndjson"):
+        return "jsonl"
+    if path.endswith(".json"):
+        return "discord"
+    return "text"
+
+
+def export_messages(document) -> tuple:
+    """
+    Find the message list and content key of a Discord export.
+
+    DiscordChatExporter writes {"messages": [{"content": ...}]}; the Discord
+    data package writes a list of {"Contents": ...} per channel.
+    """
+    if isinstance(document, dict) and isinstance(document.get("messages"), list):
+        return document["messages"], "content"
+    if isinstance(document, list):
+        return document, "Contents"
+    raise ValueError("not a DiscordChatExporter or Discord data package messages file")
+
+
+def print_summary(total: dict, elapsed: float) -> None:
+    rate = total["messages"] / elapsed if elapsed else 0.0
+    out = sys.stderr
+    print(f"Messages: {total['messages']:,} in {elapsed:.1f}s ({rate:,.0f}/s)", file=out)
+    print(f"Messages with trackers: {total['cleaned']:,}, URLs cleaned: {total['urls']:,}", file=out)
+    if total["invalid"]:
+        print(f"Lines that were not valid JSON records: {total['invalid']:,}", file=out)
+    if total["providers"]:
+        print(f"{'provider':<32}{'params':>12}{'urls':>12}", file=out)
+        for provider, (params, urls) in sorted(total["providers"].items(), key=lambda item: -item[1][0]):
+            print(f"{provider:<32}{params:>12,}{urls:>12,}", file=out)
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Remove trackers from messages in text, JSONL or Discord export files.")
+    parser.add_argument("input", help="Input file, or - for stdin (text and jsonl only)")
+    parser.add_argument("-o", "--output", help="Output file (default: stdout)")
+    parser.add_argument("--format", choices=FORMATS, help="Input format (default: from the file extension)")
+    parser.add_argument("--field", default="content", help="Message field of JSONL records")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Messages per batch")
+    parser.add_argument("--trackers", help="Use this trackers.json instead of the configured one")
+    parser.add_argument("--regex", help="Use this regex_keys pattern instead of the configured one")
+    parser.add_argument("--summary-only", action="store_true", help="Only print the summary, write no output")
+    args = parser.parse_args()
+
+    tracker_map = None
+    if args.trackers:
+        with open(args.trackers, 'r', encoding='utf-8') as f:
+            tracker_map = json.load(f)
+    if args.regex:
+        try:
+            re.compile(args.regex)
+        except re.error as e:
+            parser.error(f"invalid --regex: {e}")
+
+    fmt = args.format or ("text" if args.input == "-" else detect_format(args.input))
+    if args.input == "-" and fmt == "discord":
+        parser.error("Discord exports can't be read from stdin")
+
+    total = new_summary()
+    window = max(1, args.jobs) * BATCHES_PER_WORKER
+    started = time.perf_counter()
+
+    if args.summary_only:
+        output = None
+    elif args.output:
+        output = open(args.output, 'w', encoding='utf-8', newline='')
+    else:
+        output = sys.stdout
+
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, args.jobs), initializer=init_worker,
+                                 initargs=(tracker_map, args.regex)) as executor:
+            if fmt == "discord":
+                with open(args.input, 'r', encoding='utf-8') as f:
+                    document = json.load(f)
+                messages, key = export_messages(document)
+                contents = (message.get(key) or "" for message in messages)
+                for message, (_, cleaned) in zip(messages, run_ordered(
+                        executor, fmt, contents, key, args.batch_size, window, total)):
+                    if cleaned is not None:
+                        message[key] = cleaned
+                if output is not None:
+                    json.dump(document, output, ensure_ascii=False, indent=2)
+            else:
+                source = sys.stdin if args.input == "-" else open(args.input, 'r', encoding='utf-8', newline='')
+                with source:
+                    lines = (line.rstrip("\r\n") for line in source)
+                    for original, cleaned in run_ordered(executor, fmt, lines, args.field, args.batch_size, window, total):
+                        if output is not None:
+                            output.write((original if cleaned is None else cleaned) + "\n")
+    finally:
+        if output is not None and output is not sys.stdout:
+            output.close()
+
+    print_summary(total, time.perf_counter() - started)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
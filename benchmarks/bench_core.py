@@ -0,0 +1,315 @@
+# Offline microbenchmarks for the message cleaning core. No Discord token needed.
+#
+# Usage:
+#   python benchmarks/bench_core.py                      Run and compare against baseline.json
+#   python benchmarks/bench_core.py --update-baseline    Store the current results as the baseline
+#   python benchmarks/bench_core.py --regex "..."        Benchmark a custom regex_keys pattern
+#   python benchmarks/bench_core.py --trackers my.json   Benchmark a different tracker list
+#
+# Without --trackers the built-in default tracker list is used, not this install's trackers.json
+# or rules.snapshot, so every run measures the same workload. A baseline is only compared against
+# runs with the same --trackers and --regex; re-record it whenever the default trackers change.
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import core  # noqa: E402
+
+STATE = None  # core.CleaningState under test, set in main_cli()
+
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+
+#--------------------------------------------------------------------
+# Corpus
+#--------------------------------------------------------------------
+
+WORDS = [
+    "check", "this", "out", "lol", "the", "new", "deal", "is", "live", "anyone",
+    "seen", "here", "what", "do", "you", "think", "about", "link", "my", "video"
+]
+UNICODE_WORDS = [
+    "héllo", "naïve", "café", "日本語", "テスト", "привет", "مرحبا", "שלום",
+    "😂", "🔥", "👀", "🎉", "ñandú", "straße"
+]
+DOMAINS = [
+    "example.com", "www.youtube.com", "youtu.be", "x.com", "www.amazon.com",
+    "open.spotify.com", "www.reddit.com", "github.com", "news.ycombinator.com",
+    "store.steampowered.com", "www.tiktok.com", "docs.python.org"
+]
+PLAIN_PARAMS = ["v", "id", "page", "q", "list", "sort", "lang", "index", "variant", "color"]
+
+
+def _random_value(rng: random.Random) -> str:
+    return "".join(rng.choices(string.ascii_letters + string.digits, k=rng.randint(3, 16)))
+
+
+def _random_url(rng: random.Random, tracker_keys: list, tracker_density: float) -> str:
+    scheme = rng.choice(["https://", "http://", "https://", ""])
+    path = "/".join(_random_value(rng) for _ in range(rng.randint(0, 3)))
+    url = f"{scheme}{rng.choice(DOMAINS)}/{path}"
+
+    param_count = rng.choice([0, 0, 1, 2, 3, 5])
+    params = []
+    for _ in range(param_count):
+        if tracker_keys and rng.random() < tracker_density:
+            key = rng.choice(tracker_keys)
+        else:
+            key = rng.choice(PLAIN_PARAMS)
+        params.append(f"{key}={_random_value(rng)}")
+    if params:
+        url += "?" + "&".join(params)
+    return url
+
+
+def generate_corpus(count: int, seed: int = 1234, tracker_keys: list = None) -> list:
+    """
+    Generate a synthetic corpus of chat messages.
+
+    Messages vary in length (a few words to a few hundred), URL count (most
+    have none), tracker density (share of query parameters that are trackers)
+    and how much non-ASCII text they contain. A share of URLs is drawn from a
+    small pool of popular links, the way the same links get reposted in chat.
+
+    Args:
+        count: Number of messages to generate
+        seed: Random seed, so runs are comparable
+        tracker_keys: Tracker parameter names to draw from (defaults to the tracker index)
+
+    Returns:
+        list: Message strings
+    """
+    rng = random.Random(seed)
+    if tracker_keys is None:
+        # Turn simple globs into concrete keys, regex rules can't be sampled
+        params = {core.split_host_scope(rule)[0] for rule in STATE.index}
+        tracker_keys = sorted(
+            param.replace("*", "x").replace("?", "x") for param in params
+            if not param.startswith(core.REGEX_RULE_PREFIX) and "[" not in param
+        )
+
+    popular_urls = [_random_url(rng, tracker_keys, 0.5) for _ in range(50)]
+
+    corpus = []
+    for _ in range(count):
+        length = rng.choice([3, 8, 15, 40, 120, 400])
+        url_count = rng.choices([0, 1, 2, 5], weights=[70, 20, 7, 3])[0]
+        tracker_density = rng.choice([0.0, 0.2, 0.5, 1.0])
+        unicode_share = rng.choice([0.0, 0.0, 0.1, 0.5])
+
+        tokens = [
+            rng.choice(UNICODE_WORDS) if rng.random() < unicode_share else rng.choice(WORDS)
+            for _ in range(length)
+        ]
+        for _ in range(url_count):
+            if rng.random() < 0.3:
+                url = rng.choice(popular_urls)
+            else:
+                url = _random_url(rng, tracker_keys, tracker_density)
+            tokens.insert(rng.randint(0, len(tokens)), url)
+        corpus.append(" ".join(tokens))
+    return corpus
+
+#--------------------------------------------------------------------
+# Stages
+#--------------------------------------------------------------------
+
+
+def _stage_clean_url_uncached(message: str):
+    for url in STATE.scanner.scan(message):
+        core._clean_url(url, STATE.rules)
+
+
+def _stage_clean_url_cached(message: str):
+    for url in STATE.scanner.scan(message):
+        STATE.clean_url(url)
+
+
+def _stage_pipeline(message: str):
+    # Mirrors on_message without the Discord calls
+    detected_companies = set()
+    replacements = []
+    for start, end in STATE.scanner.scan_spans(message):
+        result = STATE.clean_url(message[start:end])
+        if result["removed_trackers"]:
+            detected_companies.update(result["removed_trackers"].keys())
+            replacements.append((start, end, result["clean_url"]))
+    if detected_companies:
+        core.sanitize_message(message, replacements)
+        core.format_companies(detected_companies)
+
+
+def build_stages(corpus: list) -> dict:
+    """
+    Build the benchmark stages as name -> (function, inputs).
+
+    Stages that only make sense on messages with trackers (rewrite and
+    format_companies) get their inputs precomputed from the corpus.
+    """
+    rewrite_inputs = []
+    company_inputs = []
+    for message in corpus:
+        replacements = []
+        companies = set()
+        for start, end in STATE.scanner.scan_spans(message):
+            result = core._clean_url(message[start:end], STATE.rules)
+            if result["removed_trackers"]:
+                companies.update(result["removed_trackers"].keys())
+                replacements.append((start, end, result["clean_url"]))
+        if replacements:
+            rewrite_inputs.append((message, replacements))
+            company_inputs.append(companies)
+
+    return {
+        "has_link": (lambda message: bool(STATE.regex.search(message)), corpus),
+        "regex_findall": (lambda message: STATE.regex.findall(message), corpus),
+        "scanner": (STATE.scanner.scan, corpus),
+        "clean_url": (_stage_clean_url_uncached, corpus),
+        "clean_url_cached": (_stage_clean_url_cached, corpus),
+        "format_companies": (core.format_companies, company_inputs),
+        "rewrite": (lambda args: core.sanitize_message(*args), rewrite_inputs),
+        "pipeline": (_stage_pipeline, corpus),
+    }
+
+#--------------------------------------------------------------------
+# Runner
+#--------------------------------------------------------------------
+
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_stage(func, inputs: list, repeat: int) -> dict:
+    """
+    Time one stage over its inputs.
+
+    Args:
+        func: Stage function taking one input
+        inputs: Inputs to feed through the stage
+        repeat: Number of passes over the inputs (the best pass is reported)
+
+    Returns:
+        dict: ops/sec and p50/p99 per-call latency in microseconds
+    """
+    if not inputs:
+        return {"ops_per_sec": 0.0, "p50_us": 0.0, "p99_us": 0.0, "count": 0}
+
+    best_total = None
+    best_samples = None
+    perf_counter_ns = time.perf_counter_ns
+    for _ in range(repeat):
+        samples = []
+        total_start = perf_counter_ns()
+        for item in inputs:
+            start = perf_counter_ns()
+            func(item)
+            samples.append(perf_counter_ns() - start)
+        total = perf_counter_ns() - total_start
+        if best_total is None or total < best_total:
+            best_total = total
+            best_samples = samples
+
+    best_samples.sort()
+    return {
+        "ops_per_sec": len(inputs) / (best_total / 1e9),
+        "p50_us": _percentile(best_samples, 50) / 1000,
+        "p99_us": _percentile(best_samples, 99) / 1000,
+        "count": len(inputs)
+    }
+
+
+def load_state(regex: str = None, trackers_path: str = None) -> core.CleaningState:
+    """Build the rules under test: the default trackers, or a custom regex_keys pattern and/or tracker list."""
+    trackers = None
+    if trackers_path:
+        with open(trackers_path, 'r', encoding='utf-8') as f:
+            trackers = json.load(f)
+    return core.CleaningState(tracker_map=trackers, regex=regex)
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    """Return a list of (stage, current, baseline) for stages that regressed."""
+    regressions = []
+    for stage, stored in baseline.get("stages", {}).items():
+        current = results.get(stage)
+        if current is None or not stored.get("ops_per_sec"):
+            continue
+        if current["ops_per_sec"] < stored["ops_per_sec"] * (1 - tolerance):
+            regressions.append((stage, current["ops_per_sec"], stored["ops_per_sec"]))
+    return regressions
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the link cleaning core.")
+    parser.add_argument("--messages", type=int, default=20000, help="Corpus size")
+    parser.add_argument("--seed", type=int, default=1234, help="Corpus random seed")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes per stage, best is kept")
+    parser.add_argument("--regex", help="Custom regex_keys pattern to benchmark")
+    parser.add_argument("--trackers", help="Path to an alternative trackers.json")
+    parser.add_argument("--tolerance", type=float, default=0.30,
+                        help="Allowed throughput drop vs baseline before failing (0.30 = 30%%)")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline file")
+    parser.add_argument("--update-baseline", action="store_true", help="Store results as the new baseline")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    global STATE
+    STATE = load_state(args.regex, args.trackers)
+    corpus = generate_corpus(args.messages, args.seed)
+
+    results = {}
+    for name, (func, inputs) in build_stages(corpus).items():
+        if name == "clean_url_cached":
+            STATE.cache.clear()
+        results[name] = run_stage(func, inputs, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print(f"{'stage':<18}{'ops/sec':>14}{'p50 (us)':>12}{'p99 (us)':>12}{'inputs':>10}")
+        for name, result in results.items():
+            print(
+                f"{name:<18}{result['ops_per_sec']:>14,.0f}{result['p50_us']:>12.2f}"
+                f"{result['p99_us']:>12.2f}{result['count']:>10}"
+            )
+        print(f"URL cache: {STATE.cache.stats()}")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({"messages": args.messages, "seed": args.seed, "trackers": args.trackers, "regex": args.regex,
+                       "stages": results}, f, indent=4)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print("No baseline stored yet, run with --update-baseline to create one.")
+        return 0
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if (baseline.get("trackers"), baseline.get("regex")) != (args.trackers, args.regex):
+        print("Baseline was recorded with other --trackers/--regex options, not comparing.")
+        return 0
+
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    for stage, current, stored in regressions:
+        print(f"REGRESSION: {stage} {current:,.0f} ops/sec vs baseline {stored:,.0f} ops/sec")
+    if regressions:
+        return 1
+    print(f"All stages within {args.tolerance:.0%} of baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
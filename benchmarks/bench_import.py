@@ -0,0 +1,99 @@
+# Checks that importing the cleaning core stays fast and free of side effects.
+#
+# Usage:
+#   python benchmarks/bench_import.py                  Check against the default budgets
+#   python benchmarks/bench_import.py --budget-ms 30   Use a different import budget
+#
+# Each run starts a fresh interpreter, so nothing is cached in sys.modules. The import
+# must not pull in discord.py, aiohttp or asyncio, and must not create or change any file
+# next to core.py; the first load_state() call is timed separately.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_FOLDER = os.path.dirname(BENCH_DIR)
+
+DEFAULT_IMPORT_BUDGET_MS = 50.0
+DEFAULT_STATE_BUDGET_MS = 250.0
+FORBIDDEN_MODULES = ("discord", "aiohttp", "asyncio", "sqlite3")
+
+# Runs in the child interpreter, prints one JSON line
+CHILD = """
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import core
+imported = time.perf_counter()
+core.load_state()
+loaded = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "state_ms": (loaded - imported) * 1000,
+    "forbidden": [name for name in sys.argv[2:] if name in sys.modules],
+}))
+"""
+
+
+def folder_listing(folder: str) -> dict:
+    """Return name -> mtime of the files directly in a folder."""
+    listing = {}
+    for entry in os.scandir(folder):
+        if entry.is_file():
+            listing[entry.name] = entry.stat().st_mtime_ns
+    return listing
+
+
+def run_once() -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD, APP_FOLDER, *FORBIDDEN_MODULES],
+        capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Measure the import time of core.py.")
+    parser.add_argument("--runs", type=int, default=10, help="Fresh interpreters to start")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_IMPORT_BUDGET_MS,
+                        help="Allowed median time for `import core`")
+    parser.add_argument("--state-budget-ms", type=float, default=DEFAULT_STATE_BUDGET_MS,
+                        help="Allowed median time for the first core.load_state()")
+    args = parser.parse_args()
+
+    run_once()  # Warm up: compiles .pyc files, which would otherwise count as a side effect
+    before = folder_listing(APP_FOLDER)
+    runs = [run_once() for _ in range(args.runs)]
+    after = folder_listing(APP_FOLDER)
+
+    import_ms = statistics.median(run["import_ms"] for run in runs)
+    state_ms = statistics.median(run["state_ms"] for run in runs)
+    print(f"import core:       {import_ms:8.2f} ms median, {min(run['import_ms'] for run in runs):.2f} ms best")
+    print(f"core.load_state(): {state_ms:8.2f} ms median")
+
+    failures = []
+    if import_ms > args.budget_ms:
+        failures.append(f"import took {import_ms:.2f} ms, budget is {args.budget_ms:.2f} ms")
+    if state_ms > args.state_budget_ms:
+        failures.append(f"load_state() took {state_ms:.2f} ms, budget is {args.state_budget_ms:.2f} ms")
+    forbidden = sorted({name for run in runs for name in run["forbidden"]})
+    if forbidden:
+        failures.append(f"core pulled in {', '.join(forbidden)}")
+    changed = sorted(name for name in set(before) | set(after) if before.get(name) != after.get(name))
+    if changed:
+        failures.append(f"files changed next to core.py: {', '.join(changed)}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        return 1
+    print("Import within budget and free of side effects.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
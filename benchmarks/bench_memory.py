@@ -0,0 +1,196 @@
+# Measures how much memory the bot's discord.py caches take per server, for each gateway profile.
+# No Discord token needed.
+#
+# Usage:
+#   python benchmarks/bench_memory.py                       Compare the default and low_memory profiles
+#   python benchmarks/bench_memory.py --guilds 5000         Simulate more servers
+#   python benchmarks/bench_memory.py --channels 100 --emojis 200   Bigger servers
+#
+# Each profile runs in a fresh interpreter that feeds synthetic GUILD_CREATE and MESSAGE_CREATE
+# payloads into discord.py's connection state, the way the gateway would deliver them with that
+# profile's intents. Reported are the bytes traced by tracemalloc per server and, from a second
+# untraced run (tracemalloc's own bookkeeping would inflate it), the growth of the process RSS.
+
+import argparse
+import json
+import subprocess
+import sys
+
+PROFILES = ("default", "low_memory")
+
+# Runs in the child interpreter, prints one JSON line. The profiles mirror gateway_options()
+# in main.py; main.py itself isn't imported because importing it sets up the whole bot.
+CHILD = """
+import gc, json, sys, tracemalloc
+import discord
+
+profile, guilds, channels, roles, emojis, voice, messages, message_cache_size, trace = json.loads(sys.argv[1])
+
+if profile == "low_memory":
+    intents = discord.Intents.none()
+    intents.guilds = intents.guild_messages = intents.dm_messages = intents.message_content = True
+    options = {"intents": intents, "max_messages": None,
+               "member_cache_flags": discord.MemberCacheFlags.none(), "chunk_guilds_at_startup": False}
+else:
+    intents = discord.Intents.default()
+    intents.message_content = True
+    options = {"intents": intents, "max_messages": message_cache_size or None}
+
+def rss_kib():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+def user(user_id):
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0",
+            "global_name": f"User {user_id}", "avatar": "a" * 32, "bot": False}
+
+def member(user_id, role_ids):
+    return {"user": user(user_id), "roles": role_ids, "nick": None, "joined_at": "2024-01-01T00:00:00+00:00",
+            "deaf": False, "mute": False, "flags": 0}
+
+next_id = 10**17
+def snowflake():
+    global next_id
+    next_id += 1
+    return next_id
+
+def guild_payload():
+    guild_id = snowflake()
+    role_ids = [str(snowflake()) for _ in range(roles)]
+    payload = {
+        "id": str(guild_id), "name": f"Server {guild_id}", "owner_id": str(snowflake()), "member_count": 500,
+        "features": ["COMMUNITY", "NEWS"], "preferred_locale": "en-US",
+        "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "1071698660929", "position": 0,
+                   "color": 0, "hoist": False, "managed": False, "mentionable": False}] +
+                 [{"id": role_id, "name": f"role {i}", "permissions": "0", "position": i + 1, "color": 3447003,
+                   "hoist": False, "managed": False, "mentionable": True} for i, role_id in enumerate(role_ids)],
+        "channels": [{"id": str(snowflake()), "type": 0, "name": f"channel-{i}", "position": i,
+                      "topic": "Talk about things here", "nsfw": False, "rate_limit_per_user": 0,
+                      "permission_overwrites": [{"id": role_ids[i % roles] if roles else str(guild_id),
+                                                 "type": 0, "allow": "1024", "deny": "0"}]}
+                     for i in range(channels)],
+        "emojis": [{"id": str(snowflake()), "name": f"emoji_{i}", "roles": [], "require_colons": True,
+                    "managed": False, "animated": False, "available": True} for i in range(emojis)],
+        "stickers": [{"id": str(snowflake()), "name": f"sticker_{i}", "description": "", "tags": "x",
+                      "format_type": 1, "available": True, "guild_id": str(guild_id), "type": 2}
+                     for i in range(emojis // 10)],
+        "threads": [], "stage_instances": [], "guild_scheduled_events": [], "soundboard_sounds": []
+    }
+    voice_channel = str(snowflake())
+    payload["channels"].append({"id": voice_channel, "type": 2, "name": "Voice", "position": channels,
+                                "bitrate": 64000, "user_limit": 0, "permission_overwrites": []})
+    voice_users = [snowflake() for _ in range(voice)]
+    members = [member(SELF_ID, [])]
+    # What the gateway sends depends on the intents: voice states (and their members) only with
+    # the voice_states intent, all other members only when chunked
+    if intents.voice_states:
+        payload["voice_states"] = [{"user_id": str(user_id), "channel_id": voice_channel, "session_id": "s",
+                                    "deaf": False, "mute": False, "self_deaf": False, "self_mute": False,
+                                    "self_video": False, "suppress": False} for user_id in voice_users]
+        members += [member(user_id, role_ids[:2]) for user_id in voice_users]
+    payload["members"] = members
+    return payload
+
+def message_payload(guild):
+    channel = guild.text_channels[snowflake() % len(guild.text_channels)]
+    author_id = snowflake()
+    return {"id": str(snowflake()), "channel_id": str(channel.id), "guild_id": str(guild.id), "type": 0,
+            "author": user(author_id), "member": {k: v for k, v in member(author_id, []).items() if k != "user"},
+            "content": "check this out https://www.youtube.com/watch?v=dQw4w9WgXcQ&si=abcdef123456 lol",
+            "timestamp": "2024-01-01T00:00:00+00:00", "edited_timestamp": None, "tts": False,
+            "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [], "embeds": [],
+            "pinned": False, "flags": 0}
+
+client = discord.Client(**options)
+state = client._connection
+SELF_ID = snowflake()
+state.user = discord.ClientUser(state=state, data=user(SELF_ID) | {"bot": True})
+
+payloads = [guild_payload() for _ in range(guilds)]
+gc.collect()
+rss_before = rss_kib()
+if trace:
+    tracemalloc.start()
+for payload in payloads:
+    state._add_guild_from_data(payload)
+gc.collect()
+guild_bytes = tracemalloc.get_traced_memory()[0]
+for guild in list(client.guilds):
+    if guild.text_channels:
+        for _ in range(messages):
+            state.parse_message_create(message_payload(guild))
+gc.collect()
+total_bytes = tracemalloc.get_traced_memory()[0]
+tracemalloc.stop()
+del payloads
+gc.collect()
+
+print(json.dumps({
+    "guild_bytes": guild_bytes,
+    "message_bytes": total_bytes - guild_bytes,
+    "rss_kib": rss_kib() - rss_before,
+    "members": sum(len(guild._members) for guild in client.guilds),
+    "emojis": len(client.emojis),
+    "messages_cached": len(state._messages or ()),
+}))
+"""
+
+
+def run_child(profile: str, args, trace: bool) -> dict:
+    params = [profile, args.guilds, args.channels, args.roles, args.emojis, args.voice,
+              args.messages_per_guild, args.message_cache_size, trace]
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD, json.dumps(params)],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{profile} run failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_profile(profile: str, args) -> dict:
+    result = run_child(profile, args, trace=True)
+    result["rss_kib"] = run_child(profile, args, trace=False)["rss_kib"]
+    return result
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Measure discord.py cache memory per server for each gateway profile.")
+    parser.add_argument("--guilds", type=int, default=1000, help="Servers to simulate")
+    parser.add_argument("--channels", type=int, default=30, help="Text channels per server")
+    parser.add_argument("--roles", type=int, default=20, help="Roles per server")
+    parser.add_argument("--emojis", type=int, default=50, help="Custom emojis per server (a tenth as many stickers)")
+    parser.add_argument("--voice", type=int, default=5, help="Members in voice per server")
+    parser.add_argument("--messages-per-guild", type=int, default=5, help="Messages posted per server")
+    parser.add_argument("--message-cache-size", type=int, default=1000,
+                        help="message_cache_size of the default profile")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    results = {profile: run_profile(profile, args) for profile in PROFILES}
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return 0
+
+    print(f"{args.guilds} servers, {args.channels} channels, {args.roles} roles, {args.emojis} emojis, "
+          f"{args.voice} in voice and {args.messages_per_guild} messages each")
+    print(f"{'profile':<12}{'KiB/server':>12}{'messages MiB':>14}{'RSS MiB':>10}{'members':>10}{'emojis':>10}{'cached msgs':>13}")
+    for profile, result in results.items():
+        print(
+            f"{profile:<12}{result['guild_bytes'] / args.guilds / 1024:>12.1f}"
+            f"{result['message_bytes'] / 2**20:>14.1f}{result['rss_kib'] / 1024:>10.1f}"
+            f"{result['members']:>10}{result['emojis']:>10}{result['messages_cached']:>13}"
+        )
+    default_total = results["default"]["guild_bytes"] + results["default"]["message_bytes"]
+    low_total = results["low_memory"]["guild_bytes"] + results["low_memory"]["message_bytes"]
+    if default_total:
+        print(f"low_memory uses {1 - low_total / default_total:.0%} less traced memory than default")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,518 @@
+# End-to-end load test of the bot's message handling against a local stand-in for Discord's HTTP API.
+# No Discord token needed, nothing is sent to Discord.
+#
+# Usage:
+#   python benchmarks/bench_replay.py                                        2000 synthetic messages at 200/s
+#   python benchmarks/bench_replay.py --rate 500 --guilds 1 --channels 1     A raid on one channel
+#   python benchmarks/bench_replay.py messages.jsonl --rate 50               Replay recorded messages
+#   python benchmarks/bench_replay.py --latency-ms 300 --rate-limit-share 0.1   Slow Discord that often answers 429
+#   python benchmarks/bench_replay.py --repost-mode webhook --queue-size 50  Try repost settings
+#   python benchmarks/bench_replay.py --short-links 0.2                     Expand short links in a fifth of the messages
+#
+# main.py runs in this process with its own config.json, trackers.json and guilds.db in a temporary
+# folder (LINK_CLEANER_APP_FOLDER); the real trackers.json and rules.snapshot are copied there, the
+# originals are never written. discord.py's API base URL points at a fake Discord server in a child
+# process, which answers sends, deletes, edits and webhook calls after a configurable latency, enforces
+# Discord's per-channel send limit and answers a share of requests with 429. With --short-links the fake
+# server is also every shortener host the bot's UrlExpander knows, redirecting through one or two hops
+# to a link with trackers or answering 404. Messages are handed to the bot the way the gateway delivers
+# them, at a fixed rate. Reported are the time from a message arriving to its repost completing, event
+# loop lag, peak memory, what the fake server was asked to do and how many short links were expanded.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_FOLDER = os.path.dirname(BENCH_DIR)
+
+API_PREFIX = "/api/v10"
+SHORTENER_PREFIX = "/_short"
+SHORT_LINK_TARGET = "https://example.com/article/"
+BOT_ID = 10**17 + 1
+TOKEN = "replay"
+
+#--------------------------------------------------------------------
+# Fake Discord
+#--------------------------------------------------------------------
+
+
+def user_payload(user_id: int, bot: bool = False) -> dict:
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0",
+            "global_name": None if bot else f"User {user_id}", "avatar": None, "bot": bot}
+
+
+def message_payload(message_id: int, channel_id: int, guild_id, author: dict, content: str) -> dict:
+    payload = {"id": str(message_id), "channel_id": str(channel_id), "type": 0,
+               "author": author, "content": content, "timestamp": "2024-01-01T00:00:00+00:00",
+               "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [],
+               "mention_roles": [], "attachments": [], "embeds": [], "pinned": False, "flags": 0}
+    if guild_id is not None:
+        payload["guild_id"] = str(guild_id)
+    return payload
+
+
+def json_response(data, status: int = 200, headers: dict = None):
+    """JSON response with the bare content type discord.py expects (aiohttp's json_response adds a charset)."""
+    from aiohttp import web
+    return web.Response(body=json.dumps(data).encode(), status=status,
+                        headers={"Content-Type": "application/json", **(headers or {})})
+
+
+class FakeDiscord:
+    """
+    Just enough of Discord's HTTP API for the bot's repost path.
+
+    Every call waits latency ± jitter before answering. Sends to a channel
+    beyond channel_limit per channel_window seconds get a 429 with the time
+    left in the window, like Discord's per-channel limit, and a further
+    rate_limit_share of all calls get a 429 with retry_after.
+
+    Short links go through SHORTENER_PREFIX: /r<n> redirects to another
+    shortener's /t<n>, which redirects to SHORT_LINK_TARGET with trackers,
+    anything else is a 404.
+    """
+
+    def __init__(self, args):
+        self.latency = args.latency_ms / 1000
+        self.jitter = args.jitter_ms / 1000
+        self.rate_limit_share = args.rate_limit_share
+        self.retry_after = args.retry_after
+        self.channel_limit = args.channel_limit
+        self.channel_window = args.channel_window
+        self.rng = random.Random(args.seed)
+        self.next_id = 10**18
+        self.windows = {}   # channel id -> [window start, sends]
+        self.webhooks = {}  # channel id -> webhook payload
+        self.requests = {}  # call -> count
+        self.rate_limited = 0
+
+    def snowflake(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+    def too_many(self, retry_after: float):
+        self.rate_limited += 1
+        # discord.py only retries 429s that came through Discord's proxy, which sets Via
+        return json_response(
+            {"message": "You are being rate limited.", "retry_after": round(retry_after, 3), "global": False},
+            status=429, headers={"Via": "1.1 google"}
+        )
+
+    def send_limit(self, channel_id: int):
+        """Return the retry_after of a send over the channel's limit, or None."""
+        if not self.channel_limit:
+            return None
+        now = time.monotonic()
+        window = self.windows.get(channel_id)
+        if window is None or now - window[0] >= self.channel_window:
+            window = self.windows[channel_id] = [now, 0]
+        if window[1] >= self.channel_limit:
+            return self.channel_window - (now - window[0])
+        window[1] += 1
+        return None
+
+    async def answer(self, call: str, channel_id: int, respond, is_send: bool = False):
+        self.requests[call] = self.requests.get(call, 0) + 1
+        await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+        if self.rate_limit_share and self.rng.random() < self.rate_limit_share:
+            return self.too_many(self.retry_after)
+        if is_send:
+            retry_after = self.send_limit(channel_id)
+            if retry_after is not None:
+                return self.too_many(retry_after)
+        return await respond()
+
+    def app(self):
+        from aiohttp import web
+        routes = web.RouteTableDef()
+        bot_user = user_payload(BOT_ID, bot=True)
+
+        @routes.get(API_PREFIX + "/users/@me")
+        async def me(request):
+            return json_response(bot_user)
+
+        @routes.get(API_PREFIX + "/oauth2/applications/@me")
+        async def application(request):
+            return json_response({
+                "id": str(BOT_ID), "name": "Link Cleaner", "icon": None, "description": "",
+                "bot_public": True, "bot_require_code_grant": False, "owner": user_payload(BOT_ID + 1),
+                "verify_key": "0" * 64, "flags": 0
+            })
+
+        @routes.post(API_PREFIX + "/channels/{channel_id}/messages")
+        async def send(request):
+            channel_id = int(request.match_info["channel_id"])
+            body = await request.json()
+
+            async def respond():
+                guild_id = (body.get("message_reference") or {}).get("guild_id")
+                return json_response(message_payload(
+                    self.snowflake(), channel_id, guild_id, bot_user, body.get("content") or ""))
+            return await self.answer("send", channel_id, respond, is_send=True)
+
+        @routes.patch(API_PREFIX + "/channels/{channel_id}/messages/{message_id}")
+        async def edit(request):
+            channel_id = int(request.match_info["channel_id"])
+            body = await request.json()
+
+            async def respond():
+                return json_response(message_payload(
+                    int(request.match_info["message_id"]), channel_id, None, bot_user, body.get("content") or ""))
+            return await self.answer("edit", channel_id, respond)
+
+        @routes.delete(API_PREFIX + "/channels/{channel_id}/messages/{message_id}")
+        async def delete(request):
+            async def respond():
+                return web.Response(status=204)
+            return await self.answer("delete", int(request.match_info["channel_id"]), respond)
+
+        @routes.get(API_PREFIX + "/channels/{channel_id}/webhooks")
+        async def list_webhooks(request):
+            channel_id = int(request.match_info["channel_id"])
+
+            async def respond():
+                webhook = self.webhooks.get(channel_id)
+                return json_response([webhook] if webhook else [])
+            return await self.answer("list_webhooks", channel_id, respond)
+
+        @routes.post(API_PREFIX + "/channels/{channel_id}/webhooks")
+        async def create_webhook(request):
+            channel_id = int(request.match_info["channel_id"])
+            body = await request.json()
+
+            async def respond():
+                webhook = self.webhooks[channel_id] = {
+                    "id": str(self.snowflake()), "type": 1, "channel_id": str(channel_id),
+                    "name": body.get("name"), "token": "webhook-token", "user": bot_user, "avatar": None
+                }
+                return json_response(webhook)
+            return await self.answer("create_webhook", channel_id, respond)
+
+        @routes.post(API_PREFIX + "/webhooks/{webhook_id}/{webhook_token}")
+        async def execute_webhook(request):
+            webhook_id = request.match_info["webhook_id"]
+            channel_id = next((int(c) for c, w in self.webhooks.items() if w["id"] == webhook_id), 0)
+            body = await request.json()
+
+            async def respond():
+                if request.query.get("wait") != "true":
+                    return web.Response(status=204)
+                return json_response(message_payload(
+                    self.snowflake(), channel_id, None, user_payload(int(webhook_id), bot=True), body.get("content") or ""))
+            return await self.answer("webhook_send", channel_id, respond, is_send=True)
+
+        @routes.head(SHORTENER_PREFIX + "/{code}")
+        async def shortener(request):
+            code = request.match_info["code"]
+            self.requests["shortener"] = self.requests.get("shortener", 0) + 1
+            await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+            if code[:1] == "r" and code[1:].isdigit():
+                location = f"https://tinyurl.com/t{code[1:]}"
+            elif code[:1] == "t" and code[1:].isdigit():
+                location = f"{SHORT_LINK_TARGET}{code[1:]}?utm_source=replay&utm_medium=social&id={code[1:]}"
+            else:
+                return web.Response(status=404)
+            return web.Response(status=301, headers={"Location": location})
+
+        @routes.get("/_stats")
+        async def stats(request):
+            return json_response({"requests": self.requests, "rate_limited": self.rate_limited})
+
+        app = web.Application(client_max_size=2**20)
+        app.add_routes(routes)
+        return app
+
+
+async def serve_fake_discord(args) -> None:
+    """Run the fake server until stdin closes, after printing {"port": N} on stdout."""
+    from aiohttp import web
+    runner = web.AppRunner(FakeDiscord(args).app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    print(json.dumps({"port": port}), flush=True)
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+    await runner.cleanup()
+
+#--------------------------------------------------------------------
+# Replay
+#--------------------------------------------------------------------
+
+
+def prepare_app_folder(args) -> str:
+    """Create the bot's temporary folder with the replay settings."""
+    folder = tempfile.mkdtemp(prefix="link-cleaner-replay-")
+    trackers = args.trackers or os.path.join(APP_FOLDER, 'trackers.json')
+    if os.path.isfile(trackers):
+        shutil.copy(trackers, os.path.join(folder, 'trackers.json'))
+    snapshot = os.path.join(APP_FOLDER, 'rules.snapshot')
+    if os.path.isfile(snapshot) and not args.trackers:
+        shutil.copy(snapshot, os.path.join(folder, 'rules.snapshot'))
+
+    config = {
+        "bot_token": TOKEN,
+        "repost_mode": args.repost_mode,
+        "log_level": "WARNING",
+        "metrics_port": 0
+    }
+    if args.short_links:
+        config["expand_shorteners"] = True
+    for key in ("repost_queue_size", "repost_max_inflight", "repost_overflow_policy"):
+        value = getattr(args, key.replace("repost_", ""))
+        if value is not None:
+            config[key] = value
+    with open(os.path.join(folder, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=4)
+    return folder
+
+
+def load_stream(args, folder: str) -> list:
+    """Return the messages to replay as (content, channel key) pairs."""
+    if args.input:
+        stream = []
+        with open(args.input, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                content = record.get(args.field) if isinstance(record, dict) else None
+                if isinstance(content, str):
+                    stream.append((content, record.get("channel_id")))
+                if len(stream) >= args.messages:
+                    break
+        return stream
+
+    sys.path.insert(0, BENCH_DIR)
+    import bench_core
+    import core
+    bench_core.STATE = core.load_state(app_folder=folder)
+    return [(content, None) for content in bench_core.generate_corpus(args.messages, args.seed)]
+
+
+def guild_payload(guild_id: int, channel_ids: list) -> dict:
+    return {
+        "id": str(guild_id), "name": f"Server {guild_id}", "owner_id": str(BOT_ID + 1), "member_count": 1000,
+        "features": [], "emojis": [], "stickers": [], "threads": [],
+        "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "8", "position": 0,
+                   "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+        "channels": [{"id": str(channel_id), "type": 0, "name": f"channel-{i}", "position": i,
+                      "permission_overwrites": []} for i, channel_id in enumerate(channel_ids)],
+        "members": [{"user": user_payload(BOT_ID, bot=True), "roles": [], "joined_at": "2024-01-01T00:00:00+00:00",
+                     "deaf": False, "mute": False, "flags": 0}]
+    }
+
+
+def memory_kib(field: str) -> int:
+    """Read VmRSS (current) or VmHWM (peak) RSS of this process, in KiB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # Not Linux: ru_maxrss is the peak, in KiB on Linux but bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def percentiles(values: list) -> dict:
+    ordered = sorted(values)
+    if not ordered:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    pick = lambda pct: ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+    return {"p50": pick(50), "p90": pick(90), "p99": pick(99), "max": ordered[-1]}
+
+
+async def replay(args, main, stream: list) -> dict:
+    import aiohttp
+    import discord
+
+    fake = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), "--serve-fake-discord", *sys.argv[1:],
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+    )
+    port = json.loads(await fake.stdout.readline())["port"]
+    base = f"http://127.0.0.1:{port}"
+    discord.http.Route.BASE = base + API_PREFIX
+    main.url_expander = main.UrlExpander(
+        host_overrides={host: base + SHORTENER_PREFIX for host in main.SHORTENER_HOSTS})
+
+    bot = main.bot
+    await bot.login(TOKEN)
+    state = bot._connection
+    rng = random.Random(args.seed)
+    channels = []  # (guild id, channel id)
+    next_id = BOT_ID + 1000
+    for _ in range(args.guilds):
+        guild_id = next_id = next_id + 1
+        channel_ids = list(range(next_id + 1, next_id + 1 + args.channels))
+        next_id += args.channels
+        state._add_guild_from_data(guild_payload(guild_id, channel_ids))
+        channels += [(guild_id, channel_id) for channel_id in channel_ids]
+
+    # Completed reposts are timed where the scheduler finishes them
+    arrived = {}   # message id -> perf_counter() when handed to the bot
+    latencies = []
+    short_links = {"messages": 0, "resolvable": 0, "expanded": 0}
+    process_repost = main.process_repost
+
+    async def timed_process_repost(message, companies, sanitized_message):
+        await process_repost(message, companies, sanitized_message)
+        latencies.append(time.perf_counter() - arrived.pop(message.id))
+        if SHORT_LINK_TARGET in sanitized_message and "utm_medium=social" not in sanitized_message:
+            short_links["expanded"] += 1
+    main.process_repost = timed_process_repost
+
+    lag_samples = []
+    lag_task = asyncio.create_task(main.measure_loop_lag(lag_samples))
+    rss_start = memory_kib("VmRSS")
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    for i, (content, channel_key) in enumerate(stream):
+        if args.rate:
+            await asyncio.sleep(max(0.0, started + i / args.rate - loop.time()))
+        elif i % 100 == 0:
+            await asyncio.sleep(0)
+        if channel_key is None:
+            guild_id, channel_id = channels[rng.randrange(len(channels))]
+        else:
+            guild_id, channel_id = channels[zlib.crc32(str(channel_key).encode()) % len(channels)]
+        if args.short_links and rng.random() < args.short_links:
+            # Half go straight to the target, some take two hops, some don't resolve
+            kind = rng.choices("tr4", weights=(5, 4, 1))[0]
+            content += f" https://bit.ly/{kind}{rng.randrange(100)}"
+            short_links["messages"] += 1
+            short_links["resolvable"] += kind != "4"
+        message_id = next_id = next_id + 1
+        author = user_payload(BOT_ID + 10 + rng.randrange(1000))
+        arrived[message_id] = time.perf_counter()
+        state.parse_message_create(message_payload(message_id, channel_id, guild_id, author, content))
+    fed = loop.time() - started
+
+    # Wait for queued reposts, but not forever: a raid with a slow Discord may leave some behind
+    deadline = loop.time() + args.drain_timeout
+    idle_checks = 0
+    while loop.time() < deadline and idle_checks < 3:
+        await asyncio.sleep(0.1)
+        stats = main.repost_scheduler.stats()
+        idle_checks = idle_checks + 1 if not stats["queued"] and not stats["inflight"] else 0
+    elapsed = loop.time() - started
+    lag_task.cancel()
+    main.process_repost = process_repost
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(base + "/_stats") as response:
+            fake_stats = await response.json()
+    fake.stdin.close()
+    await fake.wait()
+    await bot.close()
+
+    scheduler = main.repost_scheduler.stats()
+    return {
+        "messages": len(stream),
+        "feed_seconds": fed,
+        "elapsed_seconds": elapsed,
+        "reposts": len(latencies),
+        "dropped": scheduler["dropped"],
+        "deleted_only": scheduler["deleted_only"],
+        "still_queued": scheduler["queued"] + scheduler["inflight"],
+        "latency_ms": {key: value * 1000 for key, value in percentiles(latencies).items()},
+        "loop_lag_ms": {key: value * 1000 for key, value in percentiles(lag_samples).items()},
+        "rss_start_mib": rss_start / 1024,
+        "peak_rss_mib": memory_kib("VmHWM") / 1024,
+        "short_links": short_links,
+        "discord": fake_stats
+    }
+
+
+def print_report(result: dict, args) -> None:
+    rate = result["messages"] / result["feed_seconds"] if result["feed_seconds"] else 0.0
+    print(f"Messages: {result['messages']:,} in {result['feed_seconds']:.1f}s ({rate:,.0f}/s), "
+          f"{args.guilds} server(s) x {args.channels} channel(s), repost_mode {args.repost_mode}")
+    print(f"Reposts: {result['reposts']:,} completed, {result['dropped']:,} dropped, "
+          f"{result['deleted_only']:,} deleted without repost, {result['still_queued']:,} still queued "
+          f"after {result['elapsed_seconds']:.1f}s")
+    for name, key in (("Message to repost", "latency_ms"), ("Event loop lag", "loop_lag_ms")):
+        values = result[key]
+        print(f"{name + ':':<19}p50 {values['p50']:9.1f} ms   p90 {values['p90']:9.1f} ms   "
+              f"p99 {values['p99']:9.1f} ms   max {values['max']:9.1f} ms")
+    print(f"Memory: {result['rss_start_mib']:.1f} MiB RSS before the replay, {result['peak_rss_mib']:.1f} MiB peak")
+    calls = ", ".join(f"{call} {count:,}" for call, count in sorted(result["discord"]["requests"].items()))
+    print(f"Discord calls: {calls or 'none'}; {result['discord']['rate_limited']:,} answered with 429")
+    if args.short_links:
+        short_links = result["short_links"]
+        print(f"Short links: {short_links['messages']:,} messages with one, {short_links['resolvable']:,} resolvable, "
+              f"{short_links['expanded']:,} reposted with the cleaned target, "
+              f"{result['discord']['requests'].get('shortener', 0):,} shortener lookups")
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Replay messages through the bot against a fake Discord API.")
+    parser.add_argument("input", nargs="?", help="JSONL file of recorded messages (default: synthetic messages)")
+    parser.add_argument("--field", default="content", help="Message field of JSONL records")
+    parser.add_argument("--messages", type=int, default=2000, help="Messages to replay (at most, for files)")
+    parser.add_argument("--rate", type=float, default=200.0, help="Messages per second, 0 for as fast as possible")
+    parser.add_argument("--guilds", type=int, default=10, help="Servers the messages are spread over")
+    parser.add_argument("--channels", type=int, default=5, help="Channels per server")
+    parser.add_argument("--seed", type=int, default=1234, help="Random seed, so runs are comparable")
+    parser.add_argument("--trackers", help="Use this trackers.json instead of the configured one")
+    parser.add_argument("--repost-mode", choices=("reply", "webhook", "edit"), default="reply")
+    parser.add_argument("--queue-size", type=int, help="repost_queue_size (default: the bot's default)")
+    parser.add_argument("--max-inflight", type=int, help="repost_max_inflight (default: the bot's default)")
+    parser.add_argument("--overflow-policy", choices=("drop_oldest", "delete_only"),
+                        help="repost_overflow_policy (default: the bot's default)")
+    parser.add_argument("--latency-ms", type=float, default=80.0, help="Fake Discord response time")
+    parser.add_argument("--jitter-ms", type=float, default=40.0, help="Response time varies by up to this much")
+    parser.add_argument("--rate-limit-share", type=float, default=0.0, help="Share of calls answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry_after of those 429s, in seconds")
+    parser.add_argument("--channel-limit", type=int, default=5, help="Sends allowed per channel per window, 0 for no limit")
+    parser.add_argument("--channel-window", type=float, default=5.0, help="Per-channel send window, in seconds")
+    parser.add_argument("--short-links", type=float, default=0.0,
+                        help="Share of messages given a short link for the bot to expand")
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="Seconds to wait for queued reposts after the last message")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--serve-fake-discord", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_fake_discord:
+        asyncio.run(serve_fake_discord(args))
+        return 0
+
+    folder = prepare_app_folder(args)
+    try:
+        os.environ["LINK_CLEANER_APP_FOLDER"] = folder
+        sys.path.insert(0, APP_FOLDER)
+        # main.py logs to the sys.stdout it finds at import; send that to stderr to keep the report readable
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        try:
+            import main
+        finally:
+            sys.stdout = stdout
+        stream = load_stream(args, folder)
+        if not stream:
+            parser.error("no messages to replay")
+        result = asyncio.run(replay(args, main, stream))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(result, indent=4))
+    else:
+        print_report(result, args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
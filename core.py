@@ -0,0 +1,1222 @@
+# The message cleaning core: the URL scanner, the tracker rules and clean_url(), without Discord.
+#
+# Standard library only, and importing it has no side effects: no files are read or written and
+# no rules are compiled until something asks for them. main.py builds the bot on top of it;
+# batch_clean.py, import_rules.py and the benchmarks use it directly.
+#
+# Usage:
+#   import core
+#   state = core.load_state()   # trackers.json, config.json and rules.snapshot, read-only
+#   cleaned, results = state.clean_message("see https://example.com/?utm_source=x")
+
+import fnmatch
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+from types import MappingProxyType
+from urllib.parse import urlparse, parse_qsl, unquote_plus
+# hashlib, pickle and tempfile are only needed for rule snapshots and are imported where
+# they are used; importing them here would double the time `import core` takes
+
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+log = logging.getLogger("link_cleaner.core")
+
+DEFAULT_REGEX_KEYS = "(?i)\\b((?:https?://|www\\.)[^\\s<>\"']+|(?:[a-z0-9-]+\\.)+[a-z]{2,}(?:/[^\\s<>\"']*)?)\\b"
+DEFAULT_CLEAN_CACHE_SIZE = 4096
+
+DEFAULT_TRACKERS = {
+    "Google": ["utm_*", "gclid", "gclsrc", "dclid", "wbraid", "gbraid", "gad_source"],
+    "Meta": ["fbclid", "fb_action_ids", "fb_action_types", "fb_source", "fb_ref", "fb_ad_id", "fb_adset_id", "fb_campaign_id", "igsh"],
+    "TikTok": ["ttclid", "tt_*"],
+    "Microsoft": ["msclkid", "li_fat_id", "li_source", "li_medium", "li_campaign"],
+    "Twitter": ["twclid", "ref_src", "s@twitter.com", "t@twitter.com", "s@x.com", "t@x.com", "tw_campaign", "tw_source"],
+    "Reddit": ["rdt_cid", "rdt_source", "rdt_medium", "rdt_campaign"],
+    "Snapchat": ["sc_cid", "sc_source", "sc_medium", "sc_campaign"],
+    "Pinterest": ["epik", "pin_campaign", "pin_source"],
+    "Amazon": ["tag@amazon.*", "ascsubtag", "asc_source", "creative", "creativeASIN", "linkCode", "th@amazon.*"],
+    "Mailchimp": ["mc_cid", "mc_eid"],
+    "HubSpot": ["hsa_*"],
+    "Adobe": ["s_cid", "ef_id"],
+    "Salesforce": ["pi_*"],
+    "Shopify": ["shopify", "shopify_app", "shopify_email", "shopify_utm"],
+    "Email": ["mkt_tok", "_hsenc", "_hsmi", "trk", "trkCampaign", "campaign", "source"],
+    "Affiliate": ["aff_id", "affiliate_id", "ref", "ref_id", "referrer", "partner", "partner_id", "click_id", "clickid", "cid", "subid", "sub_id"],
+    "Analytics": ["_ga", "_gl", "_gac", "_gid", "yclid", "rb_clickid", "vero_id", "vero_conv", "oly_anon_id", "oly_enc_id", "appSharePlatform"]
+}
+
+#--------------------------------------------------------------------
+# Tracker Rules
+#--------------------------------------------------------------------
+
+PATTERN_CHARS = "*?["
+REGEX_RULE_PREFIX = "re:"
+
+def is_pattern_rule(rule: str) -> bool:
+    """Whether a tracker entry is a glob or regex rule rather than an exact name."""
+    return rule.startswith(REGEX_RULE_PREFIX) or any(c in rule for c in PATTERN_CHARS)
+
+def rule_error(rule: str):
+    """Return why a tracker entry can't be compiled, or None if it can."""
+    param = split_host_scope(rule)[0]
+    if not param.startswith(REGEX_RULE_PREFIX):
+        return None
+    try:
+        re.compile(param[len(REGEX_RULE_PREFIX):], re.IGNORECASE)
+    except re.error as e:
+        return str(e)
+    return None
+
+REGEX_META = ".^$*+?{}[]|()\\"
+LITERAL_KINDS = {(False, False): "exact", (False, True): "prefix", (True, False): "suffix", (True, True): "infix"}
+
+def _scan_regex(pattern: str):
+    """Yield (index, char, depth) for the regex syntax characters outside escapes and [classes]."""
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if ch == "[":
+            # A ']' right after '[' or '[^' is part of the class
+            i += 2 if pattern[i + 1:i + 2] == "^" else 1
+            i += 1 if pattern[i:i + 1] == "]" else 0
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            i += 1
+            continue
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        yield i, ch, depth
+        i += 1
+
+def _literal_run(pattern: str) -> tuple:
+    """Return the literal characters a regex starts with and the index after them."""
+    chars = []
+    starts = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\" and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            chars.append(pattern[i + 1])
+            step = 2
+        elif ch not in REGEX_META:
+            chars.append(ch)
+            step = 1
+        else:
+            break
+        starts.append(i)
+        i += step
+    if i < len(pattern) and pattern[i] in "*+?{" and chars:
+        # The last character is quantified, so it isn't required
+        chars.pop()
+        i = starts.pop()
+    return "".join(chars), i
+
+def _regex_literal(pattern: str):
+    """
+    Find the literal a `re:` rule's pattern requires of the keys it matches.
+    
+    Understands patterns made of a literal with optional `^`, `$` and `.*`
+    around it, including the `.*(?:...).*` wrapping import_rules.py gives
+    adblock regexes. See rule_literal() for the result.
+    """
+    body, any_start, any_end = pattern, False, False
+    if pattern.startswith(".*(?:") and pattern.endswith(").*"):
+        closing = next((i for i, ch, depth in _scan_regex(pattern) if ch == ")" and depth == 0), None)
+        if closing == len(pattern) - 3:
+            body, any_start, any_end = pattern[5:-3], True, True
+    if any(ch == "|" and depth == 0 for _, ch, depth in _scan_regex(body)):
+        return None
+    if body.startswith("^"):
+        body, any_start = body[1:], False
+    elif body.startswith(".*"):
+        body, any_start = body[2:], True
+    if body.endswith("$") and not body[:-1].endswith("\\"):
+        body, any_end = body[:-1], False
+    elif body.endswith(".*") and not body[:-2].endswith("\\"):
+        body, any_end = body[:-2], True
+    literal, end = _literal_run(body)
+    if not literal:
+        return None
+    if end == len(body):
+        return LITERAL_KINDS[(any_start, any_end)], literal
+    return ("contains" if any_start else "starts"), literal
+
+def rule_literal(rule: str):
+    """
+    Find the literal part of a tracker entry (without its host scope).
+    
+    Returns:
+        tuple: (kind, literal) where kind is "exact", "prefix", "suffix" or
+            "infix" when the entry matches exactly the keys that are, start
+            with, end with or contain the literal, "starts" or "contains"
+            when the keys it matches start with or contain the literal but
+            the entry is more than that, or None when no literal is required
+    """
+    if rule.startswith(REGEX_RULE_PREFIX):
+        return _regex_literal(rule[len(REGEX_RULE_PREFIX):])
+    if not is_pattern_rule(rule):
+        return "exact", rule
+    inner = rule[1 if rule.startswith("*") else 0:-1 if rule.endswith("*") else None]
+    if inner and not is_pattern_rule(inner):
+        return LITERAL_KINDS[(rule.startswith("*"), rule.endswith("*"))], inner
+    literal = rule[:min(rule.index(c) for c in PATTERN_CHARS if c in rule)]
+    return ("starts", literal) if literal else None
+
+def _embeddable(pattern: str, compiled) -> bool:
+    """Whether a regex rule keeps its meaning inside the combined `(?P<_ruleN>...)` alternation."""
+    if compiled.groups:
+        return False  # Group numbers and names would clash with the other rules
+    try:
+        re.compile(f"(?P<_rule0>{pattern})")
+    except re.error:
+        return False  # e.g. global flags like (?i) are only allowed at the very start
+    return True
+
+class RegexGroup:
+    """
+    Regex rules sharing a literal prefix, compiled on first use.
+    
+    Rules are folded into one `(?P<_ruleN>...)` alternation like
+    ParamMatcher's combined regex; standalone ones are tried after it.
+    """
+
+    __slots__ = ("patterns", "owners", "standalone", "_regex", "_standalone")
+
+    def __init__(self, patterns: list, owners: list, standalone: list):
+        """
+        Args:
+            patterns: Embeddable patterns
+            owners: Provider of each pattern
+            standalone: (pattern, provider) pairs that can't be embedded
+        """
+        self.patterns = patterns
+        self.owners = owners
+        self.standalone = standalone
+        self._regex = None
+        self._standalone = None
+
+    def match(self, key: str):
+        """Return the provider of the first rule that matches the whole key, or None."""
+        if self._standalone is None:
+            if self.patterns:
+                self._regex = re.compile("|".join(
+                    f"(?P<_rule{i}>{pattern})" for i, pattern in enumerate(self.patterns)), re.IGNORECASE)
+            self._standalone = [(re.compile(pattern, re.IGNORECASE), provider) for pattern, provider in self.standalone]
+        if self._regex is not None:
+            match = self._regex.fullmatch(key)
+            if match:
+                return self.owners[int(match.lastgroup[len("_rule"):])]
+        for regex, provider in self._standalone:
+            if regex.fullmatch(key):
+                return provider
+        return None
+
+class ParamMatcher:
+    """
+    Compiled tracker rules: exact names, globs and regexes.
+    
+    Exact names are a single dict lookup. Rules that are only a literal
+    prefix, suffix or substring (`utm_*`, `*_id`, `re:^utm_.*`, adblock
+    `/^utm_/`) are stored in character tries, so matching them walks at
+    most the length of the key, however many rules there are. Other globs
+    and regexes that start with a literal (`hsa_?`, `re:rx_[a-z]+`) are
+    grouped under that literal in another trie and only tried on keys that
+    start with it. The rest are folded into one combined regex that is only
+    tried when nothing cheaper matched. Regexes that would change meaning
+    inside it (global flags, groups, backreferences) are tried one by one
+    after it.
+    """
+
+    def __init__(self, rules):
+        """
+        Args:
+            rules: Iterable of (rule, provider) pairs, rules as written in trackers.json
+        """
+        self.exact = {}
+        self.prefixes = {}
+        self.suffixes = {}
+        self.infixes = {}
+        self.prefixed = {}  # Trie of literal prefixes -> RegexGroup of the rules starting with it
+        self.regex = None
+        self.regex_owners = []
+        self.standalone = []  # (compiled regex, provider)
+
+        regex_parts = []
+        grouped = {}  # literal prefix -> ([patterns], [providers], [standalone (pattern, provider)])
+        for rule, provider in rules:
+            if rule.startswith(REGEX_RULE_PREFIX):
+                pattern = rule[len(REGEX_RULE_PREFIX):]
+                try:
+                    compiled = re.compile(pattern, re.IGNORECASE)
+                except re.error as e:
+                    log.warning("Skipping invalid tracker regex '%s': %s", pattern, e)
+                    continue
+            else:
+                pattern = compiled = None
+            literal = rule_literal(rule)
+            kind, chars = literal if literal is not None else (None, "")
+            chars = chars.lower()
+            if kind == "exact":
+                self.exact[chars] = provider
+            elif kind == "prefix":
+                self._insert(self.prefixes, chars, provider)
+            elif kind == "suffix":
+                self._insert(self.suffixes, chars[::-1], provider)
+            elif kind == "infix":
+                self._insert(self.infixes, chars, provider)
+            elif kind == "starts":
+                patterns, owners, standalone = grouped.setdefault(chars, ([], [], []))
+                if compiled is not None and not _embeddable(pattern, compiled):
+                    standalone.append((pattern, provider))
+                else:
+                    patterns.append(pattern if pattern is not None else fnmatch.translate(rule))
+                    owners.append(provider)
+            elif compiled is not None and not _embeddable(pattern, compiled):
+                self.standalone.append((compiled, provider))
+            else:
+                regex_parts.append(f"(?P<_rule{len(self.regex_owners)}>{pattern or fnmatch.translate(rule)})")
+                self.regex_owners.append(provider)
+
+        for chars, (patterns, owners, standalone) in grouped.items():
+            self._insert(self.prefixed, chars, RegexGroup(patterns, owners, standalone))
+        if regex_parts:
+            self.regex = re.compile("|".join(regex_parts), re.IGNORECASE)
+
+    @staticmethod
+    def _insert(trie: dict, chars: str, provider: str) -> None:
+        node = trie
+        for ch in chars:
+            node = node.setdefault(ch, {})
+        node[""] = provider  # "" never collides with a single character
+
+    @staticmethod
+    def _walk(trie: dict, chars):
+        node = trie
+        if "" in node:
+            return node[""]
+        for ch in chars:
+            node = node.get(ch)
+            if node is None:
+                return None
+            if "" in node:
+                return node[""]
+        return None
+
+    @staticmethod
+    def _walk_all(trie: dict, chars):
+        """Yield the values of every node on the path, shortest prefix first."""
+        node = trie
+        if "" in node:
+            yield node[""]
+        for ch in chars:
+            node = node.get(ch)
+            if node is None:
+                return
+            if "" in node:
+                yield node[""]
+
+    def match(self, key: str):
+        """Return the provider whose rule matches a query key, or None."""
+        lower = key.lower()
+        provider = self.exact.get(lower)
+        if provider is not None:
+            return provider
+        if self.prefixes:
+            provider = self._walk(self.prefixes, lower)
+            if provider is not None:
+                return provider
+        if self.suffixes:
+            provider = self._walk(self.suffixes, reversed(lower))
+            if provider is not None:
+                return provider
+        if self.infixes:
+            for start in range(len(lower)):
+                provider = self._walk(self.infixes, lower[start:])
+                if provider is not None:
+                    return provider
+        if self.prefixed:
+            for group in self._walk_all(self.prefixed, lower):
+                provider = group.match(key)
+                if provider is not None:
+                    return provider
+        if self.regex is not None:
+            match = self.regex.fullmatch(key)
+            if match:
+                return self.regex_owners[int(match.lastgroup[len("_rule"):])]
+        for regex, provider in self.standalone:
+            if regex.fullmatch(key):
+                return provider
+        return None
+
+    def to_state(self) -> tuple:
+        """Return the compiled matcher as plain data, for the rules snapshot."""
+        pattern = self.regex.pattern if self.regex is not None else None
+        standalone = [(regex.pattern, provider) for regex, provider in self.standalone]
+        prefixed = []  # (literal prefix, patterns, providers, standalone)
+        stack = [("", self.prefixed)]
+        while stack:
+            chars, node = stack.pop()
+            for ch, child in node.items():
+                if ch:
+                    stack.append((chars + ch, child))
+                else:
+                    prefixed.append((chars, child.patterns, child.owners, child.standalone))
+        return (self.exact, self.prefixes, self.suffixes, self.infixes, prefixed, pattern, self.regex_owners, standalone)
+
+    @classmethod
+    def from_state(cls, state: tuple) -> "ParamMatcher":
+        """Rebuild a matcher from to_state() without parsing or validating its rules again."""
+        matcher = cls.__new__(cls)
+        (matcher.exact, matcher.prefixes, matcher.suffixes, matcher.infixes, prefixed,
+         pattern, matcher.regex_owners, standalone) = state
+        matcher.prefixed = {}
+        for chars, patterns, owners, group_standalone in prefixed:
+            cls._insert(matcher.prefixed, chars, RegexGroup(patterns, owners, group_standalone))
+        matcher.regex = re.compile(pattern, re.IGNORECASE) if pattern is not None else None
+        matcher.standalone = [(re.compile(p, re.IGNORECASE), provider) for p, provider in standalone]
+        return matcher
+
+HOST_SCOPE_RE = re.compile(r"^(?:(?:[a-z0-9-]+\.)+[a-z0-9-]+|[a-z0-9-]+\.\*)$", re.IGNORECASE)
+
+def split_host_scope(rule: str):
+    """
+    Split a `param@host` tracker entry into its parts.
+    
+    Returns:
+        tuple: (param rule, lowercased host) or (rule, None) for global rules
+    """
+    param, sep, host = rule.rpartition("@")
+    if sep and param and HOST_SCOPE_RE.match(host):
+        return param, host.lower()
+    return rule, None
+
+def url_host(parsed) -> str:
+    """Return the lowercased host of a parsed URL, including scheme-less ones like www.example.com/page."""
+    if parsed.netloc:
+        return (parsed.hostname or "").rstrip(".")
+    if not parsed.scheme:
+        return parsed.path.split("/", 1)[0].split(":", 1)[0].lower().rstrip(".")
+    return ""
+
+class TrackerRules:
+    """
+    Global tracker rules plus host-scoped rules indexed by domain.
+    
+    `param@example.com` only applies to example.com and its subdomains, and
+    `param@example.*` to any host with an `example` label followed by at
+    least one more label (example.de, www.example.co.uk). Finding the rule
+    sets for a host is one dict lookup per label, however many domains
+    have rules of their own.
+    """
+
+    def __init__(self, rules):
+        """
+        Args:
+            rules: Iterable of (rule, provider) pairs, rules as written in trackers.json
+        """
+        global_rules = []
+        by_domain = {}
+        by_label = {}
+        for rule, provider in rules:
+            param, host = split_host_scope(rule)
+            if host is None:
+                global_rules.append((rule, provider))
+            elif host.endswith(".*"):
+                by_label.setdefault(host[:-2], []).append((param, provider))
+            else:
+                by_domain.setdefault(host, []).append((param, provider))
+
+        self.global_matcher = ParamMatcher(global_rules)
+        self.by_domain = {domain: ParamMatcher(scoped) for domain, scoped in by_domain.items()}
+        self.by_label = {label: ParamMatcher(scoped) for label, scoped in by_label.items()}
+        self._global_only = (self.global_matcher,)
+
+    def for_host(self, host: str) -> tuple:
+        """Return the matchers that apply to a host, host-specific ones first."""
+        if not host or not (self.by_domain or self.by_label):
+            return self._global_only
+
+        labels = host.split(".")
+        matchers = []
+        suffix = ""
+        last = len(labels) - 1
+        for i in range(last, -1, -1):
+            label = labels[i]
+            suffix = f"{label}.{suffix}" if suffix else label
+            matcher = self.by_domain.get(suffix)
+            if matcher is not None:
+                matchers.append(matcher)
+            if i < last:
+                matcher = self.by_label.get(label)
+                if matcher is not None:
+                    matchers.append(matcher)
+        if not matchers:
+            return self._global_only
+        matchers.append(self.global_matcher)
+        return tuple(matchers)
+
+    def match(self, key: str, host: str = None):
+        """Return the provider whose rule matches a query key on a host, or None."""
+        for matcher in self.for_host(host):
+            provider = matcher.match(key)
+            if provider is not None:
+                return provider
+        return None
+
+    def to_state(self) -> dict:
+        """Return the compiled rules as plain data, for the rules snapshot."""
+        return {
+            "global": self.global_matcher.to_state(),
+            "by_domain": {domain: matcher.to_state() for domain, matcher in self.by_domain.items()},
+            "by_label": {label: matcher.to_state() for label, matcher in self.by_label.items()}
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "TrackerRules":
+        """Rebuild compiled rules from to_state()."""
+        rules = cls.__new__(cls)
+        rules.global_matcher = ParamMatcher.from_state(state["global"])
+        rules.by_domain = {domain: ParamMatcher.from_state(s) for domain, s in state["by_domain"].items()}
+        rules.by_label = {label: ParamMatcher.from_state(s) for label, s in state["by_label"].items()}
+        rules._global_only = (rules.global_matcher,)
+        return rules
+
+class TrackerSnapshot:
+    """Immutable view of the tracker index and compiled rules at one registry version."""
+
+    __slots__ = ("version", "index", "rules")
+
+    def __init__(self, version: int, index: dict, rules: TrackerRules):
+        self.version = version
+        self.index = MappingProxyType(index)
+        self.rules = rules
+
+def compile_snapshot(version: int, index: dict, rules: list) -> TrackerSnapshot:
+    """Compile the rules from TrackerRegistry.snapshot_inputs(); safe to run in another thread."""
+    return TrackerSnapshot(version, index, TrackerRules(rules))
+
+class TrackerRegistry:
+    """
+    Owns the provider -> params and param -> provider maps.
+    
+    add(), remove() and lookup() are O(1) dict operations, so admin edits
+    never rebuild the whole index. The message hot path doesn't read the
+    registry; it reads the immutable TrackerSnapshot returned by snapshot(),
+    which is copied at most once per registry version, or compiled elsewhere
+    with snapshot_inputs() and compile_snapshot().
+    
+    Rules imported from filter lists (see import_rules.py) sit underneath
+    the trackers.json entries: they are matched and can be disabled per
+    server, but admin commands and trackers.json only ever show and edit
+    the hand-kept list, which wins when both have the same param.
+    """
+
+    def __init__(self, tracker_map: dict = None, imported=()):
+        """
+        Args:
+            tracker_map: Provider -> list of params, as stored in trackers.json
+            imported: (param, provider) pairs imported from filter lists
+        """
+        self._providers = {}  # provider -> {param.lower(): param}
+        self._index = {}      # param.lower() -> provider
+        self._imported = {}   # param.lower() -> (param, provider)
+        self.version = 0
+        self._snapshot = None
+        for param, provider in imported:
+            self._imported.setdefault(param.lower(), (param, provider))
+        for provider, params in (tracker_map or {}).items():
+            entries = self._providers.setdefault(provider, {})
+            for param in params:
+                entries[param.lower()] = param
+                self._index[param.lower()] = provider
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def imported_count(self) -> int:
+        return len(self._imported)
+
+    def lookup(self, param: str, imported: bool = True):
+        """Return the provider owning a param (case-insensitive), or None; with imported=False only trackers.json counts."""
+        lower = param.lower()
+        provider = self._index.get(lower)
+        if provider is None and imported and lower in self._imported:
+            provider = self._imported[lower][1]
+        return provider
+
+    def has_provider(self, provider: str) -> bool:
+        return provider in self._providers
+
+    def providers(self):
+        """Iterate over (provider, [params]) pairs."""
+        for provider, entries in self._providers.items():
+            yield provider, list(entries.values())
+
+    def add(self, provider: str, param: str) -> None:
+        """Add a param to a provider, creating the provider if needed."""
+        lower = param.lower()
+        self._providers.setdefault(provider, {})[lower] = param
+        self._index[lower] = provider
+        self.version += 1
+
+    def remove(self, provider: str, param: str):
+        """
+        Remove a param from a provider. Providers left empty are dropped.
+        
+        Returns:
+            str: The removed param as it was stored, or None if not found
+        """
+        entries = self._providers.get(provider)
+        if entries is None:
+            return None
+        lower = param.lower()
+        removed = entries.pop(lower, None)
+        if removed is None:
+            return None
+        if self._index.get(lower) == provider:
+            del self._index[lower]
+        if not entries:
+            del self._providers[provider]
+        self.version += 1
+        return removed
+
+    def snapshot(self) -> TrackerSnapshot:
+        """Return the immutable index for the current version."""
+        if self._snapshot is None or self._snapshot.version != self.version:
+            self._snapshot = compile_snapshot(*self.snapshot_inputs())
+        return self._snapshot
+
+    def snapshot_inputs(self) -> tuple:
+        """
+        Copy what the next snapshot is compiled from.
+        
+        Compiling the rules is the slow part, so the bot copies these on the
+        event loop and passes them to compile_snapshot() in an executor, where
+        later edits can't change them midway.
+        
+        Returns:
+            tuple: (version, param index, rules)
+        """
+        index = {lower: provider for lower, (_, provider) in self._imported.items()}
+        index.update(self._index)
+        return self.version, index, self.rules()
+
+    def publish_snapshot(self, snapshot: TrackerSnapshot) -> bool:
+        """
+        Use a snapshot compiled from snapshot_inputs().
+        
+        Returns:
+            bool: False, and the snapshot is dropped, if the registry was edited since
+        """
+        if snapshot.version != self.version:
+            return False
+        self._snapshot = snapshot
+        return True
+
+    def adopt_snapshot(self, index: dict, rules: TrackerRules) -> None:
+        """Use an index and rules compiled earlier for this exact registry content."""
+        self._snapshot = TrackerSnapshot(self.version, index, rules)
+
+    def rules(self) -> list:
+        """Return every rule as a (param, provider) pair, params as written, imported ones included."""
+        rules = [rule for lower, rule in self._imported.items() if lower not in self._index]
+        rules.extend((self._providers[provider][lower], provider) for lower, provider in self._index.items())
+        return rules
+
+    def imported_rules(self) -> list:
+        """Return the imported rules as (param, provider) pairs."""
+        return list(self._imported.values())
+
+    def to_dict(self) -> dict:
+        """Return the trackers.json representation."""
+        return {provider: params for provider, params in self.providers()}
+
+    def fingerprint(self) -> str:
+        """Hash of the hand-kept rules, to tell whether a compiled snapshot still matches them."""
+        rules = sorted((self._providers[provider][lower], provider) for lower, provider in self._index.items())
+        text = json.dumps(rules)
+        import hashlib
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def write_file_atomic(filepath: str, data: bytes) -> int:
+    """
+    Atomically replace a file with new contents.
+    
+    The data is written to a temporary file in the same directory, synced to
+    disk and renamed over the target, so a crash mid-write never leaves a
+    truncated file behind.
+    
+    Returns:
+        int: Modification time of the written file in nanoseconds
+    """
+    import tempfile
+    directory = os.path.dirname(filepath) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(filepath)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return os.stat(filepath).st_mtime_ns
+
+# Bumped whenever the layout of rules.snapshot or of the compiled rules changes
+RULES_SNAPSHOT_FORMAT = 3
+
+def load_rules_snapshot(filepath: str):
+    """
+    Read the imported rules snapshot written by import_rules.py.
+    
+    Returns:
+        dict: The snapshot, or None if there is none or it can't be used
+    """
+    import pickle
+    try:
+        with open(filepath, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning("Could not read %s, imported rules are not used: %s", filepath, e)
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("format") != RULES_SNAPSHOT_FORMAT:
+        log.warning("%s was written by another version, run import_rules.py again to use imported rules", filepath)
+        return None
+    return snapshot
+
+def compile_rules_snapshot(registry: TrackerRegistry, sources: list) -> tuple:
+    """
+    Compile a registry into a rules snapshot.
+    
+    The snapshot holds the imported rules themselves, so it can be compiled
+    again after trackers.json changes, and the compiled index, host rules
+    and key filter as plain dicts and pattern strings, so loading it skips
+    parsing, validating and sorting tens of thousands of rules.
+    
+    Args:
+        registry: Registry holding trackers.json and the imported rules
+        sources: Descriptions of the imported filter lists, for display
+    
+    Returns:
+        tuple: (snapshot dict, compiled key filter)
+    """
+    compiled = registry.snapshot()
+    key_filter = build_key_filter(compiled.index)
+    snapshot = {
+        "format": RULES_SNAPSHOT_FORMAT,
+        "fingerprint": registry.fingerprint(),
+        "sources": sources,
+        "imported": registry.imported_rules(),
+        "index": dict(compiled.index),
+        "rules": compiled.rules.to_state(),
+        "key_filter": key_filter.pattern if key_filter is not None else None
+    }
+    return snapshot, key_filter
+
+def save_rules_snapshot(snapshot: dict, filepath: str) -> int:
+    """Atomically write a rules snapshot, returning its mtime in nanoseconds."""
+    import pickle
+    return write_file_atomic(filepath, pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+
+def build_registry(tracker_map: dict, snapshot, snapshot_path: str = None) -> tuple:
+    """
+    Build the tracker registry and key filter, reusing a rules snapshot when it matches.
+    
+    A snapshot compiled against a different trackers.json is compiled again,
+    and rewritten if snapshot_path is given, so only the first start after
+    an edit pays for it.
+    
+    Args:
+        tracker_map: Provider -> list of params, as stored in trackers.json
+        snapshot: Result of load_rules_snapshot(), or None
+        snapshot_path: Where to save a recompiled snapshot (None to never write)
+    
+    Returns:
+        tuple: (TrackerRegistry, key filter for LinkScanner)
+    """
+    if snapshot is None:
+        registry = TrackerRegistry(tracker_map)
+        return registry, build_key_filter(registry.snapshot().index)
+
+    registry = TrackerRegistry(tracker_map, snapshot["imported"])
+    if snapshot["fingerprint"] == registry.fingerprint():
+        registry.adopt_snapshot(snapshot["index"], TrackerRules.from_state(snapshot["rules"]))
+        pattern = snapshot["key_filter"]
+        return registry, re.compile(pattern, re.IGNORECASE) if pattern is not None else None
+
+    fresh, key_filter = compile_rules_snapshot(registry, snapshot["sources"])
+    snapshot.update(fresh)
+    if snapshot_path is not None:
+        try:
+            save_rules_snapshot(snapshot, snapshot_path)
+        except OSError as e:
+            log.warning("Could not update %s: %s", snapshot_path, e)
+    return registry, key_filter
+
+#--------------------------------------------------------------------
+# Scanning and Cleaning
+#--------------------------------------------------------------------
+
+# Redirect wrappers: host -> (provider, path or None for any path, parameters holding the target).
+# "name.*" hosts match any TLD, like tracker host scopes.
+REDIRECT_RULES = {
+    "google.*": ("Google", "/url", ("q", "url")),
+    "youtube.com": ("YouTube", "/redirect", ("q",)),
+    "l.facebook.com": ("Meta", "/l.php", ("u",)),
+    "lm.facebook.com": ("Meta", "/l.php", ("u",)),
+    "l.messenger.com": ("Meta", "/l.php", ("u",)),
+    "l.instagram.com": ("Meta", "/", ("u",)),
+    "linkedin.com": ("LinkedIn", "/redir/redirect", ("url",)),
+    "out.reddit.com": ("Reddit", None, ("url",)),
+    "steamcommunity.com": ("Steam", "/linkfilter", ("url", "u")),
+    "away.vk.com": ("VK", "/away.php", ("to",)),
+    "t.umblr.com": ("Tumblr", "/redirect", ("z",)),
+    "slack-redir.net": ("Slack", "/link", ("url",)),
+    "click.linksynergy.com": ("Rakuten", None, ("murl",)),
+    "go.redirectingat.com": ("Skimlinks", None, ("url",)),
+}
+REDIRECT_MAX_DEPTH = 5
+# Substrings that let a message past the scanner's key filter, wrapped trackers are usually percent-encoded
+REDIRECT_MARKERS = tuple(host[:-1] if host.endswith(".*") else host + "/" for host in REDIRECT_RULES)
+
+def has_redirect_marker(message: str) -> bool:
+    """Whether a message may contain a link through a redirect wrapper."""
+    for marker in REDIRECT_MARKERS:
+        if marker in message:
+            return True
+    return False
+
+def redirect_rule(host: str):
+    """Return the REDIRECT_RULES entry for a host, or None."""
+    if host.startswith("www."):
+        host = host[4:]
+    rule = REDIRECT_RULES.get(host)
+    if rule is None and "." in host:
+        rule = REDIRECT_RULES.get(host.split(".", 1)[0] + ".*")
+    return rule
+
+def url_path(parsed) -> str:
+    """Return the path of a parsed URL, including scheme-less ones like google.com/url."""
+    if parsed.netloc or parsed.scheme:
+        return parsed.path
+    return "/" + parsed.path.split("/", 1)[1] if "/" in parsed.path else "/"
+
+def unwrap_redirect(url: str) -> tuple:
+    """
+    Follow redirect wrappers such as google.com/url?q=... without any network access.
+    
+    Nested wrappers are unwrapped up to REDIRECT_MAX_DEPTH levels. Only
+    absolute http(s) targets are followed.
+    
+    Returns:
+        tuple: (target URL, providers of the wrappers that were removed)
+    """
+    providers = []
+    for _ in range(REDIRECT_MAX_DEPTH):
+        parsed = urlparse(url)
+        rule = redirect_rule(url_host(parsed))
+        if rule is None:
+            break
+        provider, path, params = rule
+        if path is not None and url_path(parsed).rstrip("/") != path.rstrip("/"):
+            break
+        target = next((value for key, value in parse_qsl(parsed.query) if key in params), "")
+        if not target.lower().startswith(("http://", "https://")):
+            break
+        providers.append(provider)
+        url = target
+    return url, providers
+
+# Searching the filter costs about 6 us per 100 parts on a short message, so past this many it is
+# slower than scanning the URLs and matching their keys, which the tries keep cheap
+KEY_FILTER_MAX_PARTS = 300
+
+def _key_filter_regex(rule: str):
+    """
+    Return a `re:` rule without a literal part as a key filter alternative, or None.
+    
+    The filter searches messages rather than matching whole keys, so rules
+    that look at the end of the key or past it ($, \\Z, \\B, lookarounds)
+    can't be used.
+    """
+    if not rule.startswith(REGEX_RULE_PREFIX):
+        return None
+    pattern = rule[len(REGEX_RULE_PREFIX):]
+    if any(ch == "$" for _, ch, _ in _scan_regex(pattern)):
+        return None
+    if any(token in pattern for token in ("\\Z", "\\z", "\\B", "(?=", "(?!", "(?<")):
+        return None
+    try:
+        compiled = re.compile(pattern, re.IGNORECASE)
+    except re.error:
+        return None
+    return f"(?:{pattern})" if _embeddable(pattern, compiled) else None
+
+def build_key_filter(param_index):
+    """
+    Compile the scanner's reject filter for a tracker index.
+    
+    The filter is one alternation regex of every tracker key following a '?'
+    or '&', so checking a message is a single pass no matter how many
+    trackers are configured. Each rule contributes its literal part (see
+    rule_literal): names and prefixes as they are, suffixes and substrings
+    after any other key characters. Regex rules without a literal part, like
+    `re:[a-z]+id`, are added as they are when they also work inside a
+    search; the presence of any other rule disables the filter, and so do
+    more than KEY_FILTER_MAX_PARTS distinct parts (imported filter lists).
+    Host scopes are ignored here, the filter only looks at parameter names.
+    
+    Returns:
+        re.Pattern: The filter, or None if only the '?' check can be used
+    """
+    parts = set()
+    for rule in {split_host_scope(rule)[0] for rule in param_index}:
+        literal = rule_literal(rule)
+        if literal is None:
+            pattern = _key_filter_regex(rule)
+            if pattern is None:
+                return None
+            parts.add(pattern)
+            continue
+        kind, chars = literal
+        if kind in ("exact", "prefix", "starts"):
+            parts.add(re.escape(chars))
+        else:
+            parts.add(r"[^&=#\s]*" + re.escape(chars))
+        if len(parts) > KEY_FILTER_MAX_PARTS:
+            return None
+    if not parts:
+        return re.compile("(?!)")  # Nothing is tracked, reject everything
+    return re.compile("[?&](?:" + "|".join(sorted(parts, key=len, reverse=True)) + ")", re.IGNORECASE)
+
+class LinkScanner:
+    """
+    Single-pass scanner that finds the URLs in a message worth cleaning.
+
+    Messages are rejected before the URL regex runs when they contain no '?'
+    or when the key filter (see build_key_filter) finds no tracker key and
+    no redirect wrapper host.
+    """
+
+    def __init__(self, regex: re.Pattern, key_filter):
+        """
+        Build a scanner for a URL regex and tracker key filter.
+
+        Args:
+            regex: Compiled URL detection regex (regex_keys)
+            key_filter: Result of build_key_filter(), or None to only check for '?'
+        """
+        self.regex = regex
+        # Mirror re.findall: a single capture group is the URL itself
+        self.group = 1 if regex.groups == 1 else 0
+        self.key_filter = key_filter
+
+    def might_have_trackers(self, message: str) -> bool:
+        """Cheap pre-check; False means no URL in the message can carry a tracker."""
+        if '?' not in message:
+            return False
+        # Percent-encoded keys can't be matched literally, let those through
+        if self.key_filter is None or '%' in message:
+            return True
+        return self.key_filter.search(message) is not None or has_redirect_marker(message)
+
+    def scan(self, message: str) -> list:
+        """
+        Return the URLs in a message that have a query string to clean.
+
+        Args:
+            message: Raw message content
+
+        Returns:
+            list: URLs in order of appearance, empty if the message was rejected
+        """
+        return [message[start:end] for start, end in self.scan_spans(message)]
+
+    def scan_spans(self, message: str) -> list:
+        """Like scan(), but return (start, end) spans into the message instead of the URLs."""
+        if not self.might_have_trackers(message):
+            return []
+
+        spans = []
+        group = self.group
+        for match in self.regex.finditer(message):
+            start, end = match.span(group)
+            if start != end and '?' in message[start:end]:
+                spans.append((start, end))
+        return spans
+
+class CleanCache:
+    """
+    Size-bounded LRU cache of clean_url results keyed by the raw URL.
+
+    Results are cached whether or not trackers were found, so URLs that are
+    known to be clean skip parsing too. The cache must be cleared whenever
+    the tracker rules change, since cached results depend on them.
+    """
+
+    def __init__(self, max_size: int):
+        """
+        Args:
+            max_size: Maximum number of cached URLs (0 disables caching)
+        """
+        self.max_size = max(0, int(max_size))
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, url: str):
+        """Return the cached result for a URL, or None on a miss."""
+        result = self._entries.get(url)
+        if result is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(url)
+        self.hits += 1
+        return result
+
+    def put(self, url: str, result: dict) -> None:
+        """Cache a result, evicting the least recently used entries if full."""
+        if self.max_size == 0:
+            return
+        self._entries[url] = result
+        self._entries.move_to_end(url)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, max_size: int) -> None:
+        """Change the size bound, evicting entries if it shrank."""
+        self.max_size = max(0, int(max_size))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop all cached results (counters are kept)."""
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """Return current size and hit/miss/eviction counters."""
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+def clean_url(url: str, rules: TrackerRules, cache: CleanCache) -> dict:
+    """
+    Remove tracking parameters from a URL, through a result cache.
+    
+    Args:
+        url: URL to clean
+        rules: TrackerRules to apply
+        cache: CleanCache matching those rules
+    """
+    if '?' not in url:
+        # Nothing to strip without a query string, skip the parse entirely
+        return {
+            "clean_url": url,
+            "removed_trackers": {},
+            "message": "No trackers found"
+        }
+
+    result = cache.get(url)
+    if result is None:
+        result = _clean_url(url, rules)
+        cache.put(url, result)
+    return result
+
+def _clean_url(url: str, rules: TrackerRules) -> dict:
+    """
+    Remove the tracker parameters of one URL.
+    
+    Only the tracker key=value pieces are cut out of the query string;
+    everything else, including how the kept values are encoded and their
+    order, is left exactly as it was.
+    """
+    parsed = urlparse(url)
+    host = url_host(parsed)
+    removed = {}
+    if redirect_rule(host) is not None:
+        url, wrappers = unwrap_redirect(url)
+        for provider in wrappers:
+            removed.setdefault(provider, []).append("redirect")
+        if wrappers:
+            parsed = urlparse(url)
+            host = url_host(parsed)
+
+    fragment_start = url.find('#')
+    if fragment_start < 0:
+        fragment_start = len(url)
+    query_start = url.find('?', 0, fragment_start)
+
+    cleaned_url = url
+    if query_start >= 0:
+        kept = []
+        cut = False
+        matchers = rules.for_host(host)
+        for segment in url[query_start + 1:fragment_start].split('&'):
+            key = segment.partition('=')[0]
+            if '%' in key or '+' in key:
+                key = unquote_plus(key)
+            owner = None
+            for matcher in matchers:
+                owner = matcher.match(key)
+                if owner is not None:
+                    break
+            if owner:
+                removed.setdefault(owner, []).append(key)
+                cut = True
+            else:
+                kept.append(segment)
+        if cut:
+            query = "&".join(segment for segment in kept if segment)
+            cleaned_url = url[:query_start] + ("?" + query if query else "") + url[fragment_start:]
+
+    if removed:
+        message = f"Removed trackers from {', '.join(removed.keys())}"
+    else:
+        message = "No trackers found"
+
+    return {
+        "clean_url": cleaned_url,
+        "removed_trackers": removed,
+        "message": message
+    }
+
+def sanitize_message(content: str, replacements: list) -> str:
+    """
+    Replace spans of a message with their cleaned URLs in one pass.
+    
+    Args:
+        content: Original message content
+        replacements: (start, end, cleaned URL) tuples; overlapping spans
+            after the first are ignored
+    """
+    pieces = []
+    position = 0
+    for start, end, cleaned in sorted(replacements):
+        if start < position:
+            continue
+        pieces.append(content[position:start])
+        pieces.append(cleaned)
+        position = end
+    pieces.append(content[position:])
+    return "".join(pieces)
+
+def format_companies(companies):
+    """Return a nicely formatted string with commas and 'and' before the last item."""
+    companies = list(companies)  # ensure it's a list
+    if len(companies) == 0:
+        return ""
+    elif len(companies) == 1:
+        return companies[0]
+    else:
+        return ", ".join(companies[:-1]) + f", and {companies[-1]}"
+
+#--------------------------------------------------------------------
+# Cleaning State
+#--------------------------------------------------------------------
+
+class CleaningState:
+    """
+    Compiled tracker rules, URL scanner and result cache, ready to clean messages.
+    
+    The bot keeps these in main.py's globals and per-server GuildState
+    objects; this bundles them for batch jobs, benchmarks and tests.
+    """
+
+    def __init__(self, tracker_map: dict = None, regex: str = None, rules_snapshot: dict = None,
+                 cache_size: int = DEFAULT_CLEAN_CACHE_SIZE):
+        """
+        Args:
+            tracker_map: Provider -> list of params (defaults to DEFAULT_TRACKERS)
+            regex: URL detection regex, as in regex_keys (defaults to DEFAULT_REGEX_KEYS)
+            rules_snapshot: Imported rules from load_rules_snapshot(), or None
+            cache_size: Maximum number of cached clean_url() results
+        """
+        tracker_map = DEFAULT_TRACKERS if tracker_map is None else tracker_map
+        self.registry, key_filter = build_registry(tracker_map, rules_snapshot)
+        self.index = self.registry.snapshot().index
+        self.rules = self.registry.snapshot().rules
+        self.regex = re.compile(regex or DEFAULT_REGEX_KEYS)
+        self.scanner = LinkScanner(self.regex, key_filter)
+        self.cache = CleanCache(cache_size)
+
+    def clean_url(self, url: str) -> dict:
+        return clean_url(url, self.rules, self.cache)
+
+    def clean_message(self, content: str) -> tuple:
+        """
+        Remove the trackers from every link in a message.
+        
+        Returns:
+            tuple: (cleaned message or None if nothing changed, clean_url() results of the changed links)
+        """
+        replacements = []
+        results = []
+        for start, end in self.scanner.scan_spans(content):
+            result = self.clean_url(content[start:end])
+            if result["removed_trackers"]:
+                replacements.append((start, end, result["clean_url"]))
+                results.append(result)
+        if not replacements:
+            return None, results
+        return sanitize_message(content, replacements), results
+
+def read_json_file(filepath: str, default):
+    """Read a JSON file, or return a default if it doesn't exist. Never creates the file."""
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+def load_state(app_folder: str = None, tracker_map: dict = None, regex: str = None) -> CleaningState:
+    """
+    Build a CleaningState from the bot's files, without writing anything.
+    
+    Args:
+        app_folder: Folder holding config.json, trackers.json and rules.snapshot (defaults to this file's)
+        tracker_map: Use these trackers instead of trackers.json
+        regex: Use this URL regex instead of config.json's regex_keys
+    """
+    app_folder = app_folder or APP_FOLDER
+    config = read_json_file(os.path.join(app_folder, 'config.json'), {})
+    if tracker_map is None:
+        tracker_map = read_json_file(os.path.join(app_folder, 'trackers.json'), DEFAULT_TRACKERS)
+    snapshot_path = os.path.join(app_folder, 'rules.snapshot')
+    rules_snapshot = load_rules_snapshot(snapshot_path) if os.path.exists(snapshot_path) else None
+    return CleaningState(
+        tracker_map,
+        regex or config.get("regex_keys", DEFAULT_REGEX_KEYS),
+        rules_snapshot,
+        config.get("clean_cache_size", DEFAULT_CLEAN_CACHE_SIZE)
+    )
+
+_default_state = None
+
+def default_state() -> CleaningState:
+    """Return a CleaningState loaded from the bot's files on first use and shared afterwards."""
+    global _default_state
+    if _default_state is None:
+        _default_state = load_state()
+    return _default_state
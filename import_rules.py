@@ -0,0 +1,271 @@
+# Imports tracker rules from community filter lists into rules.snapshot, next to trackers.json.
+#
+# Usage:
+#   python3 import_rules.py --clearurls data.min.json                 ClearURLs provider rules
+#   python3 import_rules.py --adguard tracking.txt --provider AdGuard  AdGuard/uBlock $removeparam rules
+#   python3 import_rules.py --clearurls data.min.json --adguard a.txt --adguard b.txt
+#   python3 import_rules.py --clear                                    Drop all imported rules
+#
+# Every run replaces the previously imported rules with the lists given. Files are read
+# locally, download them first. A running bot picks up the new snapshot within a few seconds.
+# Imported rules never end up in trackers.json; entries there win over imported ones.
+
+import argparse
+import json
+import os
+import re
+import sys
+
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_FOLDER)
+
+import core  # noqa: E402
+
+TRACKERS_PATH = os.path.join(APP_FOLDER, 'trackers.json')
+RULES_SNAPSHOT_PATH = os.path.join(APP_FOLDER, 'rules.snapshot')
+
+# ClearURLs url patterns start with a scheme and an optional run of subdomains
+CLEARURLS_PREFIX_RE = re.compile(r"^\^?https\?:(?:\\/|/){2}(?:\(\?:\[a-z0-9-\]\+\\\.\)\*\??)?")
+CLEARURLS_TLD_GROUPS = (r"(?:\.[a-z]{2,}){1,}", r"(?:\.[a-z]{2,})+", r"\.[a-z]{2,}")
+LITERAL_RULE_RE = re.compile(r"^[A-Za-z0-9_.\-]+$")
+HOST_CHARS_RE = re.compile(r"^(?:[a-z0-9-]|\\\.)+", re.IGNORECASE)
+
+
+def _clearurls_host_scopes(url_pattern: str):
+    """
+    Reduce a ClearURLs urlPattern to host scopes, e.g. `amazon.*` or `twitter.com`.
+
+    Returns:
+        list: Host scopes, or None when the pattern is not a plain host match
+    """
+    rest = CLEARURLS_PREFIX_RE.sub("", url_pattern, count=1)
+    if rest == url_pattern:
+        return None
+
+    if rest.startswith("(?:"):
+        # (?:youtube\.com|youtu\.be) style alternation of hosts
+        end = rest.find(")")
+        hosts = rest[3:end].split("|") if end != -1 else []
+        scopes = [host.replace("\\.", ".") for host in hosts if HOST_CHARS_RE.fullmatch(host)]
+        return scopes if scopes and len(scopes) == len(hosts) else None
+
+    match = HOST_CHARS_RE.match(rest)
+    if not match:
+        return None
+    host = match.group(0).replace("\\.", ".").lower()
+    tail = rest[match.end():]
+    if "." not in host and tail.startswith(CLEARURLS_TLD_GROUPS):
+        return [f"{host}.*"]
+    if "." in host:
+        return [host]
+    return None
+
+
+def _rule_entry(rule: str):
+    """Turn a ClearURLs parameter regex into a trackers.json style entry, or None if invalid."""
+    if LITERAL_RULE_RE.match(rule):
+        return rule
+    try:
+        re.compile(rule)
+    except re.error:
+        return None
+    return core.REGEX_RULE_PREFIX + rule
+
+
+def parse_clearurls(data: dict) -> tuple:
+    """
+    Convert ClearURLs providers to (param, provider) rules.
+
+    Each provider's `rules` become tracker entries scoped to the hosts of its
+    urlPattern, `globalRules` apply everywhere. Referral marketing rules
+    (off by default in ClearURLs), raw path rules and exceptions have no
+    counterpart here and are left out.
+
+    Returns:
+        tuple: (rules, notes) where notes are human readable skip reasons
+    """
+    rules = []
+    notes = []
+    for name, provider in data.get("providers", {}).items():
+        if provider.get("completeProvider"):
+            continue
+        display = "ClearURLs" if name == "globalRules" else name[:1].upper() + name[1:]
+        if name == "globalRules":
+            scopes = [None]
+        else:
+            scopes = _clearurls_host_scopes(provider.get("urlPattern", ""))
+            if not scopes:
+                notes.append(f"{name}: urlPattern is not a plain host match, skipped")
+                continue
+        if provider.get("exceptions"):
+            notes.append(f"{name}: exceptions are not supported, rules apply to the whole host")
+
+        for rule in provider.get("rules", []):
+            entry = _rule_entry(rule)
+            if entry is None:
+                notes.append(f"{name}: invalid rule {rule!r} skipped")
+                continue
+            for scope in scopes:
+                rules.append((entry if scope is None else f"{entry}@{scope}", display))
+    return rules, notes
+
+
+def _split_options(options: str) -> list:
+    """Split an adblock option list on commas, keeping commas inside /regex/ values."""
+    parts = []
+    for part in re.split(r"(?<!\\),", options):
+        if parts and re.match(r"^(?:removeparam|queryprune)=/", parts[-1]) and not re.search(r"/i?$", parts[-1]):
+            parts[-1] += "," + part
+        else:
+            parts.append(part)
+    return parts
+
+
+def _adblock_hosts(pattern: str, options: dict):
+    """
+    Return the hosts a network rule applies to.
+
+    Returns:
+        list: Hosts, [None] for rules that apply everywhere, or None if they can't be expressed
+    """
+    match = re.match(r"^(?:\|\||\|https?://)([a-z0-9.-]+\.[a-z0-9-]+)(?:[\^/:*|]|$)", pattern, re.IGNORECASE)
+    if match:
+        return [match.group(1).lower()]
+    if pattern not in ("", "*", "|http*", "|https://"):
+        return None
+
+    domains = [domain for domain in options.get("domain", "").split("|") if domain]
+    if not domains:
+        return [None]
+    if any(domain.startswith("~") for domain in domains):
+        return None  # "Everywhere except" has no counterpart in host scopes
+    return [domain.lower() for domain in domains]
+
+
+def parse_adblock(lines, provider: str) -> tuple:
+    """
+    Convert AdGuard/uBlock Origin `$removeparam` network rules to (param, provider) rules.
+
+    `||example.com^$removeparam=x` and `$removeparam=x,domain=a.com|b.com`
+    become host scoped entries, `/regex/` values become `re:` rules.
+    Exception (`@@`), negated (`~x`) and bare `$removeparam` rules are left
+    out since they can't be expressed as tracker entries.
+
+    Returns:
+        tuple: (rules, notes) where notes are human readable skip reasons
+    """
+    rules = []
+    skipped = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith(("!", "[", "@@")) or "#" in line.split("$", 1)[0]:
+            continue
+        found = re.search(r"[$,](?:removeparam|queryprune)(?:=|$|,)", line)
+        if not found:
+            continue
+        dollar = line.rfind("$", 0, found.start() + 1)
+        options = {}
+        for option in _split_options(line[dollar + 1:]):
+            key, _, value = option.partition("=")
+            options[key.strip().lower()] = value
+
+        value = options.get("removeparam", options.get("queryprune", ""))
+        hosts = _adblock_hosts(line[:dollar], options)
+        if not value or value.startswith("~") or hosts is None:
+            skipped += 1
+            continue
+
+        if value.startswith("/") and re.search(r"/i?$", value) and len(value) > 2:
+            body = value[1:value.rindex("/")].replace("\\,", ",")
+            try:
+                re.compile(body)
+            except re.error:
+                skipped += 1
+                continue
+            # removeparam regexes search within the key, rules here must match the whole key
+            entry = f"{core.REGEX_RULE_PREFIX}.*(?:{body}).*"
+        elif LITERAL_RULE_RE.match(value):
+            entry = value
+        else:
+            entry = core.REGEX_RULE_PREFIX + re.escape(value)
+
+        for host in hosts:
+            rules.append((entry if host is None else f"{entry}@{host}", provider))
+
+    notes = [f"{provider}: {skipped} rules can't be expressed as tracker entries, skipped"] if skipped else []
+    return rules, notes
+
+
+def adblock_title(lines: list, default: str) -> str:
+    """Return the `! Title:` of a filter list, or a default."""
+    for line in lines[:50]:
+        if line.lower().startswith("! title:"):
+            return line.split(":", 1)[1].strip() or default
+    return default
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Import tracker rules from community filter lists.")
+    parser.add_argument("--clearurls", action="append", default=[], metavar="FILE",
+                        help="ClearURLs rules file (data.min.json)")
+    parser.add_argument("--adguard", action="append", default=[], metavar="FILE",
+                        help="AdGuard/uBlock Origin filter list with $removeparam rules")
+    parser.add_argument("--provider", help="Provider name for adblock rules (default: the list's title)")
+    parser.add_argument("--clear", action="store_true", help="Remove all imported rules")
+    parser.add_argument("--verbose", action="store_true", help="Print every skipped provider and rule")
+    args = parser.parse_args()
+
+    if args.clear:
+        try:
+            os.remove(RULES_SNAPSHOT_PATH)
+        except FileNotFoundError:
+            pass
+        print(f"Removed imported rules ({RULES_SNAPSHOT_PATH})")
+        return 0
+    if not (args.clearurls or args.adguard):
+        parser.error("give at least one --clearurls or --adguard file, or --clear")
+
+    imported = []
+    sources = []
+    notes = []
+    for path in args.clearurls:
+        with open(path, 'r', encoding='utf-8') as f:
+            rules, list_notes = parse_clearurls(json.load(f))
+        imported.extend(rules)
+        notes.extend(list_notes)
+        sources.append(f"ClearURLs {os.path.basename(path)}: {len(rules)} rules")
+    for path in args.adguard:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        provider = args.provider or adblock_title(lines, os.path.splitext(os.path.basename(path))[0])
+        rules, list_notes = parse_adblock(lines, provider)
+        imported.extend(rules)
+        notes.extend(list_notes)
+        sources.append(f"{provider} {os.path.basename(path)}: {len(rules)} rules")
+
+    registry = core.TrackerRegistry(core.read_json_file(TRACKERS_PATH, core.DEFAULT_TRACKERS), imported)
+    snapshot, key_filter = core.compile_rules_snapshot(registry, sources)
+    core.save_rules_snapshot(snapshot, RULES_SNAPSHOT_PATH)
+
+    # Names, prefixes, suffixes and substrings are trie lookups and regexes starting with a literal are
+    # only tried on keys starting with it; the rest are tried on every query key of every message
+    slow = [rule for rule, _ in imported
+            if (core.rule_literal(core.split_host_scope(rule)[0]) or ("contains",))[0] == "contains"]
+    if slow:
+        notes.append(f"{len(slow)} rules are regexes without a literal prefix and are tried on every query key, "
+                     f"e.g. {slow[0]}")
+    if key_filter is None:
+        notes.append("The scanner's key filter is off with these rules, every message with a '?' is parsed")
+
+    for note in notes if args.verbose else notes[:20]:
+        print(f"  {note}")
+    if len(notes) > 20 and not args.verbose:
+        print(f"  ... {len(notes) - 20} more, use --verbose to see them")
+    for source in sources:
+        print(source)
+    print(f"Imported {registry.imported_count} rules into {RULES_SNAPSHOT_PATH}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
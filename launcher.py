@@ -0,0 +1,122 @@
+# Runs the bot as several worker processes, each owning a contiguous range of shards.
+#
+# Usage:
+#   python3 launcher.py --workers 4                   Use Discord's recommended shard count
+#   python3 launcher.py --workers 4 --shard-count 16  Use a fixed shard count
+#
+# Only the first worker syncs slash commands. Admin changes made through any worker
+# are saved to config.json/trackers.json/guilds.db, which every worker watches for changes.
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+MAIN_PATH = os.path.join(APP_FOLDER, 'main.py')
+CONFIG_PATH = os.path.join(APP_FOLDER, 'config.json')
+GATEWAY_URL = "https://discord.com/api/v10/gateway/bot"
+RESTART_DELAY = 10
+
+
+def recommended_shard_count() -> int:
+    """
+    Ask Discord how many shards the bot should use.
+
+    Returns:
+        int: Recommended shard count
+    """
+    with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+        token = json.load(f).get("bot_token", "")
+    if not token:
+        raise RuntimeError("bot_token is not set in config.json")
+
+    request = urllib.request.Request(GATEWAY_URL, headers={
+        "Authorization": f"Bot {token}",
+        "User-Agent": "DiscordBot (https://github.com/StroepWafel/Discord-Link-Cleaner, 1.0)"
+    })
+    with urllib.request.urlopen(request, timeout=15) as response:
+        return int(json.load(response)["shards"])
+
+
+def split_shards(shard_count: int, workers: int) -> list:
+    """Split shard IDs into contiguous, evenly sized ranges, one per worker."""
+    workers = max(1, min(workers, shard_count))
+    ranges = []
+    start = 0
+    for index in range(workers):
+        size = shard_count // workers + (1 if index < shard_count % workers else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+def configured_metrics_port() -> int:
+    with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+        return int(json.load(f).get("metrics_port", 0) or 0)
+
+
+def start_worker(index: int, shard_ids: list, shard_count: int) -> subprocess.Popen:
+    env = dict(os.environ)
+    metrics_port = configured_metrics_port()
+    if metrics_port:
+        # Workers can't share a port, worker N serves metrics on metrics_port + N
+        env["LINK_CLEANER_METRICS_PORT"] = str(metrics_port + index)
+    env["LINK_CLEANER_SHARD_IDS"] = ",".join(str(shard) for shard in shard_ids)
+    env["LINK_CLEANER_SHARD_COUNT"] = str(shard_count)
+    env["LINK_CLEANER_SYNC_COMMANDS"] = "1" if index == 0 else "0"
+    print(f"Starting worker {index} with shards {shard_ids[0]}-{shard_ids[-1]} of {shard_count}")
+    return subprocess.Popen([sys.executable, MAIN_PATH], cwd=APP_FOLDER, env=env)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Run the bot as several sharded worker processes.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--shard-count", type=int, help="Total shard count (default: Discord's recommendation)")
+    args = parser.parse_args()
+
+    shard_count = args.shard_count or recommended_shard_count()
+    ranges = split_shards(shard_count, args.workers)
+    workers = [start_worker(index, shard_ids, shard_count) for index, shard_ids in enumerate(ranges)]
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    restart_at = {}
+    while not stopping:
+        time.sleep(1)
+        for index, process in enumerate(workers):
+            if process.poll() is None:
+                continue
+            # Restart crashed workers after a delay, like Restart=always in systemd
+            if index not in restart_at:
+                print(f"Worker {index} exited with code {process.returncode}, restarting in {RESTART_DELAY}s")
+                restart_at[index] = time.monotonic() + RESTART_DELAY
+            elif time.monotonic() >= restart_at[index]:
+                del restart_at[index]
+                workers[index] = start_worker(index, ranges[index], shard_count)
+
+    print("Stopping workers...")
+    for process in workers:
+        if process.poll() is None:
+            process.terminate()
+    for process in workers:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,181 @@
 # This bot requires the 'message_content' intent.
 
+import asyncio
+import atexit
+import cProfile
+import io
+import itertools
 import json
+import logging
+import logging.handlers
+import queue
+import threading
+import pstats
 import discord
 from discord import app_commands
 from discord.ext import commands
 import re
+from array import array
 from datetime import datetime
-from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from urllib.parse import urlparse, urlunparse, urljoin
 import os
 import sys
+import sqlite3
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+import aiohttp
+from aiohttp import web
+
+import core
+from core import (
+    ParamMatcher, TrackerRegistry, TrackerRules, LinkScanner, CleanCache,
+    build_key_filter, build_registry, compile_snapshot, load_rules_snapshot, rule_error, split_host_scope,
+    url_host, sanitize_message, format_companies, write_file_atomic
+)
+
+#--------------------------------------------------------------------
+# Logging
+#--------------------------------------------------------------------
+
+LOG_QUEUE_SIZE = 10000     # Records waiting for the writer thread; more are dropped, never waited for
+LOG_SAMPLE_WINDOW = 60.0   # Seconds over which identical records are counted
+LOG_SAMPLE_BURST = 5       # Identical records written per window, the rest are only counted
+LOG_SAMPLE_KEYS = 4096     # Distinct records tracked at once
+LOG_CONTEXT_FIELDS = ("guild_id", "channel_id", "message_id")
+LOG_TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+log = logging.getLogger("link_cleaner")
+
+class SamplingFilter(logging.Filter):
+    """
+    Rate-limit identical log records.
+    
+    Records are identical when they share logger, level, message template
+    and guild/channel, so a storm of errors in one misconfigured channel is
+    capped without hiding the same error elsewhere. The first
+    LOG_SAMPLE_BURST records of a window are let through and the rest
+    counted; the count is attached to the first record of the next window.
+    """
+
+    def __init__(self, window: float = LOG_SAMPLE_WINDOW, burst: int = LOG_SAMPLE_BURST,
+                 max_keys: int = LOG_SAMPLE_KEYS):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.max_keys = max_keys
+        self.suppressed = 0
+        self._windows = OrderedDict()  # key -> [window start, records, suppressed]
+        self._lock = threading.Lock()  # Executor threads log too
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (
+            record.name, record.levelno, record.msg,
+            getattr(record, "guild_id", None), getattr(record, "channel_id", None)
+        )
+        with self._lock:
+            entry = self._windows.get(key)
+            if entry is None or record.created - entry[0] >= self.window:
+                if entry is not None and entry[2]:
+                    record.suppressed = entry[2]
+                self._windows[key] = [record.created, 1, 0]
+                self._windows.move_to_end(key)
+                if len(self._windows) > self.max_keys:
+                    self._windows.popitem(last=False)
+                return True
+            entry[1] += 1
+            if entry[1] <= self.burst:
+                return True
+            entry[2] += 1
+            self.suppressed += 1
+            return False
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never waits: records that don't fit in the queue are counted and dropped."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The writer thread is in this process, so the record doesn't have to be
+        # made picklable; formatting it (and its traceback) is left to that thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class ContextFormatter(logging.Formatter):
+    """Text lines with the guild/channel context and suppression count appended as key=value pairs."""
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        line = super().formatMessage(record)
+        fields = [f"{name}={getattr(record, name)}" for name in LOG_CONTEXT_FIELDS if getattr(record, name, None) is not None]
+        if getattr(record, "suppressed", 0):
+            fields.append(f"suppressed={record.suppressed}")
+        return f"{line} {' '.join(fields)}" if fields else line
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log collectors."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for name in LOG_CONTEXT_FIELDS + ("suppressed",):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+LOG_FORMATTERS = {"text": ContextFormatter(LOG_TEXT_FORMAT), "json": JsonFormatter()}
+
+# Everything, discord.py included, logs through a queue; one thread does the actual writing
+log_queue = queue.Queue(LOG_QUEUE_SIZE)
+log_handler = NonBlockingQueueHandler(log_queue)
+log_sampler = SamplingFilter()
+log_handler.addFilter(log_sampler)
+log_output = logging.StreamHandler(sys.stdout)
+log_output.setFormatter(LOG_FORMATTERS["text"])
+log_listener = logging.handlers.QueueListener(log_queue, log_output)
+logging.getLogger().addHandler(log_handler)
+logging.getLogger().setLevel(logging.INFO)
+log_listener.start()
+atexit.register(log_listener.stop)  # Writes out what is still queued
+
+def configure_logging(level: str, output_format: str) -> None:
+    """Apply log_level and log_format from config.json."""
+    level_number = logging.getLevelName(str(level).upper())
+    if isinstance(level_number, int):
+        logging.getLogger().setLevel(level_number)
+    else:
+        log.warning("Unknown log_level %r, keeping %s", level, logging.getLevelName(logging.getLogger().level))
+    if output_format in LOG_FORMATTERS:
+        log_output.setFormatter(LOG_FORMATTERS[output_format])
+    else:
+        log.warning("Unknown log_format %r, use one of %s", output_format, ", ".join(LOG_FORMATTERS))
+
+def message_context(message) -> dict:
+    """Logging context of a Discord message, for extra=."""
+    return {
+        "guild_id": message.guild.id if message.guild is not None else None,
+        "channel_id": message.channel.id,
+        "message_id": message.id
+    }
+
+def channel_context(channel) -> dict:
+    """Logging context of a Discord channel, for extra=."""
+    guild = getattr(channel, "guild", None)
+    return {"guild_id": guild.id if guild is not None else None, "channel_id": channel.id}
 
 #--------------------------------------------------------------------
 # Setup
@@ -20,8 +187,13 @@ def get_app_folder() -> str:
     Determine the application folder path.
     
     Returns:
-        str: Path to the application directory (executable dir if frozen, script dir otherwise)
+        str: Path to the application directory (LINK_CLEANER_APP_FOLDER if set,
+            executable dir if frozen, script dir otherwise)
     """
+    # Lets several instances, or benchmarks/bench_replay.py, run from one copy of the code
+    if os.environ.get("LINK_CLEANER_APP_FOLDER"):
+        return os.path.abspath(os.environ["LINK_CLEANER_APP_FOLDER"])
+
     if getattr(sys, 'frozen', False):
         # When compiled with PyInstaller, return the directory containing the executable
         return os.path.dirname(sys.executable)
@@ -66,7 +238,7 @@ def ensure_file_exists(filepath: str, default_content) -> None:
     if not os.path.isfile(filepath):
         with open(filepath, 'w', encoding='utf-8') as f:
             json.dump(default_content, f, indent=4)
-        print(f"Created missing file: {filepath}")
+        log.info("Created missing file: %s", filepath)
 
 def ensure_json_valid(filepath: str, default_content: dict) -> None:
     """
@@ -87,7 +259,7 @@ def ensure_json_valid(filepath: str, default_content: dict) -> None:
                 # Reset to defaults if file is corrupted
                 with open(filepath, 'w', encoding='utf-8') as fw:
                     json.dump(default_content, fw, indent=4)
-                print(f"Invalid JSON in {filepath}. Resetting to default.")
+                log.warning("Invalid JSON in %s. Resetting to default.", filepath)
                 return
 
         modified = False
@@ -100,13 +272,13 @@ def ensure_json_valid(filepath: str, default_content: dict) -> None:
             else:
                 cleaned_data[key] = default_value
                 modified = True
-                print(f"Added missing key '{key}' to {filepath}")
+                log.info("Added missing key '%s' to %s", key, filepath)
 
         # Check for and remove extra keys
         extra_keys = set(data.keys()) - set(default_content.keys())
         if extra_keys:
             modified = True
-            print(f"Removing extra keys from {filepath}: {extra_keys}")
+            log.info("Removing extra keys from %s: %s", filepath, extra_keys)
 
         if modified:
             # Create a backup before making changes
@@ -114,64 +286,163 @@ def ensure_json_valid(filepath: str, default_content: dict) -> None:
             backup_path = f"{filepath}.backup_{timestamp}.json"
             with open(backup_path, 'w', encoding='utf-8') as backup_file:
                 json.dump(data, backup_file, indent=4)
-            print(f"Backed up original config file to {backup_path}")
+            log.info("Backed up original config file to %s", backup_path)
 
             # Write cleaned data
             with open(filepath, 'w', encoding='utf-8') as f:
                 json.dump(cleaned_data, f, indent=4)
-            print(f"Successfully cleaned and updated {filepath}")
+            log.info("Successfully cleaned and updated %s", filepath)
 
     except Exception as e:
-        print(f"Error validating JSON file {filepath}: {e}")
+        log.error("Error validating JSON file %s: %s", filepath, e)
+
+SAVE_DEBOUNCE_SECONDS = 1.0
+FILE_WATCH_INTERVAL = 5.0
+
+class JsonStore:
+    """
+    Authoritative in-memory copy of a JSON file with write-behind persistence.
+    
+    Changes are made to `data` directly and then announced with mark_dirty().
+    Writes within the debounce window are coalesced into one atomic write
+    that runs in the default executor, off the event loop. The mtime of the
+    last read or write is remembered so external edits can be detected with
+    a single stat() call.
+    """
+
+    def __init__(self, filepath: str, debounce: float = SAVE_DEBOUNCE_SECONDS):
+        self.filepath = filepath
+        self.debounce = debounce
+        self.data = {}
+        self.mtime_ns = None
+        self._dirty = False
+        self._flush_handle = None
+        self._flush_task = None
+
+    def _read(self):
+        # stat before reading, so a change that lands mid-read is seen again later
+        mtime_ns = os.stat(self.filepath).st_mtime_ns
+        with open(self.filepath, 'r', encoding="utf-8") as f:
+            return json.load(f), mtime_ns
+
+    def load(self) -> dict:
+        """Read the file synchronously. Only use this outside the event loop."""
+        self.data, self.mtime_ns = self._read()
+        return self.data
+
+    async def reload(self) -> dict:
+        """Read the file in an executor and replace the in-memory data."""
+        loop = asyncio.get_running_loop()
+        self.data, self.mtime_ns = await loop.run_in_executor(None, self._read)
+        return self.data
+
+    @property
+    def pending(self) -> bool:
+        """Whether there are changes that have not reached the disk yet."""
+        return self._dirty or (self._flush_task is not None and not self._flush_task.done())
+
+    def changed_on_disk(self) -> bool:
+        """Whether the file was modified by something other than this store."""
+        if self.pending:
+            return False
+        try:
+            return os.stat(self.filepath).st_mtime_ns != self.mtime_ns
+        except OSError:
+            return False
+
+    def mark_seen(self) -> None:
+        """Accept the current file on disk as known, e.g. after a failed reload."""
+        try:
+            self.mtime_ns = os.stat(self.filepath).st_mtime_ns
+        except OSError:
+            pass
+
+    def mark_dirty(self) -> None:
+        """Schedule the in-memory data to be written after the debounce window."""
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (startup or shutdown), just write now
+            self.flush_sync()
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.debounce, self._start_flush)
+
+    def _start_flush(self) -> None:
+        self._flush_handle = None
+        if self._flush_task is not None and not self._flush_task.done():
+            # Previous write still running, try again after another window
+            self._flush_handle = asyncio.get_running_loop().call_later(self.debounce, self._start_flush)
+            return
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self) -> None:
+        """Write pending changes now, in an executor."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        # Serialize on the loop so the snapshot can't change while it's written
+        text = json.dumps(self.data, indent=4)
+        loop = asyncio.get_running_loop()
+        try:
+            self.mtime_ns = await loop.run_in_executor(None, write_file_atomic, self.filepath, text.encode('utf-8'))
+        except OSError as e:
+            log.error("Failed to save %s: %s", self.filepath, e)
+            self.mark_dirty()
+
+    def flush_sync(self) -> None:
+        """Write pending changes now, blocking. Used when no event loop is running."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        self.mtime_ns = write_file_atomic(self.filepath, json.dumps(self.data, indent=4).encode('utf-8'))
 
 APP_FOLDER = get_app_folder()
 CONFIG_PATH = os.path.join(APP_FOLDER, 'config.json')
 TRACKERS_PATH = os.path.join(APP_FOLDER, 'trackers.json')
+GUILDS_DB_PATH = os.path.join(APP_FOLDER, 'guilds.db')
+RULES_SNAPSHOT_PATH = os.path.join(APP_FOLDER, 'rules.snapshot')
 
 default_config = {
     "bot_token": "",
     "mention_reply_author": True,
     "require_links": True,
-    "regex_keys": "(?i)\\b((?:https?://|www\\.)[^\\s<>\"']+|(?:[a-z0-9-]+\\.)+[a-z]{2,}(?:/[^\\s<>\"']*)?)\\b"
+    "clean_cache_size": 4096,
+    "repost_mode": "reply",
+    "repost_queue_size": 20,
+    "repost_max_inflight": 8,
+    "repost_overflow_policy": "drop_oldest",
+    "sharding": False,
+    "low_memory": False,
+    "message_cache_size": 1000,
+    "sweep_max_channels": 3,
+    "expand_shorteners": False,
+    "guild_cache_size": 1024,
+    "metrics_host": "127.0.0.1",
+    "metrics_port": 0,
+    "log_level": "INFO",
+    "log_format": "text",
+    "regex_keys": core.DEFAULT_REGEX_KEYS
 }
 
-default_trackers = {
-    "Google": ["utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content", "utm_id", "gclid", "gclsrc", "dclid", "wbraid", "gbraid", "gad_source"],
-    "Meta": ["fbclid", "fb_action_ids", "fb_action_types", "fb_source", "fb_ref", "fb_ad_id", "fb_adset_id", "fb_campaign_id", "igsh"],
-    "TikTok": ["ttclid", "tt_content_id", "tt_medium", "tt_campaign_id", "tt_ad_id", "tt_adset_id"],
-    "Microsoft": ["msclkid", "li_fat_id", "li_source", "li_medium", "li_campaign"],
-    "Twitter": ["twclid", "ref_src", "s", "t", "tw_campaign", "tw_source"],
-    "Reddit": ["rdt_cid", "rdt_source", "rdt_medium", "rdt_campaign"],
-    "Snapchat": ["sc_cid", "sc_source", "sc_medium", "sc_campaign"],
-    "Pinterest": ["epik", "pin_campaign", "pin_source"],
-    "Amazon": ["tag", "ascsubtag", "asc_source", "creative", "creativeASIN", "linkCode", "th"],
-    "Mailchimp": ["mc_cid", "mc_eid"],
-    "HubSpot": ["hsa_acc", "hsa_cam", "hsa_grp", "hsa_ad", "hsa_src", "hsa_net", "hsa_ver"],
-    "Adobe": ["s_cid", "ef_id"],
-    "Salesforce": ["pi_campaign_id", "pi_source", "pi_ad_id"],
-    "Shopify": ["shopify", "shopify_app", "shopify_email", "shopify_utm"],
-    "Email": ["mkt_tok", "_hsenc", "_hsmi", "trk", "trkCampaign", "campaign", "source"],
-    "Affiliate": ["aff_id", "affiliate_id", "ref", "ref_id", "referrer", "partner", "partner_id", "click_id", "clickid", "cid", "subid", "sub_id"],
-    "Analytics": ["_ga", "_gl", "_gac", "_gid", "yclid", "rb_clickid", "vero_id", "vero_conv", "oly_anon_id", "oly_enc_id", "appSharePlatform"]
-}
+default_trackers = core.DEFAULT_TRACKERS
 
 ensure_file_exists(CONFIG_PATH, default_config)
 ensure_json_valid(CONFIG_PATH, default_config)
 ensure_file_exists(TRACKERS_PATH, default_trackers)
 ensure_json_valid(TRACKERS_PATH, default_trackers)
 
-# Load initial config
-with open(CONFIG_PATH, 'r', encoding="utf-8") as f:
-    config = json.load(f)
-
-with open(TRACKERS_PATH, 'r', encoding="utf-8") as f:
-    trackers = json.load(f)
+# Load initial config, from here on the stores are the source of truth
+config_store = JsonStore(CONFIG_PATH)
+trackers_store = JsonStore(TRACKERS_PATH)
+config = config_store.load()
+trackers = trackers_store.load()
+configure_logging(config.get("log_level", default_config["log_level"]), config.get("log_format", default_config["log_format"]))
 
 bot_token = config.get("bot_token", default_config["bot_token"])
-mention_reply_author = config.get("mention_reply_author", default_config["mention_reply_author"])
-require_links = config.get("require_links", default_config["require_links"])
-
-PARAM_INDEX = {param.lower(): company for company, params in trackers.items() for param in params}
+clean_cache_size = config.get("clean_cache_size", default_config["clean_cache_size"])
+expand_shorteners = config.get("expand_shorteners", default_config["expand_shorteners"])
 
 try:
     REGEX = re.compile(
@@ -181,162 +452,1926 @@ except re.error as e:
     raise RuntimeError(f"Invalid regex in config.json: {e}")
 
 
-#--------------------------------------------------------------------
-# Funcs
-#--------------------------------------------------------------------
+#--------------------------------------------------------------------
+# Funcs
+#--------------------------------------------------------------------
+
+def rules_snapshot_mtime():
+    try:
+        return os.stat(RULES_SNAPSHOT_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+rules_snapshot = load_rules_snapshot(RULES_SNAPSHOT_PATH)
+REGISTRY, _key_filter = build_registry(trackers, rules_snapshot, RULES_SNAPSHOT_PATH)
+PARAM_INDEX = REGISTRY.snapshot().index
+RULES = REGISTRY.snapshot().rules
+SCANNER = LinkScanner(REGEX, _key_filter)
+rules_snapshot_mtime_ns = rules_snapshot_mtime()
+
+CLEAN_CACHE = CleanCache(clean_cache_size)
+
+def clean_url(url, rules=None, cache=None):
+    """
+    Remove tracking parameters from a URL.
+    
+    Args:
+        url: URL to clean
+        rules: TrackerRules to apply (defaults to the global RULES)
+        cache: CleanCache matching those rules (defaults to the global CLEAN_CACHE)
+    """
+    return core.clean_url(url, RULES if rules is None else rules, CLEAN_CACHE if cache is None else cache)
+
+async def reload_config_from_disk():
+    """Load configuration from JSON file without blocking the event loop."""
+    global config
+    config = await config_store.reload()
+    apply_config()
+
+def apply_config():
+    """Apply the in-memory configuration to the module-level settings."""
+    global expand_shorteners, REGEX, SCANNER
+    expand_shorteners = config.get("expand_shorteners", default_config["expand_shorteners"])
+    configure_logging(config.get("log_level", default_config["log_level"]), config.get("log_format", default_config["log_format"]))
+    repost_scheduler.configure(
+        config.get("repost_queue_size", default_config["repost_queue_size"]),
+        config.get("repost_max_inflight", default_config["repost_max_inflight"]),
+        config.get("repost_overflow_policy", default_config["repost_overflow_policy"])
+    )
+    CLEAN_CACHE.resize(config.get("clean_cache_size", default_config["clean_cache_size"]))
+    
+    try:
+        REGEX = re.compile(config.get("regex_keys", default_config["regex_keys"]))
+    except re.error as e:
+        raise RuntimeError(f"Invalid regex in config.json: {e}")
+    SCANNER = LinkScanner(REGEX, SCANNER.key_filter)
+    guild_states.resize(config.get("guild_cache_size", default_config["guild_cache_size"]))
+    guild_states.invalidate()
+
+def save_config():
+    """Save current configuration to JSON file (debounced, off the event loop)."""
+    config_store.mark_dirty()
+
+async def reload_trackers_from_disk():
+    """Load trackers from JSON file without blocking the event loop."""
+    global trackers
+    trackers = await trackers_store.reload()
+    # Compiling imported filter lists can take a while, so the registry is built in an executor too
+    loop = asyncio.get_running_loop()
+    apply_trackers(*await loop.run_in_executor(None, build_registry, trackers, rules_snapshot, RULES_SNAPSHOT_PATH))
+
+async def reload_rules_snapshot():
+    """Pick up a rules snapshot written by import_rules.py while the bot is running."""
+    global rules_snapshot, rules_snapshot_mtime_ns
+    loop = asyncio.get_running_loop()
+    rules_snapshot_mtime_ns = rules_snapshot_mtime()
+    rules_snapshot = await loop.run_in_executor(None, load_rules_snapshot, RULES_SNAPSHOT_PATH)
+    apply_trackers(*await loop.run_in_executor(None, build_registry, trackers, rules_snapshot, RULES_SNAPSHOT_PATH))
+    rules_snapshot_mtime_ns = rules_snapshot_mtime()  # build_registry may have rewritten it
+
+def apply_trackers(registry: TrackerRegistry, key_filter):
+    """Swap in a new tracker registry and the scanner key filter compiled for it."""
+    global REGISTRY, PARAM_INDEX, RULES, SCANNER
+    REGISTRY = registry
+    PARAM_INDEX = REGISTRY.snapshot().index
+    RULES = REGISTRY.snapshot().rules
+    SCANNER = LinkScanner(REGEX, key_filter)
+    CLEAN_CACHE.clear()  # Cached results were computed against the old index
+    guild_states.invalidate()
+
+async def publish_trackers():
+    """
+    Publish registry edits to the message hot path.
+    
+    The new snapshot is compiled in an executor while messages are still
+    cleaned with the previous one, then swapped in. Until the scanner's key
+    filter is recompiled as well, the scanner only checks for '?', which
+    lets more messages through but never misses a tracker. When edits come
+    in faster than they compile, only the newest is swapped in.
+    """
+    global PARAM_INDEX, RULES, SCANNER
+    registry = REGISTRY
+    loop = asyncio.get_running_loop()
+    snapshot = await loop.run_in_executor(None, compile_snapshot, *registry.snapshot_inputs())
+    if registry is not REGISTRY or not registry.publish_snapshot(snapshot):
+        return  # Edited or reloaded again meanwhile, that publish wins
+    PARAM_INDEX = snapshot.index
+    RULES = snapshot.rules
+    CLEAN_CACHE.clear()
+    SCANNER = LinkScanner(REGEX, None)
+    guild_states.invalidate()
+
+    key_filter = await loop.run_in_executor(None, build_key_filter, snapshot.index)
+    if PARAM_INDEX is snapshot.index:  # Skip if a newer edit was published meanwhile
+        SCANNER = LinkScanner(REGEX, key_filter)
+        guild_states.invalidate()
+
+def save_trackers():
+    """Save current trackers to JSON file (debounced, off the event loop)."""
+    global trackers
+    trackers = trackers_store.data = REGISTRY.to_dict()
+    trackers_store.mark_dirty()
+
+async def watch_config_files():
+    """Pick up edits made to config.json, trackers.json, rules.snapshot or guilds.db outside this process."""
+    watched = (
+        (config_store, reload_config_from_disk),
+        (trackers_store, reload_trackers_from_disk)
+    )
+    while True:
+        await asyncio.sleep(FILE_WATCH_INTERVAL)
+        for store, reload in watched:
+            if not store.changed_on_disk():
+                continue
+            try:
+                await reload()
+                log.info("Reloaded %s after it was changed on disk", store.filepath)
+            except Exception as e:
+                store.mark_seen()  # Don't retry a broken file every interval
+                log.error("Error reloading %s: %s", store.filepath, e)
+        if rules_snapshot_mtime() != rules_snapshot_mtime_ns:
+            try:
+                await reload_rules_snapshot()
+                log.info("Reloaded %s after it was changed on disk", RULES_SNAPSHOT_PATH)
+            except Exception as e:
+                log.error("Error reloading %s: %s", RULES_SNAPSHOT_PATH, e)
+        try:
+            if await guild_db.changed_elsewhere():
+                await reload_guild_overrides()
+        except sqlite3.Error as e:
+            log.error("Error reloading %s: %s", GUILDS_DB_PATH, e)
+
+#--------------------------------------------------------------------
+# Regex Guard
+#--------------------------------------------------------------------
+
+# re holds the GIL while matching, so slow patterns are run in a process that can be killed
+REGEX_GUARD_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regex_guard.py')
+REGEX_GUARD_AVAILABLE = not getattr(sys, 'frozen', False) and os.path.isfile(REGEX_GUARD_PATH)
+REGEX_BENCH_TIMEOUT = 10.0
+REGEX_MAX_SLOWDOWN = 5.0  # Allowed slowdown vs the default regex_keys
+REGEX_SLOW_FLOOR = 0.005  # Adversarial inputs faster than this always pass
+LONG_MESSAGE_CHARS = 1000  # Longer messages are matched in the guard process
+LONG_MESSAGE_TIMEOUT = 2.0
+
+async def benchmark_regex(pattern: str) -> dict:
+    """
+    Time a candidate pattern and the default regex_keys in regex_guard.py.
+    
+    Returns:
+        dict: "default" and "candidate" results; a missing entry means that
+        pattern didn't finish within REGEX_BENCH_TIMEOUT
+    """
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, REGEX_GUARD_PATH, "--bench",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    request = {"patterns": {"default": default_config["regex_keys"], "candidate": pattern}}
+    process.stdin.write(json.dumps(request).encode("utf-8"))
+    await process.stdin.drain()
+    process.stdin.close()
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + REGEX_BENCH_TIMEOUT
+    results = {}
+    try:
+        while len(results) < 2:
+            line = await asyncio.wait_for(process.stdout.readline(), max(0.0, deadline - loop.time()))
+            if not line:
+                break
+            results.update(json.loads(line))
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+    return results
+
+async def check_regex(pattern: str) -> tuple:
+    """
+    Benchmark a regex_keys candidate before it is accepted.
+    
+    Returns:
+        tuple: (error message or None, throughput report)
+    """
+    if not REGEX_GUARD_AVAILABLE:
+        return None, "Benchmark skipped, regex_guard.py is not available in this build."
+
+    results = await benchmark_regex(pattern)
+    default = results.get("default")
+    candidate = results.get("candidate")
+    if default is None or candidate is None:
+        return (
+            f"Pattern didn't finish the benchmark within {REGEX_BENCH_TIMEOUT:g}s, "
+            f"it most likely backtracks catastrophically on some inputs."
+        ), ""
+
+    report = (
+        f"Realistic messages: {candidate['chars_per_sec']:,.0f} chars/sec "
+        f"(default pattern: {default['chars_per_sec']:,.0f}).\n"
+        f"Slowest adversarial input: {candidate['adversarial_worst_seconds'] * 1000:.1f} ms "
+        f"(default pattern: {default['adversarial_worst_seconds'] * 1000:.1f} ms)."
+    )
+    if candidate["realistic_seconds"] > default["realistic_seconds"] * REGEX_MAX_SLOWDOWN:
+        return f"Pattern is more than {REGEX_MAX_SLOWDOWN:g}x slower than the default on realistic messages.", report
+    worst_allowed = max(default["adversarial_worst_seconds"] * REGEX_MAX_SLOWDOWN, REGEX_SLOW_FLOOR)
+    if candidate["adversarial_worst_seconds"] > worst_allowed:
+        return f"Pattern is more than {REGEX_MAX_SLOWDOWN:g}x slower than the default on adversarial input.", report
+    return None, report
+
+class RegexWorker:
+    """
+    A regex_guard.py --serve process that runs the URL regex on long messages.
+    
+    Requests are sent one at a time. When a request times out the process
+    is killed, and a new one is started for the next request.
+    """
+
+    def __init__(self):
+        self._process = None
+        self._lock = asyncio.Lock()
+
+    async def _ensure_process(self):
+        if self._process is None or self._process.returncode is not None:
+            self._process = await asyncio.create_subprocess_exec(
+                sys.executable, REGEX_GUARD_PATH, "--serve",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                limit=2 ** 24  # Replies can hold every URL of a 4000 character message
+            )
+        return self._process
+
+    def _discard_process(self):
+        if self._process is not None and self._process.returncode is None:
+            self._process.kill()
+        self._process = None
+
+    async def spans(self, regex: re.Pattern, group: int, message: str, timeout: float) -> list:
+        """
+        Return match.span(group) for every match of regex in message.
+        
+        Raises:
+            asyncio.TimeoutError: The match took longer than timeout
+        """
+        async with self._lock:
+            process = await self._ensure_process()
+            request = {"pattern": regex.pattern, "flags": regex.flags, "group": group, "message": message}
+            try:
+                process.stdin.write(json.dumps(request).encode("utf-8") + b"\n")
+                await process.stdin.drain()
+                line = await asyncio.wait_for(process.stdout.readline(), timeout)
+            except (asyncio.TimeoutError, ConnectionError):
+                self._discard_process()
+                raise asyncio.TimeoutError()
+            if not line:
+                self._discard_process()
+                raise asyncio.TimeoutError()
+            return json.loads(line)["spans"]
+
+regex_worker = RegexWorker()
+
+async def scan_message(scanner: LinkScanner, message: str) -> list:
+    """
+    scanner.scan_spans(), with long messages matched off the event loop.
+    
+    A message the URL regex can't get through in LONG_MESSAGE_TIMEOUT is
+    skipped rather than allowed to stall every other message.
+    """
+    if len(message) < LONG_MESSAGE_CHARS or not REGEX_GUARD_AVAILABLE:
+        return scanner.scan_spans(message)
+    if not scanner.might_have_trackers(message):
+        return []
+    try:
+        spans = await regex_worker.spans(scanner.regex, scanner.group, message, LONG_MESSAGE_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning("URL regex timed out on a %d character message, skipping it", len(message))
+        return []
+    return [(start, end) for start, end in spans if start != end and '?' in message[start:end]]
+
+#--------------------------------------------------------------------
+# Short Link Expansion
+#--------------------------------------------------------------------
+
+SHORTENER_HOSTS = (
+    "t.co", "bit.ly", "tinyurl.com", "ow.ly", "buff.ly", "is.gd", "amzn.to", "lnkd.in",
+    "fb.me", "trib.al", "dlvr.it", "rebrand.ly", "cutt.ly", "tiny.cc", "shorturl.at"
+)
+# A match must not start inside another word or URL (my-t.co/..., web.archive.org/web/2020/https://bit.ly/...)
+SHORTENER_RE = re.compile(
+    r"(?i)(?<![^\s<>()\[\]{}\"'|*_~`])(?:https?://)?(?:"
+    + "|".join(re.escape(host) for host in SHORTENER_HOSTS) + r")/[A-Za-z0-9_-]+"
+)
+SHORTENER_TIMEOUT = 5.0
+SHORTENER_MAX_CONCURRENCY = 8
+SHORTENER_MAX_HOPS = 3
+SHORTENER_CACHE_TTL = 3600.0
+SHORTENER_FAILURE_TTL = 60.0
+SHORTENER_CACHE_SIZE = 4096
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+class UrlExpander:
+    """
+    Resolves short links (t.co, bit.ly, ...) to their targets.
+    
+    Only the shortener is asked where a link points (a HEAD request without
+    following redirects), the target site is never contacted. Requests share
+    one aiohttp connection pool and are capped at max_concurrency; results,
+    including failures, are cached for a while, and concurrent requests for
+    the same link share one lookup.
+    """
+
+    def __init__(self, hosts=SHORTENER_HOSTS, timeout: float = SHORTENER_TIMEOUT,
+                 max_concurrency: int = SHORTENER_MAX_CONCURRENCY, ttl: float = SHORTENER_CACHE_TTL,
+                 host_overrides: dict = None):
+        """
+        Args:
+            hosts: Shortener hosts whose links may be resolved
+            timeout: Per-request timeout in seconds
+            max_concurrency: Maximum lookups in flight at once
+            ttl: Seconds a resolved target is cached
+            host_overrides: host -> base URL to send that host's requests to
+                instead (e.g. a local test server), with the Host header kept
+        """
+        self.hosts = frozenset(host.lower() for host in hosts)
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.ttl = ttl
+        self.host_overrides = dict(host_overrides or {})
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+        self._cache = OrderedDict()  # url -> (expires at, target or None)
+        self._inflight = {}  # url -> Task
+
+    def is_short_link(self, url: str) -> bool:
+        return url_host(urlparse(url)) in self.hosts
+
+    async def expand(self, url: str):
+        """Return the target of a short link, or None if it can't be resolved."""
+        if "://" not in url:
+            url = "https://" + url
+        loop = asyncio.get_running_loop()
+        cached = self._cache.get(url)
+        if cached is not None:
+            if cached[0] > loop.time():
+                self._cache.move_to_end(url)
+                return cached[1]
+            del self._cache[url]
+
+        task = self._inflight.get(url)
+        if task is None:
+            task = self._inflight[url] = asyncio.create_task(self._resolve(url))
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        # Shielded, so a cancelled message handler doesn't cancel the lookup for others
+        return await asyncio.shield(task)
+
+    async def _resolve(self, url: str):
+        target = url
+        ttl = self.ttl
+        try:
+            async with self._semaphore:
+                for _ in range(SHORTENER_MAX_HOPS):
+                    location = await self._lookup(target)
+                    if location is None:
+                        break
+                    target = urljoin(target, location)
+                    if not self.is_short_link(target):
+                        break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.info("Could not expand %s: %r", url, e)
+            target = url
+            ttl = SHORTENER_FAILURE_TTL
+
+        result = target if target != url and not self.is_short_link(target) else None
+        self._cache[url] = (asyncio.get_running_loop().time() + ttl, result)
+        while len(self._cache) > SHORTENER_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return result
+
+    async def _lookup(self, url: str):
+        """Return the Location a short link redirects to, or None."""
+        parsed = urlparse(url)
+        host = url_host(parsed)
+        headers = {}
+        base = self.host_overrides.get(host)
+        if base is not None:
+            headers["Host"] = parsed.netloc
+            url = base.rstrip("/") + urlunparse(("", "", parsed.path or "/", parsed.params, parsed.query, ""))
+
+        async with self._get_session().head(url, allow_redirects=False, headers=headers) as response:
+            if response.status in REDIRECT_STATUSES:
+                return response.headers.get("Location")
+            return None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": "Discord-Link-Cleaner (+https://github.com/StroepWafel/Discord-Link-Cleaner)"}
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+url_expander = UrlExpander()
+
+#--------------------------------------------------------------------
+# Per-guild Settings
+#--------------------------------------------------------------------
+
+GUILD_SETTING_KEYS = ("mention_reply_author", "require_links", "repost_mode", "regex_keys")
+GUILD_CLEAN_CACHE_SIZE = 512
+
+GUILDS_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS guild_settings (
+    guild_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (guild_id, key)
+);
+CREATE TABLE IF NOT EXISTS sweeps (
+    guild_id INTEGER PRIMARY KEY,
+    mode TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    finished INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sweep_channels (
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    before_id INTEGER,
+    scanned INTEGER NOT NULL DEFAULT 0,
+    found INTEGER NOT NULL DEFAULT 0,
+    cleaned INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (guild_id, channel_id)
+);
+CREATE TABLE IF NOT EXISTS guild_trackers (
+    guild_id INTEGER NOT NULL,
+    param_key TEXT NOT NULL,
+    param TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    removed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (guild_id, param_key)
+);
+CREATE TABLE IF NOT EXISTS settings_revision (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    revision INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO settings_revision (id, revision) VALUES (0, 0);
+CREATE TABLE IF NOT EXISTS tracker_hits (
+    guild_id INTEGER NOT NULL,
+    provider TEXT NOT NULL,
+    param TEXT NOT NULL,
+    day TEXT NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (guild_id, provider, param, day)
+);
+"""
+
+class GuildOverrides:
+    """A guild's settings and tracker changes on top of the global config."""
+
+    __slots__ = ("settings", "trackers", "revision")
+
+    _revisions = itertools.count(1)
+
+    def __init__(self):
+        self.settings = {}  # key -> value
+        self.trackers = {}  # param.lower() -> (param, provider, removed)
+        self.revision = 0   # changed with the trackers, so compiled rules know they are stale
+
+    def trackers_changed(self) -> None:
+        """Give the tracker changes a revision no earlier trackers of any guild had."""
+        self.revision = next(GuildOverrides._revisions)
+
+class GuildSettingsDB:
+    """
+    SQLite storage for per-guild settings and tracker overrides.
+    
+    Every statement runs on one dedicated executor thread, so the event loop
+    never waits on the database and the connection is never used from two
+    threads at once. The whole database is read into memory at startup; the
+    message hot path never touches it. Changes to settings and overrides
+    bump the settings_revision row, which other processes poll to know when
+    to read them again; sweep checkpoints and tracker statistics don't.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="guild-db")
+        self._conn = sqlite3.connect(filepath, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(GUILDS_DB_SCHEMA)
+        self._revision = None  # settings_revision as of the last load
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _settings_revision(self) -> int:
+        return self._conn.execute("SELECT revision FROM settings_revision").fetchone()[0]
+
+    def load_all(self) -> dict:
+        """Read every guild's overrides (blocking). Returns guild_id -> GuildOverrides."""
+        # Read first: a change committed while loading is then picked up again rather than missed
+        self._revision = self._settings_revision()
+        overrides = {}
+        for guild_id, key, value in self._conn.execute("SELECT guild_id, key, value FROM guild_settings"):
+            overrides.setdefault(guild_id, GuildOverrides()).settings[key] = json.loads(value)
+        rows = self._conn.execute("SELECT guild_id, param_key, param, provider, removed FROM guild_trackers")
+        for guild_id, param_key, param, provider, removed in rows:
+            overrides.setdefault(guild_id, GuildOverrides()).trackers[param_key] = (param, provider, bool(removed))
+        return overrides
+
+    async def load_all_async(self) -> dict:
+        return await self._run(self.load_all)
+
+    async def changed_elsewhere(self) -> bool:
+        """Whether another process (e.g. another shard worker) changed settings or overrides."""
+        return await self._run(self._settings_revision) != self._revision
+
+    def _execute(self, sql: str, params: tuple) -> None:
+        with self._conn:
+            self._conn.execute(sql, params)
+
+    def _change_settings(self, statements: list) -> None:
+        """Run (sql, params) statements and bump settings_revision in one transaction."""
+        with self._conn:
+            for sql, params in statements:
+                self._conn.execute(sql, params)
+            self._conn.execute("UPDATE settings_revision SET revision = revision + 1")
+            revision = self._settings_revision()
+        if revision == self._revision + 1:
+            self._revision = revision  # Nobody else changed anything since, there's nothing to reload
+
+    async def set_setting(self, guild_id: int, key: str, value) -> None:
+        await self._run(self._change_settings, [(
+            "INSERT INTO guild_settings (guild_id, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (guild_id, key) DO UPDATE SET value = excluded.value",
+            (guild_id, key, json.dumps(value))
+        )])
+
+    async def set_tracker(self, guild_id: int, param: str, provider: str, removed: bool) -> None:
+        await self._run(self._change_settings, [(
+            "INSERT INTO guild_trackers (guild_id, param_key, param, provider, removed) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (guild_id, param_key) DO UPDATE SET "
+            "param = excluded.param, provider = excluded.provider, removed = excluded.removed",
+            (guild_id, param.lower(), param, provider, int(removed))
+        )])
+
+    async def delete_tracker(self, guild_id: int, param: str) -> None:
+        await self._run(self._change_settings, [(
+            "DELETE FROM guild_trackers WHERE guild_id = ? AND param_key = ?",
+            (guild_id, param.lower())
+        )])
+
+    async def delete_guild(self, guild_id: int) -> None:
+        await self._run(self._change_settings, [
+            ("DELETE FROM guild_settings WHERE guild_id = ?", (guild_id,)),
+            ("DELETE FROM guild_trackers WHERE guild_id = ?", (guild_id,))
+        ])
+
+    def _start_sweep(self, guild_id: int, mode: str, started_at: str, channel_ids: list) -> None:
+        with self._conn:
+            self._conn.execute("DELETE FROM sweep_channels WHERE guild_id = ?", (guild_id,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sweeps (guild_id, mode, started_at, finished) VALUES (?, ?, ?, 0)",
+                (guild_id, mode, started_at)
+            )
+            self._conn.executemany(
+                "INSERT INTO sweep_channels (guild_id, channel_id) VALUES (?, ?)",
+                [(guild_id, channel_id) for channel_id in channel_ids]
+            )
+
+    async def start_sweep(self, guild_id: int, mode: str, started_at: str, channel_ids: list) -> None:
+        await self._run(self._start_sweep, guild_id, mode, started_at, channel_ids)
+
+    async def save_sweep_channel(self, guild_id: int, progress) -> None:
+        await self._run(self._execute, (
+            "UPDATE sweep_channels SET before_id = ?, scanned = ?, found = ?, cleaned = ?, done = ? "
+            "WHERE guild_id = ? AND channel_id = ?"
+        ), (
+            progress.before_id, progress.scanned, progress.found, progress.cleaned, int(progress.done),
+            guild_id, progress.channel_id
+        ))
+
+    async def finish_sweep(self, guild_id: int) -> None:
+        await self._run(self._execute, "UPDATE sweeps SET finished = 1 WHERE guild_id = ?", (guild_id,))
+
+    def _load_sweeps(self) -> list:
+        sweeps = []
+        for guild_id, mode, started_at in self._conn.execute(
+            "SELECT guild_id, mode, started_at FROM sweeps WHERE finished = 0"
+        ).fetchall():
+            rows = self._conn.execute(
+                "SELECT channel_id, before_id, scanned, found, cleaned, done FROM sweep_channels WHERE guild_id = ?",
+                (guild_id,)
+            )
+            channels = {row[0]: ChannelProgress(*row) for row in rows}
+            sweeps.append((guild_id, mode, started_at, channels))
+        return sweeps
+
+    async def load_sweeps(self) -> list:
+        """Return unfinished sweeps as (guild_id, mode, started_at, channel ID -> ChannelProgress)."""
+        return await self._run(self._load_sweeps)
+
+    def add_tracker_hits(self, day: str, rows: list) -> None:
+        """Add (guild_id, provider, param, hits) rows to a day's totals in one transaction (blocking)."""
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO tracker_hits (guild_id, provider, param, day, hits) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (guild_id, provider, param, day) DO UPDATE SET hits = hits + excluded.hits",
+                [(guild_id, provider, param, day, hits) for guild_id, provider, param, hits in rows]
+            )
+
+    async def add_tracker_hits_async(self, day: str, rows: list) -> None:
+        await self._run(self.add_tracker_hits, day, rows)
+
+class GuildState:
+    """
+    Everything the message hot path needs for one guild, precompiled.
+    
+    Guilds without tracker overrides share the global rules and URL cache;
+    guilds with overrides get their own merged rules and a small cache.
+    """
+
+    __slots__ = ("mention_reply_author", "require_links", "repost_mode", "regex_keys", "scanner", "rules", "cache")
+
+    def clean_url(self, url: str) -> dict:
+        return clean_url(url, self.rules, self.cache)
+
+def merge_guild_rules(rules, trackers: dict) -> dict:
+    """Apply a guild's tracker overrides to the global rules, as param.lower() -> (param, provider)."""
+    merged = {param.lower(): (param, provider) for param, provider in rules}
+    for param_key, (param, provider, removed) in trackers.items():
+        if removed:
+            merged.pop(param_key, None)
+        else:
+            merged[param_key] = (param, provider)
+    return merged
+
+def guild_rules(guild_id) -> dict:
+    """Return the effective tracker rules of a guild as param.lower() -> (param, provider)."""
+    overrides = guild_overrides.get(guild_id)
+    return merge_guild_rules(REGISTRY.rules(), overrides.trackers if overrides is not None else {})
+
+class GuildRuleSet:
+    """A guild's merged tracker rules, compiled for one registry version and override revision."""
+
+    __slots__ = ("stamp", "rules", "key_filter", "cache")
+
+    def __init__(self, stamp: tuple, rules: TrackerRules, key_filter):
+        self.stamp = stamp
+        self.rules = rules
+        self.key_filter = key_filter
+        self.cache = CleanCache(GUILD_CLEAN_CACHE_SIZE)
+
+def compile_guild_rules(stamp: tuple, rules: list, trackers: dict) -> GuildRuleSet:
+    """Merge and compile a guild's tracker rules; runs in an executor."""
+    merged = merge_guild_rules(rules, trackers)
+    return GuildRuleSet(stamp, TrackerRules(merged.values()), build_key_filter(merged))
+
+def build_guild_state(guild_id, rule_set) -> GuildState:
+    """Put together the effective settings of a guild with its compiled rules, if it has any (no I/O)."""
+    overrides = guild_overrides.get(guild_id)
+    settings = overrides.settings if overrides is not None else {}
+
+    state = GuildState()
+    for key in GUILD_SETTING_KEYS:
+        setattr(state, key, settings[key] if key in settings else config.get(key, default_config[key]))
+
+    regex = REGEX
+    if "regex_keys" in settings:
+        try:
+            regex = re.compile(settings["regex_keys"])
+        except re.error as e:
+            log.warning("Invalid regex for guild %s, using the global one: %s", guild_id, e, extra={"guild_id": guild_id})
+
+    if rule_set is not None:
+        state.rules = rule_set.rules
+        state.cache = rule_set.cache
+        state.scanner = LinkScanner(regex, rule_set.key_filter)
+    else:
+        state.rules = None
+        state.cache = None
+        state.scanner = SCANNER if regex is REGEX else LinkScanner(regex, SCANNER.key_filter)
+    return state
+
+class GuildStateCache:
+    """
+    LRU cache of compiled GuildState objects, keyed by guild ID (None for DMs).
+    
+    Settings are cheap to put together, so invalidate() just drops states.
+    The merged tracker rules of guilds with overrides are kept apart and
+    compiled in an executor: when the global rules or the guild's
+    overrides change, the guild keeps the rules it has until the new ones
+    are ready. Only a guild with no compiled rules at all waits for them.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max(1, int(max_size))
+        self._states = OrderedDict()
+        self._rule_sets = {}  # guild ID -> GuildRuleSet
+        self._compiling = {}  # guild ID -> (stamp, future)
+
+    async def get(self, guild_id) -> GuildState:
+        state = self._states.get(guild_id)
+        if state is not None:
+            self._states.move_to_end(guild_id)
+            return state
+
+        rule_set = None
+        overrides = guild_overrides.get(guild_id)
+        if overrides is not None and overrides.trackers:
+            stamp = (REGISTRY, REGISTRY.version, guild_id, overrides.revision)
+            rule_set = self._rule_sets.get(guild_id)
+            if rule_set is None:
+                rule_set = self._rule_sets.setdefault(guild_id, await self._compile(guild_id, stamp, overrides))
+            elif rule_set.stamp != stamp:
+                self._compile(guild_id, stamp, overrides)  # Serve the stale rules meanwhile
+        else:
+            self._rule_sets.pop(guild_id, None)
+
+        state = self._states[guild_id] = build_guild_state(guild_id, rule_set)
+        self._states.move_to_end(guild_id)
+        self._evict()
+        return state
+
+    def _compile(self, guild_id, stamp: tuple, overrides: GuildOverrides) -> asyncio.Future:
+        """Start compiling a guild's rules in an executor, unless that is already underway."""
+        pending = self._compiling.get(guild_id)
+        if pending is not None and pending[0] == stamp:
+            return pending[1]
+        # Copied on the loop, admin edits can't change them mid-compile
+        rules = REGISTRY.rules()
+        trackers = dict(overrides.trackers)
+        future = asyncio.get_running_loop().run_in_executor(None, compile_guild_rules, stamp, rules, trackers)
+        self._compiling[guild_id] = (stamp, future)
+        future.add_done_callback(lambda done: self._compiled(guild_id, done))
+        return future
+
+    def _compiled(self, guild_id, future: asyncio.Future) -> None:
+        pending = self._compiling.get(guild_id)
+        if pending is None or pending[1] is not future:
+            return  # Superseded by a newer compile, or the guild was evicted meanwhile
+        del self._compiling[guild_id]
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            log.error("Error compiling tracker rules of guild %s: %s", guild_id, future.exception(),
+                      extra={"guild_id": guild_id})
+            return
+        self._rule_sets[guild_id] = future.result()
+        self._states.pop(guild_id, None)  # Rebuilt with the new rules on the next message
+
+    def _evict(self) -> None:
+        while len(self._states) > self.max_size:
+            evicted, _ = self._states.popitem(last=False)
+            self._rule_sets.pop(evicted, None)
+            self._compiling.pop(evicted, None)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def resize(self, max_size: int) -> None:
+        self.max_size = max(1, int(max_size))
+        self._evict()
+
+    def invalidate(self, guild_id=...) -> None:
+        """Forget one guild's compiled settings, or every guild's when called without arguments."""
+        if guild_id is ...:
+            self._states.clear()
+        else:
+            self._states.pop(guild_id, None)
+
+guild_db = GuildSettingsDB(GUILDS_DB_PATH)
+guild_overrides = guild_db.load_all()
+guild_states = GuildStateCache(config.get("guild_cache_size", default_config["guild_cache_size"]))
+
+async def reload_guild_overrides():
+    """Re-read guilds.db after another process changed it."""
+    global guild_overrides
+    reloaded = await guild_db.load_all_async()
+    for guild_id, overrides in reloaded.items():
+        previous = guild_overrides.get(guild_id)
+        if previous is not None and previous.trackers == overrides.trackers:
+            overrides.revision = previous.revision  # Compiled rules stay valid
+        else:
+            overrides.trackers_changed()
+    guild_overrides = reloaded
+    guild_states.invalidate()
+
+async def set_guild_setting(guild_id: int, key: str, value) -> None:
+    """Override a setting for one guild and persist it."""
+    guild_overrides.setdefault(guild_id, GuildOverrides()).settings[key] = value
+    guild_states.invalidate(guild_id)
+    await guild_db.set_setting(guild_id, key, value)
+
+async def set_guild_tracker(guild_id: int, param: str, provider: str, enabled: bool) -> None:
+    """
+    Enable or disable a tracker for one guild and persist it.
+    
+    Overrides that would just restate the global tracker list are deleted
+    instead of stored.
+    """
+    overrides = guild_overrides.setdefault(guild_id, GuildOverrides())
+    param_key = param.lower()
+    global_provider = REGISTRY.lookup(param)
+    if (enabled and global_provider == provider) or (not enabled and global_provider is None):
+        overrides.trackers.pop(param_key, None)
+        await_write = guild_db.delete_tracker(guild_id, param)
+    else:
+        overrides.trackers[param_key] = (param, provider, not enabled)
+        await_write = guild_db.set_tracker(guild_id, param, provider, not enabled)
+    overrides.trackers_changed()
+    guild_states.invalidate(guild_id)
+    await await_write
+
+async def reset_guild(guild_id: int) -> None:
+    """Drop every override of a guild so it follows the global config again."""
+    guild_overrides.pop(guild_id, None)
+    guild_states.invalidate(guild_id)
+    await guild_db.delete_guild(guild_id)
+
+#--------------------------------------------------------------------
+# Metrics
+#--------------------------------------------------------------------
+
+# Seconds; covers sub-microsecond regex work up to slow, rate limited API calls
+LATENCY_BUCKETS = (
+    0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+    0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+class Counter:
+    """A monotonically increasing Prometheus counter, optionally labelled."""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}  # label values tuple -> count
+
+    def inc(self, amount=1, label_values: tuple = ()) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    """
+    A Prometheus histogram with fixed buckets, optionally labelled.
+    
+    observe() is a bisect and two list updates, the cumulative bucket counts
+    are only computed when the endpoint is scraped.
+    """
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values tuple -> [bucket counts (+Inf last), sum]
+
+    def observe(self, value: float, label_values: tuple = ()) -> None:
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = format_labels(self.labels + ("le",), label_values + (str(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+MESSAGES_SCANNED = Counter("link_cleaner_messages_scanned_total", "Messages run through the link scanner")
+MESSAGES_WITH_LINKS = Counter(
+    "link_cleaner_messages_with_links_total", "Messages with at least one link that may carry trackers"
+)
+URLS_CLEANED = Counter("link_cleaner_urls_cleaned_total", "URLs that had at least one tracker removed")
+TRACKERS_REMOVED = Counter("link_cleaner_trackers_removed_total", "Tracker parameters removed", ("provider",))
+STAGE_SECONDS = Histogram("link_cleaner_stage_seconds", "Time spent in each message handling stage", ("stage",))
+DISCORD_CALL_SECONDS = Histogram(
+    "link_cleaner_discord_call_seconds", "Latency of Discord API calls made for reposts", ("call", "outcome")
+)
+METRICS = (MESSAGES_SCANNED, MESSAGES_WITH_LINKS, URLS_CLEANED, TRACKERS_REMOVED, STAGE_SECONDS, DISCORD_CALL_SECONDS)
+
+async def timed_call(call: str, awaitable):
+    """Await a Discord API call, recording its latency under `call`."""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await awaitable
+        outcome = "ok"
+        return result
+    except discord.HTTPException as e:
+        outcome = "rate_limited" if e.status == 429 else "error"
+        raise
+    finally:
+        DISCORD_CALL_SECONDS.observe(time.perf_counter() - start, (call, outcome))
+
+def render_metrics() -> str:
+    """Render every metric, plus cache and queue gauges, in the Prometheus text format."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    gauges = {
+        "link_cleaner_clean_cache_entries": ("URLs in the clean_url cache", CLEAN_CACHE.stats()["size"]),
+        "link_cleaner_guild_states": ("Servers with compiled settings in memory", len(guild_states)),
+    }
+    queue_stats = repost_scheduler.stats()
+    for key in ("queued", "inflight", "channels", "max_depth"):
+        gauges[f"link_cleaner_repost_{key}"] = (f"Repost scheduler {key.replace('_', ' ')}", queue_stats[key])
+    for name, (help_text, value) in gauges.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+
+    cache_stats = CLEAN_CACHE.stats()
+    for key in ("hits", "misses", "evictions"):
+        name = f"link_cleaner_clean_cache_{key}_total"
+        lines += [f"# HELP {name} clean_url cache {key}", f"# TYPE {name} counter", f"{name} {cache_stats[key]}"]
+    for key in ("completed", "dropped", "deleted_only"):
+        name = f"link_cleaner_reposts_{key}_total"
+        lines += [f"# HELP {name} Reposts {key.replace('_', ' ')}", f"# TYPE {name} counter", f"{name} {queue_stats[key]}"]
+    log_counters = {
+        "link_cleaner_log_records_suppressed_total": ("Repeated log records left out by sampling", log_sampler.suppressed),
+        "link_cleaner_log_records_dropped_total": ("Log records dropped because the log queue was full", log_handler.dropped),
+    }
+    for name, (help_text, value) in log_counters.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server(host: str, port: int):
+    """Serve /metrics on host:port. Returns the runner, so it can be cleaned up."""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return runner
+
+#--------------------------------------------------------------------
+# Tracker Hit Stats
+#--------------------------------------------------------------------
+
+STATS_BUCKET_SECONDS = 3600
+STATS_BUCKETS = 24         # Hourly buckets, so /stats covers the last 24 hours
+STATS_MAX_KEYS = 8192      # (guild, provider, param) combinations counted in memory
+STATS_FLUSH_INTERVAL = 60  # Seconds between writes of new hits to guilds.db
+
+class TrackerHitStats:
+    """
+    Rolling counts of removed tracker params per (guild, provider, param).
+    
+    Every key gets a slot in one flat array holding a ring of STATS_BUCKETS
+    hourly counters per slot, so memory is fixed up front and recording a
+    hit is a dict lookup and an array increment. All rings share one clock:
+    when the hour changes, that bucket is zeroed in every ring at once, and
+    slots whose ring has emptied are handed to new keys. Hits not yet saved
+    are counted per slot in a second array and written to guilds.db in one
+    batch by flush_tracker_hits(). When every slot is taken, hits of new
+    keys are still saved but left out of the in-memory counts.
+    """
+
+    def __init__(self, max_keys: int = STATS_MAX_KEYS, buckets: int = STATS_BUCKETS,
+                 bucket_seconds: int = STATS_BUCKET_SECONDS):
+        self.max_keys = max_keys
+        self.buckets = buckets
+        self.bucket_seconds = bucket_seconds
+        self.counts = array('I', bytes(4 * max_keys * buckets))  # slot * buckets + bucket -> hits
+        self.unsaved = array('I', bytes(4 * max_keys))           # slot -> hits since the last flush
+        self.slots = {}                                          # (guild_id, provider, param) -> slot
+        self.keys = [None] * max_keys                            # slot -> key
+        self.free = list(range(max_keys - 1, -1, -1))
+        self.dirty = set()      # slots with unsaved hits
+        self.overflow = {}      # key -> unsaved hits of keys that found no free slot
+        self.untracked = 0
+        self.hour = int(time.time() // bucket_seconds)
+
+    def _advance(self) -> None:
+        hour = int(time.time() // self.bucket_seconds)
+        if hour <= self.hour:
+            return
+        zero = array('I', bytes(4 * self.max_keys))
+        for passed in range(self.hour + 1, min(hour, self.hour + self.buckets) + 1):
+            self.counts[passed % self.buckets::self.buckets] = zero
+        self.hour = hour
+
+        buckets = self.buckets
+        for key, slot in list(self.slots.items()):
+            if slot not in self.dirty and not any(self.counts[slot * buckets:(slot + 1) * buckets]):
+                del self.slots[key]
+                self.keys[slot] = None
+                self.free.append(slot)
+
+    def record(self, guild_id: int, provider: str, params: list) -> None:
+        """Count the params clean_url removed for one provider."""
+        self._advance()
+        bucket = self.hour % self.buckets
+        for param in params:
+            key = (guild_id, provider, param.lower())
+            slot = self.slots.get(key)
+            if slot is None:
+                if not self.free:
+                    self.overflow[key] = self.overflow.get(key, 0) + 1
+                    self.untracked += 1
+                    continue
+                slot = self.free.pop()
+                self.slots[key] = slot
+                self.keys[slot] = key
+            self.counts[slot * self.buckets + bucket] += 1
+            self.unsaved[slot] += 1
+            self.dirty.add(slot)
+
+    def take_unsaved(self) -> list:
+        """Return and reset the hits not yet saved, as (guild_id, provider, param, hits) rows."""
+        rows = []
+        for slot in self.dirty:
+            rows.append((*self.keys[slot], self.unsaved[slot]))
+            self.unsaved[slot] = 0
+        self.dirty.clear()
+        rows.extend((*key, hits) for key, hits in self.overflow.items())
+        self.overflow = {}
+        return rows
+
+    def totals(self, guild_id: int = None) -> dict:
+        """Return (provider, param) -> hits over the window, for one guild or all of them."""
+        self._advance()
+        buckets = self.buckets
+        totals = {}
+        for (key_guild, provider, param), slot in self.slots.items():
+            if guild_id is not None and key_guild != guild_id:
+                continue
+            hits = sum(self.counts[slot * buckets:(slot + 1) * buckets])
+            if hits:
+                totals[provider, param] = totals.get((provider, param), 0) + hits
+        return totals
+
+tracker_hits = TrackerHitStats()
+
+def save_tracker_hits() -> None:
+    """Write unsaved hits to guilds.db (blocking, for shutdown)."""
+    rows = tracker_hits.take_unsaved()
+    if rows:
+        guild_db.add_tracker_hits(time.strftime("%Y-%m-%d", time.gmtime()), rows)
+
+async def flush_tracker_hits():
+    """Write new tracker hits to guilds.db in one batch every STATS_FLUSH_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        rows = tracker_hits.take_unsaved()
+        if not rows:
+            continue
+        try:
+            await guild_db.add_tracker_hits_async(time.strftime("%Y-%m-%d", time.gmtime()), rows)
+        except sqlite3.Error as e:
+            log.error("Failed to save tracker hits: %s", e)
+
+def rules_without_hits(totals: dict) -> list:
+    """Return the trackers.json rules, as (provider, rule), that matched none of the params in totals."""
+    seen = {}
+    for provider, param in totals:
+        seen.setdefault(provider, []).append(param)
+    idle = []
+    for provider, rules in REGISTRY.providers():
+        params = seen.get(provider, ())
+        for rule in rules:
+            matcher = ParamMatcher([(split_host_scope(rule)[0], provider)])
+            if not any(matcher.match(param) for param in params):
+                idle.append((provider, rule))
+    return idle
+
+#--------------------------------------------------------------------
+# Profiling
+#--------------------------------------------------------------------
+
+PROFILE_MAX_SECONDS = 120
+PROFILE_TOP_FUNCTIONS = 40
+LOOP_LAG_INTERVAL = 0.05
+
+async def measure_loop_lag(samples: list, interval: float = LOOP_LAG_INTERVAL):
+    """Append how late each wake-up is (seconds) until cancelled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected))
+
+def format_loop_lag(samples: list) -> str:
+    if not samples:
+        return "Event loop lag: no samples"
+    ordered = sorted(samples)
+    pick = lambda pct: ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))] * 1000
+    return (
+        f"Event loop lag over {len(ordered)} samples ({LOOP_LAG_INTERVAL * 1000:.0f} ms interval): "
+        f"p50 {pick(50):.2f} ms, p99 {pick(99):.2f} ms, max {ordered[-1] * 1000:.2f} ms"
+    )
+
+class ProfilerBusy(Exception):
+    """Raised when a capture is requested while another one is running."""
+
+profile_lock = asyncio.Lock()
+
+async def capture_profile(seconds: float) -> tuple:
+    """
+    Profile the event loop thread for `seconds`.
+    
+    Everything the bot does on the loop (on_message, clean_url, the repost
+    scheduler, discord.py itself) is captured; executor threads are not.
+    Only one capture can run at a time.
+    
+    Returns:
+        tuple: (loop lag summary line, full text report)
+    """
+    if profile_lock.locked():
+        raise ProfilerBusy()
+    async with profile_lock:
+        lag_samples = []
+        lag_task = asyncio.create_task(measure_loop_lag(lag_samples))
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            lag_task.cancel()
+
+    lag_summary = format_loop_lag(lag_samples)
+    out = io.StringIO()
+    out.write(f"Profile of {seconds:g}s captured at {datetime.now().isoformat(timespec='seconds')}\n")
+    out.write(lag_summary + "\n")
+    cache_stats = CLEAN_CACHE.stats()
+    out.write(f"URL cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses\n\n")
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(PROFILE_TOP_FUNCTIONS)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP_FUNCTIONS)
+    return lag_summary, out.getvalue()
+
+#--------------------------------------------------------------------
+# Main Program
+#--------------------------------------------------------------------
+
+def gateway_options(low_memory: bool, message_cache_size: int) -> dict:
+    """
+    Intents and cache settings for the bot, as keyword arguments for commands.Bot.
+    
+    Cleaning only needs a message's content, author and channel, which all
+    arrive with the message itself. The low-memory profile keeps just the
+    intents for that and caches no members (other than the bot), emojis,
+    stickers or messages, so what stays in memory per server is mostly its
+    channels and roles. benchmarks/bench_memory.py measures the difference.
+    """
+    if not low_memory:
+        intents = discord.Intents.default()
+        intents.message_content = True
+        return {"intents": intents, "max_messages": message_cache_size or None}
+
+    intents = discord.Intents.none()
+    intents.guilds = True  # Channels, threads and roles, for permission checks and sweeps
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = True
+    return {
+        "intents": intents,
+        "max_messages": None,
+        "member_cache_flags": discord.MemberCacheFlags.none(),
+        "chunk_guilds_at_startup": False
+    }
+
+GATEWAY_OPTIONS = gateway_options(
+    config.get("low_memory", default_config["low_memory"]),
+    config.get("message_cache_size", default_config["message_cache_size"])
+)
+
+# Set by launcher.py when this process is one of several shard workers
+SHARD_IDS = [int(shard) for shard in os.environ.get("LINK_CLEANER_SHARD_IDS", "").split(",") if shard.strip()]
+SHARD_COUNT = int(os.environ.get("LINK_CLEANER_SHARD_COUNT") or 0) or None
+SYNC_COMMANDS = os.environ.get("LINK_CLEANER_SYNC_COMMANDS", "1") != "0"
+# launcher.py gives each worker its own port
+METRICS_PORT = int(os.environ.get("LINK_CLEANER_METRICS_PORT") or config.get("metrics_port", default_config["metrics_port"]))
+
+class ClosesSessions:
+    """Closes the bot's own HTTP sessions together with discord.py's, while the loop still runs."""
+
+    async def close(self) -> None:
+        await url_expander.close()
+        await super().close()
+
+class LinkCleanerBot(ClosesSessions, commands.Bot):
+    pass
+
+class ShardedLinkCleanerBot(ClosesSessions, commands.AutoShardedBot):
+    pass
+
+if SHARD_IDS or config.get("sharding", default_config["sharding"]):
+    bot = ShardedLinkCleanerBot(
+        command_prefix='!',
+        shard_ids=SHARD_IDS or None,
+        shard_count=SHARD_COUNT,
+        **GATEWAY_OPTIONS
+    )
+else:
+    bot = LinkCleanerBot(command_prefix='!', **GATEWAY_OPTIONS)
+
+watch_task = None
+stats_task = None
+metrics_runner = None
+
+@bot.event
+async def on_ready():
+    global watch_task, stats_task, metrics_runner
+    log.info("Logged in as %s!", bot.user)
+    if watch_task is None:
+        # Also how admin changes made in one shard worker reach the others
+        watch_task = asyncio.create_task(watch_config_files())
+    if stats_task is None:
+        stats_task = asyncio.create_task(flush_tracker_hits())
+    if metrics_runner is None and METRICS_PORT:
+        try:
+            metrics_runner = await start_metrics_server(
+                config.get("metrics_host", default_config["metrics_host"]), METRICS_PORT
+            )
+        except OSError as e:
+            log.error("Failed to start metrics server on port %s: %s", METRICS_PORT, e)
+            metrics_runner = False  # Don't retry on every reconnect
+    global sweeps_resumed
+    if not sweeps_resumed:
+        sweeps_resumed = True
+        try:
+            await resume_history_sweeps()
+        except sqlite3.Error as e:
+            log.error("Failed to resume history sweeps: %s", e)
+    if not SYNC_COMMANDS:
+        return
+    try:
+        synced = await bot.tree.sync()
+        log.info("Synced %d command(s)", len(synced))
+    except Exception:
+        log.exception("Failed to sync commands")
+
+REPOST_MODES = ("reply", "edit", "webhook")
+WEBHOOK_NAME = "Link Cleaner"
+
+webhook_cache = {}   # parent channel id -> discord.Webhook
+webhook_locks = {}   # parent channel id -> asyncio.Lock, so each channel creates one webhook
+own_webhook_ids = set()
+
+async def get_channel_webhook(channel):
+    """
+    Return the bot's webhook for a channel, creating it on first use.
+    
+    Threads share the webhook of their parent channel. Results are cached
+    per channel, so only the first repost in a channel costs extra calls.
+    """
+    parent = channel.parent if isinstance(channel, discord.Thread) else channel
+    webhook = webhook_cache.get(parent.id)
+    if webhook is not None:
+        return webhook
+
+    lock = webhook_locks.setdefault(parent.id, asyncio.Lock())
+    async with lock:
+        webhook = webhook_cache.get(parent.id)
+        if webhook is None:
+            for existing in await parent.webhooks():
+                if existing.user == bot.user and existing.name == WEBHOOK_NAME and existing.token:
+                    webhook = existing
+                    break
+            else:
+                webhook = await parent.create_webhook(name=WEBHOOK_NAME)
+            webhook_cache[parent.id] = webhook
+            own_webhook_ids.add(webhook.id)
+    return webhook
+
+async def repost_message(message, companies, sanitized_message: str):
+    """
+    Replace a message with its cleaned version using the configured repost_mode.
+    
+    - "reply": one send with the final content, with the delete running concurrently
+    - "webhook": like "reply", but posted through a per-channel webhook under
+      the author's name and avatar (falls back to "reply" if that fails)
+    - "edit": the original reply, delete, edit sequence (three calls in a row)
+    
+    Nothing is posted where the bot can't delete the original, since the
+    send and the delete run at the same time and the message would end up
+    posted twice.
+    """
+    me = message.guild.me if message.guild is not None else bot.user
+    if not message.channel.permissions_for(me).manage_messages:
+        log.warning("Bot lacks permission to delete messages, not reposting", extra=message_context(message))
+        return
+
+    state = await guild_states.get(message.guild.id if message.guild else None)
+    mention_reply_author = state.mention_reply_author
+    repost_mode = state.repost_mode
+    author_mention = f"{message.author.mention} " if mention_reply_author else ""
+    notice = (
+        f"{author_mention}Your message has been reposted without trackers from "
+        f"{format_companies(companies)}:"
+    )
+
+    if repost_mode == "edit":
+        reply = await timed_call("reply", message.reply(">>>"))
+        await timed_call("delete", message.delete())
+        await timed_call("edit", reply.edit(content=f"{notice}\n{sanitized_message}"))
+        return
+
+    # The content is sent fresh, so only the author mention may ping again
+    allowed_mentions = discord.AllowedMentions(
+        everyone=False,
+        roles=False,
+        users=[message.author] if mention_reply_author else False,
+        replied_user=mention_reply_author
+    )
+
+    send = None
+    if repost_mode == "webhook" and message.guild is not None:
+        try:
+            webhook = await get_channel_webhook(message.channel)
+            kwargs = {"thread": message.channel} if isinstance(message.channel, discord.Thread) else {}
+            send = timed_call("webhook_send", webhook.send(
+                f"{sanitized_message}\n-# Trackers from {format_companies(companies)} removed",
+                username=message.author.display_name,
+                avatar_url=message.author.display_avatar.url,
+                allowed_mentions=discord.AllowedMentions.none(),
+                **kwargs
+            ))
+        except discord.HTTPException as e:
+            log.warning("Webhook repost unavailable, replying instead: %s", e, extra=message_context(message))
+
+    if send is None:
+        send = timed_call("reply", message.channel.send(
+            f"{notice}\n{sanitized_message}",
+            reference=message.to_reference(fail_if_not_exists=False),
+            allowed_mentions=allowed_mentions
+        ))
+
+    send_result, delete_result = await asyncio.gather(
+        send, timed_call("delete", message.delete()), return_exceptions=True
+    )
+    if isinstance(send_result, discord.NotFound) and repost_mode == "webhook":
+        # Webhook was deleted by someone, forget it so the next repost recreates it
+        parent = getattr(message.channel, "parent", None) or message.channel
+        stale = webhook_cache.pop(parent.id, None)
+        if stale is not None:
+            own_webhook_ids.discard(stale.id)
+    if isinstance(send_result, Exception) and not isinstance(delete_result, Exception):
+        # The original is already gone, retry as a plain message rather than lose it
+        log.warning("Repost failed, retrying: %s", send_result, extra=message_context(message))
+        await timed_call("reply", message.channel.send(f"{notice}\n{sanitized_message}", allowed_mentions=allowed_mentions))
+        send_result = None
+    for result in (send_result, delete_result):
+        if isinstance(result, BaseException):
+            raise result
+
+async def process_repost(message, companies, sanitized_message: str):
+    """Run one repost, reporting failures instead of raising them."""
+    try:
+        await repost_message(message, companies, sanitized_message)
+    except discord.Forbidden:
+        log.warning("Bot lacks permission to delete messages", extra=message_context(message))
+    except Exception:
+        log.exception("Error handling message", extra=message_context(message))
+
+OVERFLOW_POLICIES = ("drop_oldest", "delete_only")
+CHANNEL_RATE = 5         # Reposts allowed per channel...
+CHANNEL_RATE_PER = 5.0   # ...per this many seconds, matching Discord's per-channel send limit
+
+class ChannelQueue:
+    """Pending reposts and rate-limit budget for one channel."""
+
+    __slots__ = ("jobs", "deletions", "summary", "sent", "lock", "task")
+
+    def __init__(self):
+        self.jobs = deque()       # (message, companies, sanitized_message)
+        self.deletions = deque()  # messages to delete without a repost (delete_only overflow)
+        self.summary = set()      # providers seen in messages that were only deleted
+        self.sent = deque(maxlen=CHANNEL_RATE)  # loop times at which the last sends finished
+        self.lock = asyncio.Lock()  # held from waiting for the window until the send is recorded
+        self.task = None
+
+class RepostScheduler:
+    """
+    Queues reposts per channel and runs them within a rate-limit budget.
+    
+    Each channel has a bounded queue drained by one worker task. Before each
+    repost it waits until the oldest of the channel's last CHANNEL_RATE
+    sends finished CHANNEL_RATE_PER seconds ago, so no window of that
+    length, wherever Discord starts it, sees more sends than allowed. A
+    global semaphore caps how many reposts are talking to Discord at once,
+    so a flooded channel can't starve quiet ones. When a channel's queue is full the
+    overflow policy decides what happens to the new message:
+    
+    - "drop_oldest": the oldest queued repost is dropped (that message keeps its trackers)
+    - "delete_only": the new message is deleted without a repost, and one
+      summary message is posted once the channel's queue drains
+    
+    History sweeps repost through repost_paced(), which takes its turn in
+    the same channel budget without going through the queue.
+    """
+
+    def __init__(self, queue_size: int, max_inflight: int, overflow_policy: str):
+        self._channels = {}
+        self.dropped = 0
+        self.deleted_only = 0
+        self.completed = 0
+        self.inflight = 0
+        self.configure(queue_size, max_inflight, overflow_policy)
+
+    def configure(self, queue_size: int, max_inflight: int, overflow_policy: str) -> None:
+        """Apply new limits; queued work is kept."""
+        self.queue_size = max(1, int(queue_size))
+        self.max_inflight = max(1, int(max_inflight))
+        self.overflow_policy = overflow_policy if overflow_policy in OVERFLOW_POLICIES else "drop_oldest"
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+
+    def _channel(self, channel_id: int) -> ChannelQueue:
+        state = self._channels.get(channel_id)
+        if state is None:
+            state = self._channels[channel_id] = ChannelQueue()
+        return state
+
+    def submit(self, message, companies, sanitized_message: str) -> None:
+        """Queue a repost. Never blocks; overflow is handled by the policy."""
+        loop = asyncio.get_running_loop()
+        state = self._channel(message.channel.id)
+
+        if len(state.jobs) >= self.queue_size:
+            if self.overflow_policy == "delete_only":
+                if len(state.deletions) < self.queue_size * 10:
+                    state.deletions.append(message)
+                    state.summary.update(companies)
+                else:
+                    self.dropped += 1
+            else:
+                state.jobs.popleft()
+                state.jobs.append((message, companies, sanitized_message))
+                self.dropped += 1
+        else:
+            state.jobs.append((message, companies, sanitized_message))
+
+        if state.task is None:
+            state.task = loop.create_task(self._drain(message.channel.id, state))
+
+    async def repost_paced(self, message, companies, sanitized_message: str) -> None:
+        """Repost a message right away, waiting for its turn in the channel's send budget."""
+        channel_id = message.channel.id
+        state = self._channel(channel_id)
+        try:
+            async with state.lock:
+                await self._wait_for_window(state)
+                await self._repost(state, (message, companies, sanitized_message))
+        finally:
+            if state.task is None and not state.jobs and not state.deletions:
+                asyncio.get_running_loop().call_later(CHANNEL_RATE_PER, self._forget, channel_id, state)
+
+    async def _repost(self, state: ChannelQueue, job: tuple) -> None:
+        async with self._inflight:
+            self.inflight += 1
+            try:
+                await process_repost(*job)
+            finally:
+                self.inflight -= 1
+                self._record_send(state)
+
+    @staticmethod
+    async def _wait_for_window(state: ChannelQueue) -> None:
+        """Wait until one more send fits in the channel's sliding window."""
+        loop = asyncio.get_running_loop()
+        while len(state.sent) == CHANNEL_RATE:
+            wait = state.sent[0] + CHANNEL_RATE_PER - loop.time()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    @staticmethod
+    def _record_send(state: ChannelQueue) -> None:
+        # Stamped when the send finished, which is never before Discord counted it
+        state.sent.append(asyncio.get_running_loop().time())
+
+    async def _drain(self, channel_id: int, state: ChannelQueue) -> None:
+        try:
+            while state.jobs or state.deletions:
+                if state.jobs:
+                    async with state.lock:
+                        await self._wait_for_window(state)
+                        if not state.jobs:
+                            continue
+                        await self._repost(state, state.jobs.popleft())
+                    self.completed += 1
+                    continue
+
+                # Deletes use a separate Discord bucket, so they don't count as sends
+                message = state.deletions.popleft()
+                async with self._inflight:
+                    try:
+                        await message.delete()
+                        self.deleted_only += 1
+                    except discord.HTTPException as e:
+                        log.warning("Error deleting message during overflow: %s", e, extra=message_context(message))
+
+                if not state.deletions and not state.jobs and state.summary:
+                    companies, state.summary = state.summary, set()
+                    async with state.lock:
+                        await self._wait_for_window(state)
+                        try:
+                            await message.channel.send(
+                                "Removed several messages containing trackers from "
+                                f"{format_companies(sorted(companies))} during a burst of links.",
+                                allowed_mentions=discord.AllowedMentions.none()
+                            )
+                        except discord.HTTPException as e:
+                            log.warning("Error posting overflow summary: %s", e, extra=channel_context(message.channel))
+                        finally:
+                            self._record_send(state)
+        finally:
+            state.task = None
+            if not state.jobs and not state.deletions:
+                # The send history limits the next reposts for a while, so keep it until then
+                asyncio.get_running_loop().call_later(CHANNEL_RATE_PER, self._forget, channel_id, state)
 
-def has_link(message: str) -> bool:
-    return bool(REGEX.search(message))
+    def _forget(self, channel_id: int, state: ChannelQueue) -> None:
+        """Drop an idle channel once its last send no longer counts against the limit."""
+        if state.task is not None or state.jobs or state.deletions or state.lock.locked():
+            return
+        if self._channels.get(channel_id) is not state:
+            return
+        if state.sent and state.sent[-1] + CHANNEL_RATE_PER > asyncio.get_running_loop().time():
+            return  # Sent again since, a later call drops it
+        del self._channels[channel_id]
 
-def has_trackers(url):
-    parsed = urlparse(url)
-    for key, _ in parse_qsl(parsed.query, keep_blank_values=True):
-        if key.lower() in PARAM_INDEX:
-            return True
-    return False
+    def stats(self) -> dict:
+        """Return queue-depth and outcome counters."""
+        depths = [len(state.jobs) + len(state.deletions) for state in self._channels.values() if state.task is not None]
+        return {
+            "channels": len(depths),
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            "inflight": self.inflight,
+            "completed": self.completed,
+            "dropped": self.dropped,
+            "deleted_only": self.deleted_only
+        }
 
-def build_param_index(tracker_map):
-    index = {}
-    for company, params in tracker_map.items():
-        for param in params:
-            index[param] = company
-    return index
-
-def clean_url(url):
-    parsed = urlparse(url)
-    kept = []
-    removed = {}
-
-    for key, value in parse_qsl(parsed.query, keep_blank_values=True):
-        owner = PARAM_INDEX.get(key.lower())
-        if owner:
-            removed.setdefault(owner, []).append(key)
-        else:
-            kept.append((key, value))
-
-    cleaned_url = urlunparse((
-        parsed.scheme,
-        parsed.netloc,
-        parsed.path,
-        parsed.params,
-        urlencode(kept),
-        parsed.fragment
-    ))
-
-    if removed:
-        message = f"Removed trackers from {', '.join(removed.keys())}"
-    else:
-        message = "No trackers found"
+repost_scheduler = RepostScheduler(
+    config.get("repost_queue_size", default_config["repost_queue_size"]),
+    config.get("repost_max_inflight", default_config["repost_max_inflight"]),
+    config.get("repost_overflow_policy", default_config["repost_overflow_policy"])
+)
 
-    return {
-        "clean_url": cleaned_url,
-        "removed_trackers": removed,
-        "message": message
-    }
+EDIT_WINDOW_SECONDS = 3600.0
+SEEN_MESSAGES_SIZE = 20000
 
-def format_companies(companies):
-    """Return a nicely formatted string with commas and 'and' before the last item."""
-    companies = list(companies)  # ensure it's a list
-    if len(companies) == 0:
-        return ""
-    elif len(companies) == 1:
-        return companies[0]
-    else:
-        return ", ".join(companies[:-1]) + f", and {companies[-1]}"
+def link_fingerprint(content: str) -> int:
+    """Hash of the parts of a message that could be links; edits elsewhere leave it unchanged."""
+    return hash(tuple(token for token in content.split() if '/' in token or '?' in token or '.' in token))
 
-def load_config():
-    """Load configuration from JSON file."""
-    global config, mention_reply_author, require_links, REGEX
-    with open(CONFIG_PATH, 'r', encoding="utf-8") as f:
-        config = json.load(f)
-    
-    mention_reply_author = config.get("mention_reply_author", default_config["mention_reply_author"])
-    require_links = config.get("require_links", default_config["require_links"])
+class SeenMessages:
+    """
+    Bounded, time-windowed map of message ID -> link fingerprint.
     
-    try:
-        REGEX = re.compile(config.get("regex_keys", default_config["regex_keys"]))
-    except re.error as e:
-        raise RuntimeError(f"Invalid regex in config.json: {e}")
+    Entries are kept in insertion order, so expired entries are always at
+    the front and are dropped from there.
+    """
 
-def save_config():
-    """Save current configuration to JSON file."""
-    with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
-        json.dump(config, f, indent=4)
+    def __init__(self, max_size: int, window: float):
+        self.max_size = max_size
+        self.window = window
+        self._entries = OrderedDict()  # message ID -> (seen at, fingerprint)
 
-def load_trackers():
-    """Load trackers from JSON file."""
-    global trackers, PARAM_INDEX
-    with open(TRACKERS_PATH, 'r', encoding="utf-8") as f:
-        trackers = json.load(f)
-    PARAM_INDEX = {param.lower(): company for company, params in trackers.items() for param in params}
+    def get(self, message_id: int):
+        entry = self._entries.get(message_id)
+        return entry[1] if entry is not None else None
 
-def save_trackers():
-    """Save current trackers to JSON file."""
-    with open(TRACKERS_PATH, 'w', encoding='utf-8') as f:
-        json.dump(trackers, f, indent=4)
-#--------------------------------------------------------------------
-# Main Program
-#--------------------------------------------------------------------
+    def update(self, message_id: int, fingerprint: int) -> bool:
+        """Store a message's fingerprint. Returns False if it was already stored with that fingerprint."""
+        now = time.monotonic()
+        entries = self._entries
+        while entries:
+            oldest = next(iter(entries.values()))
+            if now - oldest[0] < self.window:
+                break
+            entries.popitem(last=False)
 
-intents = discord.Intents.default()
-intents.message_content = True
+        entry = entries.get(message_id)
+        if entry is not None and entry[1] == fingerprint:
+            return False
+        entries[message_id] = (now, fingerprint)
+        entries.move_to_end(message_id)
+        if len(entries) > self.max_size:
+            entries.popitem(last=False)
+        return True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+seen_messages = SeenMessages(SEEN_MESSAGES_SIZE, EDIT_WINDOW_SECONDS)
 
-@bot.event
-async def on_ready():
-    print(f'Logged in as {bot.user}!')
-    try:
-        synced = await bot.tree.sync()
-        print(f"Synced {len(synced)} command(s)")
-    except Exception as e:
-        print(f"Failed to sync commands: {e}")
+def is_own_message(message) -> bool:
+    if message.author == bot.user:
+        return True
+    return message.webhook_id is not None and message.webhook_id in own_webhook_ids
 
 @bot.event
 async def on_message(message):
-    if message.author == bot.user:
+    if is_own_message(message):
         return
     
     # Process commands first
     await bot.process_commands(message)
-    
-    if not (has_link(message.content) and require_links):
-        return  
+    await clean_message(message)
+
+@bot.event
+async def on_raw_message_edit(payload):
+    """Clean messages that had trackers edited in after they were posted."""
+    data = payload.data
+    # Embed unfurls and other non-user updates don't set edited_timestamp
+    if data.get("edited_timestamp") is None or "content" not in data:
+        return
+    message = payload.message
+    if is_own_message(message):
+        return
+
+    # Seed from the message cache, so the first edit of a recent message is compared too
+    if seen_messages.get(message.id) is None and payload.cached_message is not None:
+        seen_messages.update(message.id, link_fingerprint(payload.cached_message.content))
+    if not seen_messages.update(message.id, link_fingerprint(message.content)):
+        return
+    await clean_message(message)
 
-    urls = re.findall(REGEX, message.content)
-    if not urls:
+async def clean_message(message):
+    """Scan a message and queue a cleaned repost if it has trackers."""
+    state = await guild_states.get(message.guild.id if message.guild else None)
+    if not state.require_links:
         return
 
+    detected_companies, replacements = await find_trackers(
+        state, message.content, expand_shorteners, message.guild.id if message.guild else 0
+    )
+    if detected_companies:
+        start = time.perf_counter()
+        sanitized_message = sanitize_message(message.content, replacements)
+        STAGE_SECONDS.observe(time.perf_counter() - start, ("rewrite",))
+        repost_scheduler.submit(message, detected_companies, sanitized_message)
+
+async def find_trackers(state, content: str, expand_links: bool, hits_guild_id: int = None) -> tuple:
+    """
+    Find the links with trackers in a message.
+    
+    Args:
+        state: GuildState of the message's server
+        content: Message content
+        expand_links: Whether to resolve short links
+        hits_guild_id: Count the removed params for /stats under this guild ID (0 for DMs, None to not count them)
+    
+    Returns:
+        tuple: (set of providers, list of (start, end, cleaned URL) for sanitize_message)
+    """
     detected_companies = set()
-    sanitized_map = {}  
+    replacements = []
 
-    for url in urls:
-        result = clean_url(url)
+    # One pass: rejects link-free and tracker-free messages before any parsing
+    start = time.perf_counter()
+    spans = await scan_message(state.scanner, content)
+    scanned = time.perf_counter()
+    STAGE_SECONDS.observe(scanned - start, ("scanner",))
+    MESSAGES_SCANNED.inc()
+    short_links = {}  # link -> spans it replaces
+    if expand_links:
+        for match in SHORTENER_RE.finditer(content):
+            span = match.span()
+            overlapping = next(((start, end) for start, end in spans if start < span[1] and span[0] < end), None)
+            if overlapping is not None:
+                # A short link with a query string is also one of the scanner's URLs; replace all of it,
+                # but leave alone URLs that only contain a short link somewhere after their own host
+                if overlapping[0] != span[0] or not url_expander.is_short_link(content[overlapping[0]:overlapping[1]]):
+                    continue
+                span = overlapping
+            short_links.setdefault(match.group(), []).append(span)
+    if not spans and not short_links:
+        return detected_companies, replacements
+    MESSAGES_WITH_LINKS.inc()
+
+    for url_start, url_end in spans:
+        result = state.clean_url(content[url_start:url_end])
         if result["removed_trackers"]:
             detected_companies.update(result["removed_trackers"].keys())
-            sanitized_map[url] = result["clean_url"]
+            replacements.append((url_start, url_end, result["clean_url"]))
+            URLS_CLEANED.inc()
+            for provider, params in result["removed_trackers"].items():
+                TRACKERS_REMOVED.inc(len(params), (provider,))
+                if hits_guild_id is not None:
+                    tracker_hits.record(hits_guild_id, provider, params)
+    cleaned = time.perf_counter()
+    STAGE_SECONDS.observe(cleaned - scanned, ("clean_url",))
 
-    if detected_companies:
+    if short_links:
+        # Only this message waits for the lookups, other messages keep being handled
+        targets = await asyncio.gather(*(url_expander.expand(link) for link in short_links))
+        expanded = []
+        for link_spans, target in zip(short_links.values(), targets):
+            if target is None:
+                continue
+            result = state.clean_url(target)
+            if result["removed_trackers"]:
+                detected_companies.update(result["removed_trackers"].keys())
+                for link_start, link_end in link_spans:
+                    expanded.append((link_start, link_end, result["clean_url"]))
+                URLS_CLEANED.inc()
+                if hits_guild_id is not None:
+                    for provider, params in result["removed_trackers"].items():
+                        tracker_hits.record(hits_guild_id, provider, params)
+        if expanded:
+            # The expanded target wins over the short link cleaned as it was
+            spans_expanded = {(start, end) for start, end, _ in expanded}
+            replacements = [r for r in replacements if (r[0], r[1]) not in spans_expanded]
+            replacements.extend(expanded)
+        STAGE_SECONDS.observe(time.perf_counter() - cleaned, ("expand",))
+
+    return detected_companies, replacements
+
+#--------------------------------------------------------------------
+# History Sweep
+#--------------------------------------------------------------------
+
+SWEEP_MODES = ("report", "clean")
+SWEEP_BATCH_SIZE = 100  # Messages per history request, Discord's maximum
+SWEEP_PAGE_DELAY = 1.0  # Seconds between history requests in one channel
+SWEEP_REPOST_DELAY = 1.0  # Seconds between reposts in one channel, in clean mode
+SWEEP_REPORT_LINKS = 500  # Message links kept for the report
+
+class ChannelProgress:
+    """Checkpoint of one channel in a sweep: everything older than before_id is left."""
+
+    __slots__ = ("channel_id", "before_id", "scanned", "found", "cleaned", "done")
+
+    def __init__(self, channel_id: int, before_id=None, scanned=0, found=0, cleaned=0, done=False):
+        self.channel_id = channel_id
+        self.before_id = before_id
+        self.scanned = scanned
+        self.found = found
+        self.cleaned = cleaned
+        self.done = bool(done)
+
+class HistorySweep:
+    """
+    Walks the history of a server's channels, newest to oldest, looking for trackers.
+    
+    In "report" mode messages with trackers are only counted and linked; in
+    "clean" mode they are reposted like new messages. Each channel's progress
+    is saved to guilds.db after every batch, so a restarted bot resumes the
+    sweep where it stopped. At most max_channels channels are swept at once.
+    """
+
+    def __init__(self, guild, mode: str, started_at: str, channels: dict, max_channels: int):
+        self.guild = guild
+        self.mode = mode
+        self.started_at = started_at
+        self.channels = channels  # channel ID -> ChannelProgress
+        self.max_channels = max(1, int(max_channels))
+        self.found_links = deque(maxlen=SWEEP_REPORT_LINKS)
+        self.task = None
+
+    def totals(self) -> dict:
+        progress = self.channels.values()
+        return {
+            "channels": len(self.channels),
+            "channels_done": sum(1 for channel in progress if channel.done),
+            "scanned": sum(channel.scanned for channel in progress),
+            "found": sum(channel.found for channel in progress),
+            "cleaned": sum(channel.cleaned for channel in progress),
+        }
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self) -> None:
+        semaphore = asyncio.Semaphore(self.max_channels)
+
+        async def sweep_with_limit(progress):
+            async with semaphore:
+                await self.sweep_channel(progress)
+
+        pending = [progress for progress in self.channels.values() if not progress.done]
+        tasks = [asyncio.create_task(sweep_with_limit(progress)) for progress in pending]
         try:
-            reply = await message.reply(">>>")
-            await message.delete()
-            sanitized_message = message.content
-            for original, cleaned in sanitized_map.items():
-                sanitized_message = sanitized_message.replace(original, cleaned)
-
-            # Use mention_reply_author setting
-            author_mention = f"{message.author.mention} " if mention_reply_author else ""
-            notice = (
-                f"{author_mention}Your message has been reposted without trackers from "
-                f"{format_companies(detected_companies)}:"
-            )
+            await asyncio.gather(*tasks)
+            await guild_db.finish_sweep(self.guild.id)
+            log.info("History sweep finished: %s", self.totals(), extra={"guild_id": self.guild.id})
+        except Exception:
+            # The checkpoint stays in guilds.db, so the sweep resumes after a restart
+            log.exception("History sweep stopped: %s", self.totals(), extra={"guild_id": self.guild.id})
+        finally:
+            for task in tasks:
+                task.cancel()
+            if history_sweeps.get(self.guild.id) is self:
+                del history_sweeps[self.guild.id]
 
-            await reply.edit(content=f"{notice}\n{sanitized_message}")
-        
-        except discord.Forbidden:
-            print("Bot lacks permission to delete messages.")
-        except Exception as e:
-            print(f"Error handling message: {e}")
+    async def sweep_channel(self, progress: ChannelProgress) -> None:
+        channel = self.guild.get_channel(progress.channel_id)
+        if channel is None:
+            progress.done = True
+            await guild_db.save_sweep_channel(self.guild.id, progress)
+            return
+
+        try:
+            await self.sweep_messages(channel, progress)
+        except (discord.HTTPException, sqlite3.Error):
+            # Only this channel is given up on, the others carry on
+            log.exception("History sweep stopped in channel after %d messages", progress.scanned, extra=channel_context(channel))
+            progress.done = True
+            await guild_db.save_sweep_channel(self.guild.id, progress)
+
+    async def sweep_messages(self, channel, progress: ChannelProgress) -> None:
+        state = await guild_states.get(self.guild.id)
+        while not progress.done:
+            before = discord.Object(id=progress.before_id) if progress.before_id else None
+            try:
+                messages = [message async for message in channel.history(limit=SWEEP_BATCH_SIZE, before=before)]
+            except discord.Forbidden:
+                log.warning("History sweep skipped channel: missing Read Message History permission", extra=channel_context(channel))
+                messages = []
+            if not messages:
+                progress.done = True
+            for message in messages:
+                if is_own_message(message):
+                    continue
+                progress.scanned += 1
+                companies, replacements = await find_trackers(state, message.content, False)
+                if not companies:
+                    continue
+                progress.found += 1
+                self.found_links.append(f"{message.jump_url} ({format_companies(companies)})")
+                if self.mode == "clean":
+                    # Shares the channel's send budget with live reposts
+                    await repost_scheduler.repost_paced(message, companies, sanitize_message(message.content, replacements))
+                    progress.cleaned += 1
+                    await asyncio.sleep(SWEEP_REPOST_DELAY)
+            if messages:
+                progress.before_id = messages[-1].id
+            await guild_db.save_sweep_channel(self.guild.id, progress)
+            if not progress.done:
+                await asyncio.sleep(SWEEP_PAGE_DELAY)
+
+history_sweeps = {}  # guild ID -> HistorySweep
+sweeps_resumed = False
+
+async def start_history_sweep(guild, mode: str, channel_ids: list) -> HistorySweep:
+    """Start a new sweep of a server, replacing any earlier checkpoint."""
+    started_at = datetime.now().isoformat(timespec='seconds')
+    channels = {channel_id: ChannelProgress(channel_id) for channel_id in channel_ids}
+    await guild_db.start_sweep(guild.id, mode, started_at, channel_ids)
+    sweep = HistorySweep(
+        guild, mode, started_at, channels,
+        config.get("sweep_max_channels", default_config["sweep_max_channels"])
+    )
+    history_sweeps[guild.id] = sweep
+    sweep.start()
+    return sweep
+
+async def resume_history_sweeps() -> None:
+    """Resume the unfinished sweeps of the servers this process handles."""
+    for guild_id, mode, started_at, channels in await guild_db.load_sweeps():
+        guild = bot.get_guild(guild_id)
+        if guild is None or guild_id in history_sweeps:
+            continue  # Another shard worker's server
+        sweep = HistorySweep(
+            guild, mode, started_at, channels,
+            config.get("sweep_max_channels", default_config["sweep_max_channels"])
+        )
+        history_sweeps[guild_id] = sweep
+        sweep.start()
+        log.info("Resumed history sweep started at %s", started_at, extra={"guild_id": guild_id})
 
 #--------------------------------------------------------------------
 # Admin Commands
@@ -353,24 +2388,63 @@ async def settings(interaction: discord.Interaction):
         await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
         return
     
-    load_config()
+    # Show what applies in this server, including /server overrides
+    state = await guild_states.get(interaction.guild_id)
     embed = discord.Embed(
         title="Bot Settings",
         color=discord.Color.blue()
     )
     embed.add_field(
         name="Mention Reply Author",
-        value="✅ Enabled" if mention_reply_author else "❌ Disabled",
+        value="✅ Enabled" if state.mention_reply_author else "❌ Disabled",
         inline=False
     )
     embed.add_field(
         name="Require Links",
-        value="✅ Enabled" if require_links else "❌ Disabled",
+        value="✅ Enabled" if state.require_links else "❌ Disabled",
+        inline=False
+    )
+    embed.add_field(
+        name="Repost Mode",
+        value=f"`{state.repost_mode}`",
+        inline=False
+    )
+    queue_stats = repost_scheduler.stats()
+    embed.add_field(
+        name="Repost Queue",
+        value=(
+            f"{queue_stats['queued']} queued in {queue_stats['channels']} channel(s) "
+            f"(deepest {queue_stats['max_depth']}/{repost_scheduler.queue_size}), "
+            f"{queue_stats['inflight']}/{repost_scheduler.max_inflight} in flight, "
+            f"{queue_stats['completed']} done, {queue_stats['dropped']} dropped, "
+            f"{queue_stats['deleted_only']} deleted without repost "
+            f"(overflow: `{repost_scheduler.overflow_policy}`)"
+        ),
         inline=False
     )
     embed.add_field(
         name="Regex Pattern",
-        value=f"`{config.get('regex_keys', 'N/A')[:100]}...`" if len(config.get('regex_keys', '')) > 100 else f"`{config.get('regex_keys', 'N/A')}`",
+        value=f"`{state.regex_keys[:100]}...`" if len(state.regex_keys) > 100 else f"`{state.regex_keys}`",
+        inline=False
+    )
+    overrides = guild_overrides.get(interaction.guild_id)
+    if overrides is not None and (overrides.settings or overrides.trackers):
+        embed.add_field(
+            name="Server Overrides",
+            value=(
+                f"{len(overrides.settings)} setting(s), {len(overrides.trackers)} tracker change(s). "
+                f"Use `/server reset` to go back to the global settings."
+            ),
+            inline=False
+        )
+    cache_stats = CLEAN_CACHE.stats()
+    embed.add_field(
+        name="URL Cache",
+        value=(
+            f"{cache_stats['size']}/{cache_stats['max_size']} entries, "
+            f"{cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+            f"{cache_stats['evictions']} evictions"
+        ),
         inline=False
     )
     
@@ -384,10 +2458,9 @@ async def set_mention(interaction: discord.Interaction, enabled: bool):
         await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
         return
     
-    global mention_reply_author
     config["mention_reply_author"] = enabled
     save_config()
-    load_config()
+    apply_config()
     
     await interaction.response.send_message(
         f"✅ Mention reply author has been {'enabled' if enabled else 'disabled'}.",
@@ -402,16 +2475,34 @@ async def set_require_links(interaction: discord.Interaction, enabled: bool):
         await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
         return
     
-    global require_links
     config["require_links"] = enabled
     save_config()
-    load_config()
+    apply_config()
     
     await interaction.response.send_message(
         f"✅ Require links has been {'enabled' if enabled else 'disabled'}.",
         ephemeral=True
     )
 
+@bot.tree.command(name="set_repost_mode", description="Choose how cleaned messages are reposted")
+@app_commands.describe(mode="reply: one message, webhook: post as the author, edit: legacy reply-then-edit")
+@app_commands.choices(mode=[app_commands.Choice(name=mode, value=mode) for mode in REPOST_MODES])
+async def set_repost_mode(interaction: discord.Interaction, mode: app_commands.Choice[str]):
+    """Set how cleaned messages are reposted."""
+    if not is_admin(interaction):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    
+    config["repost_mode"] = mode.value
+    save_config()
+    apply_config()
+    
+    note = "\n\nThe bot needs the **Manage Webhooks** permission for this mode." if mode.value == "webhook" else ""
+    await interaction.response.send_message(
+        f"✅ Repost mode has been set to `{mode.value}`.{note}",
+        ephemeral=True
+    )
+
 @bot.tree.command(name="set_regex", description="Set the regex pattern used to detect URLs")
 @app_commands.describe(pattern="The regex pattern to use for URL detection")
 async def set_regex(interaction: discord.Interaction, pattern: str):
@@ -430,13 +2521,19 @@ async def set_regex(interaction: discord.Interaction, pattern: str):
         )
         return
     
-    global REGEX
+    # A pathological pattern would stall every message, benchmark it first
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    error, report = await check_regex(pattern)
+    if error:
+        await interaction.followup.send(f"❌ {error}\n\n{report}", ephemeral=True)
+        return
+    
     config["regex_keys"] = pattern
     save_config()
-    load_config()
+    apply_config()
     
-    await interaction.response.send_message(
-        f"✅ Regex pattern has been updated.\n\nNew pattern: `{pattern}`",
+    await interaction.followup.send(
+        f"✅ Regex pattern has been updated.\n\nNew pattern: `{pattern}`\n\n{report}",
         ephemeral=True
     )
 
@@ -448,11 +2545,90 @@ async def reload_config(interaction: discord.Interaction):
         return
     
     try:
-        load_config()
+        await reload_config_from_disk()
         await interaction.response.send_message("✅ Configuration reloaded successfully.", ephemeral=True)
     except Exception as e:
         await interaction.response.send_message(f"❌ Error reloading configuration: {e}", ephemeral=True)
 
+@bot.tree.command(name="profile", description="Profile the bot for a few seconds and get the hottest functions")
+@app_commands.describe(seconds=f"How long to profile (1-{PROFILE_MAX_SECONDS} seconds)")
+async def profile(interaction: discord.Interaction, seconds: app_commands.Range[int, 1, PROFILE_MAX_SECONDS] = 15):
+    """Capture a cProfile report and event loop lag while the bot handles live traffic."""
+    if not is_admin(interaction):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        lag_summary, report = await capture_profile(seconds)
+    except ProfilerBusy:
+        await interaction.followup.send("❌ A profile is already being captured, try again when it's done.", ephemeral=True)
+        return
+    
+    await interaction.followup.send(
+        f"✅ Profiled for {seconds}s.\n{lag_summary}",
+        file=discord.File(io.BytesIO(report.encode("utf-8")), filename="profile.txt"),
+        ephemeral=True
+    )
+
+STATS_TOP = 15
+
+@bot.tree.command(name="stats", description="Show which trackers were removed in the last 24 hours")
+@app_commands.describe(scope="This server only, or every server this bot process handles (also lists rules that never matched)")
+@app_commands.choices(scope=[
+    app_commands.Choice(name="This server", value="server"),
+    app_commands.Choice(name="All servers", value="all")
+])
+async def stats(interaction: discord.Interaction, scope: app_commands.Choice[str] = None):
+    """Show tracker hits from the in-memory counters."""
+    if not is_admin(interaction):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    
+    everywhere = scope is not None and scope.value == "all"
+    totals = tracker_hits.totals(None if everywhere else interaction.guild_id)
+    hours = STATS_BUCKETS * STATS_BUCKET_SECONDS // 3600
+    embed = discord.Embed(
+        title=f"Tracker Hits (last {hours} hours)",
+        description="All servers handled by this bot process" if everywhere else "This server",
+        color=discord.Color.blue()
+    )
+    
+    if not totals:
+        embed.add_field(name="Providers", value="No trackers removed yet.", inline=False)
+    else:
+        providers = {}
+        for (provider, _), hits in totals.items():
+            providers[provider] = providers.get(provider, 0) + hits
+        top_providers = sorted(providers.items(), key=lambda item: -item[1])[:STATS_TOP]
+        embed.add_field(
+            name="Providers",
+            value="\n".join(f"**{provider}**: {hits}" for provider, hits in top_providers)[:1024],
+            inline=False
+        )
+        top_params = sorted(totals.items(), key=lambda item: -item[1])[:STATS_TOP]
+        embed.add_field(
+            name="Parameters",
+            value="\n".join(f"`{param}` ({provider}): {hits}" for (provider, param), hits in top_params)[:1024],
+            inline=False
+        )
+    
+    if everywhere:
+        # Worth pruning: rules that cost lookups but never fired
+        idle = rules_without_hits(totals)
+        if idle:
+            listed = ", ".join(f"`{rule}` ({provider})" for provider, rule in idle)
+            if len(listed) > 1000:
+                listed = listed[:1000].rsplit(", ", 1)[0] + ", ..."
+            embed.add_field(name=f"Rules Without Hits ({len(idle)})", value=listed, inline=False)
+    
+    footer = f"{len(tracker_hits.slots)}/{tracker_hits.max_keys} counters in use"
+    if tracker_hits.untracked:
+        footer += f" · {tracker_hits.untracked} hits only saved to guilds.db (counters full)"
+    embed.set_footer(text=footer)
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 #--------------------------------------------------------------------
 # Tracker Management Commands
 #--------------------------------------------------------------------
@@ -466,9 +2642,7 @@ async def trackers_list(interaction: discord.Interaction):
         await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
         return
     
-    load_trackers()
-    
-    if not trackers:
+    if not len(REGISTRY):
         await interaction.response.send_message("❌ No trackers configured.", ephemeral=True)
         return
     
@@ -483,7 +2657,7 @@ async def trackers_list(interaction: discord.Interaction):
     total_length = 0
     fields_added = 0
     
-    for provider, params in sorted(trackers.items()):
+    for provider, params in sorted(REGISTRY.providers()):
         if not params:
             continue
         
@@ -513,21 +2687,22 @@ async def trackers_list(interaction: discord.Interaction):
         total_length += len(field_value) + len(provider)
         fields_added += 1
     
-    embed.set_footer(text=f"Total providers: {len(trackers)}")
+    footer = f"Total providers: {sum(1 for _ in REGISTRY.providers())}"
+    if REGISTRY.imported_count:
+        footer += f" · Plus {REGISTRY.imported_count} rules imported from filter lists"
+    embed.set_footer(text=footer)
     
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @trackers_group.command(name="add", description="Add a tracker parameter to a provider")
 @app_commands.describe(provider="The provider name (e.g., Google, Meta)")
-@app_commands.describe(tracker="The tracker parameter name to add")
+@app_commands.describe(tracker="The tracker parameter name to add (supports utm_* globs, re:<regex> rules and param@domain scopes)")
 async def trackers_add(interaction: discord.Interaction, provider: str, tracker: str):
     """Add a tracker parameter to a provider."""
     if not is_admin(interaction):
         await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
         return
     
-    load_trackers()
-    
     # Normalize provider name (capitalize first letter)
     provider_normalized = provider.strip()
     if provider_normalized:
@@ -539,13 +2714,13 @@ async def trackers_add(interaction: discord.Interaction, provider: str, tracker:
         await interaction.response.send_message("❌ Tracker parameter name cannot be empty.", ephemeral=True)
         return
     
-    # Check if tracker already exists for any provider
-    tracker_lower = tracker_normalized.lower()
-    existing_provider = None
-    for prov, params in trackers.items():
-        if tracker_lower in [p.lower() for p in params]:
-            existing_provider = prov
-            break
+    error = rule_error(tracker_normalized)
+    if error is not None:
+        await interaction.response.send_message(f"❌ Invalid tracker regex: {error}", ephemeral=True)
+        return
+    
+    # Check if tracker already exists for any provider; imported rules can be overridden, like in trackers.json
+    existing_provider = REGISTRY.lookup(tracker_normalized, imported=False)
     
     if existing_provider:
         if existing_provider == provider_normalized:
@@ -561,15 +2736,19 @@ async def trackers_add(interaction: discord.Interaction, provider: str, tracker:
             )
         return
     
-    # Add tracker to provider
-    if provider_normalized not in trackers:
-        trackers[provider_normalized] = []
+    # Compiling large imported rule sets can outlast Discord's 3 second reply deadline
+    await interaction.response.defer(ephemeral=True, thinking=True)
     
-    trackers[provider_normalized].append(tracker_normalized)
+    # Add tracker to provider; it is only saved once the rules compiled with it
+    REGISTRY.add(provider_normalized, tracker_normalized)
+    try:
+        await publish_trackers()
+    except Exception:
+        REGISTRY.remove(provider_normalized, tracker_normalized)
+        raise
     save_trackers()
-    load_trackers()  # Reload to update PARAM_INDEX
     
-    await interaction.response.send_message(
+    await interaction.followup.send(
         f"✅ Added tracker `{tracker_normalized}` to provider `{provider_normalized}`.",
         ephemeral=True
     )
@@ -583,8 +2762,6 @@ async def trackers_remove(interaction: discord.Interaction, provider: str, track
         await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
         return
     
-    load_trackers()
-    
     # Normalize provider name (capitalize first letter)
     provider_normalized = provider.strip()
     if provider_normalized:
@@ -592,7 +2769,7 @@ async def trackers_remove(interaction: discord.Interaction, provider: str, track
     
     tracker_normalized = tracker.strip()
     
-    if provider_normalized not in trackers:
+    if not REGISTRY.has_provider(provider_normalized):
         await interaction.response.send_message(
             f"❌ Provider `{provider_normalized}` not found.",
             ephemeral=True
@@ -600,39 +2777,256 @@ async def trackers_remove(interaction: discord.Interaction, provider: str, track
         return
     
     # Find and remove tracker (case-insensitive)
-    tracker_lower = tracker_normalized.lower()
-    found = False
-    for i, param in enumerate(trackers[provider_normalized]):
-        if param.lower() == tracker_lower:
-            removed_tracker = trackers[provider_normalized].pop(i)
-            found = True
-            break
+    removed_tracker = REGISTRY.remove(provider_normalized, tracker_normalized)
     
-    if not found:
+    if removed_tracker is None:
         await interaction.response.send_message(
             f"❌ Tracker `{tracker_normalized}` not found for provider `{provider_normalized}`.",
             ephemeral=True
         )
         return
     
-    # Remove provider if it has no trackers left
-    if not trackers[provider_normalized]:
-        del trackers[provider_normalized]
-        save_trackers()
-        load_trackers()
-        await interaction.response.send_message(
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    save_trackers()
+    await publish_trackers()
+    
+    # The registry drops providers that have no trackers left
+    if not REGISTRY.has_provider(provider_normalized):
+        await interaction.followup.send(
             f"✅ Removed tracker `{tracker_normalized}` from provider `{provider_normalized}`. "
             f"Provider `{provider_normalized}` has been removed as it has no trackers left.",
             ephemeral=True
         )
     else:
-        save_trackers()
-        load_trackers()  # Reload to update PARAM_INDEX
-        await interaction.response.send_message(
+        await interaction.followup.send(
             f"✅ Removed tracker `{tracker_normalized}` from provider `{provider_normalized}`.",
             ephemeral=True
         )
 
 bot.tree.add_command(trackers_group)
 
-bot.run(bot_token)
+#--------------------------------------------------------------------
+# Per-server Commands
+#--------------------------------------------------------------------
+
+server_group = app_commands.Group(name="server", description="Override settings for this server only", guild_only=True)
+
+async def update_guild_setting(interaction: discord.Interaction, key: str, value, message: str):
+    """Shared body of the /server set_* commands."""
+    if not is_admin(interaction):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    
+    await set_guild_setting(interaction.guild_id, key, value)
+    await interaction.response.send_message(f"✅ {message} for this server.", ephemeral=True)
+
+@server_group.command(name="set_mention", description="Enable or disable mentioning the author in this server")
+@app_commands.describe(enabled="Whether to mention the author when reposting")
+async def server_set_mention(interaction: discord.Interaction, enabled: bool):
+    """Set whether to mention the author when reposting messages in this server."""
+    await update_guild_setting(
+        interaction, "mention_reply_author", enabled,
+        f"Mention reply author has been {'enabled' if enabled else 'disabled'}"
+    )
+
+@server_group.command(name="set_require_links", description="Enable or disable link processing in this server")
+@app_commands.describe(enabled="Whether to process messages that contain links")
+async def server_set_require_links(interaction: discord.Interaction, enabled: bool):
+    """Set whether to process messages with links in this server."""
+    await update_guild_setting(
+        interaction, "require_links", enabled,
+        f"Require links has been {'enabled' if enabled else 'disabled'}"
+    )
+
+@server_group.command(name="set_repost_mode", description="Choose how cleaned messages are reposted in this server")
+@app_commands.describe(mode="reply: one message, webhook: post as the author, edit: legacy reply-then-edit")
+@app_commands.choices(mode=[app_commands.Choice(name=mode, value=mode) for mode in REPOST_MODES])
+async def server_set_repost_mode(interaction: discord.Interaction, mode: app_commands.Choice[str]):
+    """Set how cleaned messages are reposted in this server."""
+    await update_guild_setting(interaction, "repost_mode", mode.value, f"Repost mode has been set to `{mode.value}`")
+
+@server_group.command(name="set_regex", description="Set the regex pattern used to detect URLs in this server")
+@app_commands.describe(pattern="The regex pattern to use for URL detection")
+async def server_set_regex(interaction: discord.Interaction, pattern: str):
+    """Set the regex pattern used to detect URLs in this server."""
+    if not is_admin(interaction):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        await interaction.response.send_message(
+            f"❌ Invalid regex pattern: {e}\n\nPlease provide a valid regex pattern.",
+            ephemeral=True
+        )
+        return
+    
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    error, report = await check_regex(pattern)
+    if error:
+        await interaction.followup.send(f"❌ {error}\n\n{report}", ephemeral=True)
+        return
+    
+    await set_guild_setting(interaction.guild_id, "regex_keys", pattern)
+    await interaction.followup.send(f"✅ Regex pattern has been updated for this server.\n\n{report}", ephemeral=True)
+
+@server_group.command(name="enable_tracker", description="Strip an extra tracker parameter in this server")
+@app_commands.describe(provider="The provider name (e.g., Google, Meta)")
+@app_commands.describe(tracker="The tracker parameter name (supports utm_* globs, re:<regex> rules and param@domain scopes)")
+async def server_enable_tracker(interaction: discord.Interaction, provider: str, tracker: str):
+    """Strip a tracker parameter in this server, on top of the global list."""
+    if not is_admin(interaction):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    
+    provider_normalized = provider.strip()
+    if provider_normalized:
+        provider_normalized = provider_normalized[0].upper() + provider_normalized[1:].lower()
+    tracker_normalized = tracker.strip()
+    
+    if not tracker_normalized:
+        await interaction.response.send_message("❌ Tracker parameter name cannot be empty.", ephemeral=True)
+        return
+    
+    error = rule_error(tracker_normalized)
+    if error is not None:
+        await interaction.response.send_message(f"❌ Invalid tracker regex: {error}", ephemeral=True)
+        return
+    
+    await set_guild_tracker(interaction.guild_id, tracker_normalized, provider_normalized, True)
+    await interaction.response.send_message(
+        f"✅ Tracker `{tracker_normalized}` ({provider_normalized}) is now stripped in this server.",
+        ephemeral=True
+    )
+
+@server_group.command(name="disable_tracker", description="Stop stripping a tracker parameter in this server")
+@app_commands.describe(tracker="The tracker parameter name to keep in links")
+async def server_disable_tracker(interaction: discord.Interaction, tracker: str):
+    """Keep a tracker parameter in links posted in this server."""
+    if not is_admin(interaction):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    
+    tracker_normalized = tracker.strip()
+    effective = guild_rules(interaction.guild_id).get(tracker_normalized.lower())
+    if effective is None:
+        await interaction.response.send_message(
+            f"❌ Tracker `{tracker_normalized}` is not stripped in this server.",
+            ephemeral=True
+        )
+        return
+    
+    param, provider = effective
+    await set_guild_tracker(interaction.guild_id, param, provider, False)
+    await interaction.response.send_message(
+        f"✅ Tracker `{param}` ({provider}) is no longer stripped in this server.",
+        ephemeral=True
+    )
+
+@server_group.command(name="reset", description="Drop every override for this server")
+async def server_reset(interaction: discord.Interaction):
+    """Make this server follow the global settings and tracker list again."""
+    if not is_admin(interaction):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    
+    await reset_guild(interaction.guild_id)
+    await interaction.response.send_message("✅ This server now uses the global settings again.", ephemeral=True)
+
+bot.tree.add_command(server_group)
+
+#--------------------------------------------------------------------
+# History Sweep Commands
+#--------------------------------------------------------------------
+
+sweep_group = app_commands.Group(name="sweep", description="Find trackers in older messages", guild_only=True)
+
+@sweep_group.command(name="start", description="Scan this server's message history for trackers")
+@app_commands.describe(
+    mode="report: only count and link messages with trackers, clean: also repost them without trackers",
+    channel="Only sweep this channel (default: every text channel)"
+)
+@app_commands.choices(mode=[app_commands.Choice(name=mode, value=mode) for mode in SWEEP_MODES])
+async def sweep_start(interaction: discord.Interaction, mode: app_commands.Choice[str], channel: discord.TextChannel = None):
+    """Start a history sweep of this server."""
+    if not is_admin(interaction):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    
+    if interaction.guild_id in history_sweeps:
+        await interaction.response.send_message(
+            "❌ A sweep is already running in this server. Use `/sweep status` or `/sweep stop`.",
+            ephemeral=True
+        )
+        return
+    
+    channels = [channel] if channel is not None else interaction.guild.text_channels
+    me = interaction.guild.me
+    channel_ids = [
+        candidate.id for candidate in channels
+        if candidate.permissions_for(me).read_message_history
+    ]
+    if not channel_ids:
+        await interaction.response.send_message("❌ The bot can't read the history of any of those channels.", ephemeral=True)
+        return
+    
+    await start_history_sweep(interaction.guild, mode.value, channel_ids)
+    await interaction.response.send_message(
+        f"✅ Started a `{mode.value}` sweep of {len(channel_ids)} channel(s). "
+        f"Use `/sweep status` to follow it; it resumes by itself if the bot restarts.",
+        ephemeral=True
+    )
+
+@sweep_group.command(name="status", description="Show the progress of this server's history sweep")
+async def sweep_status(interaction: discord.Interaction):
+    """Show sweep progress, with the messages found so far as an attachment."""
+    if not is_admin(interaction):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    
+    sweep = history_sweeps.get(interaction.guild_id)
+    if sweep is None:
+        await interaction.response.send_message("No sweep is running in this server.", ephemeral=True)
+        return
+    
+    totals = sweep.totals()
+    summary = (
+        f"`{sweep.mode}` sweep started {sweep.started_at}: "
+        f"{totals['channels_done']}/{totals['channels']} channel(s) done, "
+        f"{totals['scanned']} message(s) scanned, {totals['found']} with trackers, {totals['cleaned']} cleaned."
+    )
+    kwargs = {}
+    if sweep.found_links:
+        report = "\n".join(sweep.found_links) + "\n"
+        kwargs["file"] = discord.File(io.BytesIO(report.encode("utf-8")), filename="sweep.txt")
+    await interaction.response.send_message(summary, ephemeral=True, **kwargs)
+
+@sweep_group.command(name="stop", description="Stop this server's history sweep")
+async def sweep_stop(interaction: discord.Interaction):
+    """Stop the running sweep; its checkpoint is dropped."""
+    if not is_admin(interaction):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    
+    sweep = history_sweeps.pop(interaction.guild_id, None)
+    if sweep is None:
+        await interaction.response.send_message("No sweep is running in this server.", ephemeral=True)
+        return
+    
+    sweep.stop()
+    await guild_db.finish_sweep(interaction.guild_id)
+    totals = sweep.totals()
+    await interaction.response.send_message(
+        f"✅ Sweep stopped after scanning {totals['scanned']} message(s) ({totals['found']} with trackers).",
+        ephemeral=True
+    )
+
+bot.tree.add_command(sweep_group)
+
+if __name__ == "__main__":
+    bot.run(bot_token, log_handler=None)  # discord.py logs through the queue set up above
+    # Persist anything still inside the debounce window
+    config_store.flush_sync()
+    trackers_store.flush_sync()
+    save_tracker_hits()
@@ -0,0 +1,131 @@
+# Runs URL regexes in a separate process, so a slow pattern can be killed instead of
+# freezing the bot. Python's re module holds the GIL while matching, so a thread
+# can't be interrupted; a process can. Standard library only, main.py starts it.
+#
+# Usage:
+#   python3 regex_guard.py --bench < request.json    Benchmark patterns, print JSON results
+#   python3 regex_guard.py --serve                    Answer match span requests, one JSON line each
+#
+# A bench request is {"patterns": {"name": "regex", ...}}. A serve request is
+# {"pattern": "regex", "flags": 0, "group": 0, "message": "..."}, answered with {"spans": [[start, end], ...]}.
+
+import argparse
+import json
+import random
+import re
+import string
+import sys
+import time
+
+ADVERSARIAL_LENGTHS = (32, 1000, 4000)  # 4000 is the longest message Discord allows
+
+
+def adversarial_corpus() -> list:
+    """Inputs that make backtracking URL patterns blow up: long runs with no valid ending."""
+    runs = (
+        ("", "a", "!"),
+        ("", "a.", ""),
+        ("", "a-", "-"),
+        ("", ".", ""),
+        ("", "/", ""),
+        ("", "?", ""),
+        ("", "%", ""),
+        ("", "a1", "_"),
+        ("http://", "a", ""),
+        ("https://", "a.", "!"),
+        ("www.", "a-", ""),
+        ("http://a.com/", "?a=b&", ""),
+        ("http://a.com/", "a/", '"'),
+        ("", "x ", ""),
+    )
+    corpus = []
+    for n in ADVERSARIAL_LENGTHS:
+        for prefix, run, ending in runs:
+            body_length = n - len(prefix) - len(ending)
+            corpus.append(prefix + (run * body_length)[:body_length] + ending)
+    return corpus
+
+
+def realistic_corpus(count: int = 300, seed: int = 1234) -> list:
+    """Chat-like messages with and without links, similar to benchmarks/bench_core.py."""
+    rng = random.Random(seed)
+    words = ["check", "this", "out", "lol", "the", "new", "deal", "is", "live", "héllo", "日本語", "🔥"]
+    domains = ["example.com", "www.youtube.com", "youtu.be", "x.com", "www.amazon.com", "github.com"]
+    corpus = []
+    for _ in range(count):
+        tokens = [rng.choice(words) for _ in range(rng.choice([3, 8, 15, 40, 120]))]
+        for _ in range(rng.choices([0, 1, 2, 5], weights=[70, 20, 7, 3])[0]):
+            value = "".join(rng.choices(string.ascii_letters + string.digits, k=rng.randint(3, 16)))
+            url = f"{rng.choice(['https://', 'http://', ''])}{rng.choice(domains)}/{value}"
+            if rng.random() < 0.6:
+                url += f"?utm_source={value}&v={value[::-1]}"
+            tokens.insert(rng.randint(0, len(tokens)), url)
+        corpus.append(" ".join(tokens))
+    return corpus
+
+
+def time_corpus(regex: re.Pattern, corpus: list) -> tuple:
+    """Return (total seconds, slowest single input in seconds) for findall over a corpus."""
+    total = 0.0
+    worst = 0.0
+    for message in corpus:
+        start = time.perf_counter()
+        regex.findall(message)
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        worst = max(worst, elapsed)
+    return total, worst
+
+
+def bench(patterns: dict) -> dict:
+    """
+    Time each pattern on the realistic and adversarial corpora.
+
+    Results are printed after each pattern, so the caller still gets the
+    numbers of patterns that finished if it has to kill this process.
+    """
+    realistic = realistic_corpus()
+    adversarial = adversarial_corpus()
+    realistic_chars = sum(len(message) for message in realistic)
+    results = {}
+    for name, pattern in patterns.items():
+        regex = re.compile(pattern)
+        realistic_total, _ = time_corpus(regex, realistic)
+        adversarial_total, adversarial_worst = time_corpus(regex, adversarial)
+        results[name] = {
+            "realistic_seconds": realistic_total,
+            "chars_per_sec": realistic_chars / realistic_total if realistic_total else float("inf"),
+            "adversarial_seconds": adversarial_total,
+            "adversarial_worst_seconds": adversarial_worst,
+        }
+        print(json.dumps({name: results[name]}), flush=True)
+    return results
+
+
+def serve() -> None:
+    """Answer span requests from stdin until it closes."""
+    for line in sys.stdin:
+        request = json.loads(line)
+        regex = re.compile(request["pattern"], request.get("flags", 0))
+        group = request.get("group", 0)
+        spans = [match.span(group) for match in regex.finditer(request["message"])]
+        sys.stdout.write(json.dumps({"spans": spans}) + "\n")
+        sys.stdout.flush()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark or run URL regexes out of process.")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--bench", action="store_true", help="Benchmark the patterns in a JSON request on stdin")
+    mode.add_argument("--serve", action="store_true", help="Answer match span requests, one JSON line each")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve()
+    else:
+        bench(json.load(sys.stdin)["patterns"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())